@@ -1,76 +1,158 @@
+"""Export the annotations to (or import them from) a file of line-delimited json,
+one annotation per line.
+
+Neither side ever has more than a batch of annotations in memory. The export
+reads them `batch_size` at a time, each batch with their edits, tags, and
+comments in a fixed number of queries. The import reads the file one line at a
+time (the old single json array works too) and inserts each batch in bulk (see
+:func:`bulk_insert_annotations`).
+"""
 import sys
+import io
 import argparse
 import json
 import os
+from collections import defaultdict
+from itertools import islice
 
-iccvenv = os.environ['ICCVENV']
-idx = iccvenv.rfind('/')
-sys.path.append(os.environ['ICCVENV'][:idx])
+if 'ICCVENV' in os.environ:
+    iccvenv = os.environ['ICCVENV']
+    idx = iccvenv.rfind('/')
+    sys.path.append(os.environ['ICCVENV'][:idx])
+
+from sqlalchemy.orm import joinedload, selectinload
 
 from icc import db, create_app
-from icc.models.annotation import Annotation, Tag, Comment
-from icc.models.content import Edition
-from icc.models.user import User
+from icc.models.annotation import Annotation, Edit, Tag, Comment
+from icc.models.content import Line
+
+from inserts.insertlines import stream_json, stream_jsonl
+from inserts.insertannotations import get_community, bulk_insert_annotations
 
 
 TAG_DESCRIPTION = "This tag's description is still blank. Please expand it."
 
 
-def get_annotations():
-    annotations = []
-    for annotation in Annotation.query.all():
-        exp = {
-            'edition': annotation.edition.id,
-            'fl': annotation.HEAD.first_line_num,
-            'll': annotation.HEAD.last_line_num,
-            'fc': annotation.HEAD.first_char_idx,
-            'lc': annotation.HEAD.last_char_idx,
-            'body': annotation.HEAD.body,
-            'tags': [(tag.tag, tag.locked) for tag in annotation.HEAD.tags],
-            'locked': annotation.locked,
-            'comments': [{
-                'id': comment.id,
-                'depth': comment.depth,
-                'weight': comment.weight,
-                'parent_id': comment.parent_id,
-                'body': comment.body
-            } for comment in annotation.comments.all()]
-        }
-        annotations.append(exp)
-    return annotations
-
-
-def export(file_name):
-    annotations = get_annotations()
-    fout = open(file_name, 'wt')
-    json.dump(annotations, fout)
-
-
-def recreate(annotation):
-    annotation['edition'] = Edition.query.get(annotation['edition'])
-    tags = []
-    for tag in annotation['tags']:
-        tag_obj = Tag.query.filter_by(tag=tag[0]).first()
-        if not tag_obj:
-            tag_obj = Tag(tag=tag[0], locked=tag[1], description=TAG_DESCRIPTION)
-        tags.append(tag_obj)
-    annotation['tags'] = tags
-    comments = annotation.pop('comments')
-    return annotation, comments
-
-
-def _import(file_name):
-    fin = open(file_name, 'rt')
-    annotations = json.load(fin)
-    community = User.query.get(1)
-    for i, annotation_dict in enumerate(annotations):
-        annotation_dict, comments = recreate(annotation_dict)
-        annotation = Annotation(annotator=community, **annotation_dict)
-        for comment in comments:
-            annotation.comments.append(Comment(**comment, poster=community))
-        db.session.add(annotation)
-        if not i % 25:
-            print(f"{i} annotations added.")
+def get_annotations(batch_size=1000):
+    """Generate the annotations as dicts for export, in order, reading them
+    `batch_size` at a time.
+    """
+    last_id = 0
+    while True:
+        batch = Annotation.query.filter(Annotation.id>last_id)\
+            .order_by(Annotation.id)\
+            .options(joinedload(Annotation.HEAD).selectinload(Edit.tags))\
+            .limit(batch_size).all()
+        if not batch:
+            return
+        comments = defaultdict(list)
+        for comment in Comment.query\
+                .filter(Comment.annotation_id.in_([a.id for a in batch]))\
+                .order_by(Comment.id):
+            comments[comment.annotation_id].append(comment)
+        for annotation in batch:
+            yield {
+                'edition': annotation.edition_id,
+                'fl': annotation.HEAD.first_line_num,
+                'll': annotation.HEAD.last_line_num,
+                'fc': annotation.HEAD.first_char_idx,
+                'lc': annotation.HEAD.last_char_idx,
+                'body': annotation.HEAD.body,
+                'tags': [(tag.tag, tag.locked) for tag in
+                         annotation.HEAD.tags],
+                'locked': annotation.locked,
+                'comments': [{
+                    'id': comment.id,
+                    'depth': comment.depth,
+                    'weight': comment.weight,
+                    'parent_id': comment.parent_id,
+                    'body': comment.body
+                } for comment in comments[annotation.id]]
+            }
+        last_id = batch[-1].id
+
+
+def export(fout, batch_size=1000):
+    """Write the annotations to the file, one json object per line. Return how
+    many there were.
+    """
+    count = 0
+    for annotation in get_annotations(batch_size):
+        fout.write(json.dumps(annotation))
+        fout.write('\n')
+        count += 1
+    return count
+
+
+def read_annotations(fin):
+    """Generate the annotations in the file, whether it's line-delimited or an
+    array.
+    """
+    start = fin.read(64)
+    fin.seek(0)
+    if start.lstrip().startswith('['):
+        yield from stream_json(fin)
+    else:
+        yield from stream_jsonl(fin)
+
+
+def import_annotations(annotations, batch_size=1000):
+    """Insert the exported annotations `batch_size` at a time. The tags are
+    looked up by name once each (and created if they don't exist), and each
+    annotation's toc is the toc of it's first line.
+
+    Returns
+    -------
+    tuple
+        The number of annotations inserted, and the annotations that were
+        skipped because their first line isn't in their edition.
+    """
+    community = get_community()
+    tags = {tag: id for tag, id in db.session.query(Tag.tag, Tag.id)}
+    tocs = {}
+    count = 0
+    skipped = []
+    annotations = iter(annotations)
+    while True:
+        batch = list(islice(annotations, batch_size))
+        if not batch:
+            return count, skipped
+
+        rows = []
+        for annotation in batch:
+            for tag, locked in annotation['tags']:
+                if tag not in tags:
+                    obj = Tag(tag=tag, locked=locked,
+                              description=TAG_DESCRIPTION)
+                    db.session.add(obj)
+                    db.session.flush()
+                    tags[tag] = obj.id
+            edition = annotation['edition']
+            if edition not in tocs:
+                tocs[edition] = dict(
+                    db.session.query(Line.num, Line.toc_id)
+                    .filter(Line.edition_id==edition))
+            first_line = min(annotation['fl'], annotation['ll'])
+            if first_line not in tocs[edition]:
+                skipped.append(annotation)
+                continue
+            rows.append({
+                'edition_id': edition, 'toc_id': tocs[edition][first_line],
+                'fl': annotation['fl'], 'll': annotation['ll'],
+                'fc': annotation['fc'], 'lc': annotation['lc'],
+                'body': annotation['body'], 'locked': annotation['locked'],
+                'tag_ids': [tags[tag] for tag, _ in annotation['tags']],
+                'comments': annotation['comments']})
+        count += bulk_insert_annotations(community, rows)
+        print(f"{count} annotations added.")
+
+
+def _import(file_name, batch_size=1000):
+    with io.open(file_name, 'r', encoding='utf-8-sig') as fin:
+        count, skipped = import_annotations(read_annotations(fin), batch_size)
+    for annotation in skipped:
+        print(f"Skipped an annotation on line {annotation['fl']}, which isn't "
+              f"in edition {annotation['edition']}.")
     db.session.commit()
 
 
@@ -78,9 +160,11 @@ def main(args):
     app = create_app()
     with app.app_context():
         if args.output:
-            export(args.output)
+            with open(args.output, 'wt') as fout:
+                count = export(fout, args.batch_size)
+            print(f"{count} annotations exported.")
         elif args.input:
-            _import(args.input)
+            _import(args.input, args.batch_size)
 
 
 if __name__ == '__main__':
@@ -92,5 +176,9 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', action='store', type=str,
                         help="The output file to write the jsonified "
                         "annotations")
+    parser.add_argument('-b', '--batch-size', action='store', type=int,
+                        default=1000,
+                        help="The number of annotations to read or write at a "
+                        "time.")
     args = parser.parse_args()
     main(args)
@@ -31,6 +31,8 @@ def create_app(config_class=Config):
     app.config.from_object(config_class)
 
     db.init_app(app)
+    from icc import instrumentation
+    instrumentation.init_app(app)
     talisman.init_app(app, content_security_policy=app.config['CSP'],
                       content_security_policy_nonce_in=['script-src'])
     migrate.init_app(app, db)
@@ -40,6 +42,8 @@ def create_app(config_class=Config):
     moment.init_app(app)
     app.elasticsearch = Elasticsearch([app.config["ELASTICSEARCH_URL"]]) \
         if app.config["ELASTICSEARCH_URL"] else None
+    from icc import search
+    search.init_app(app)
 
     from icc.admin import admin as admin_bp
     app.register_blueprint(admin_bp)
@@ -106,6 +110,9 @@ def create_app(config_class=Config):
     app.jinja_env.lstrip_blocks = True
     app.jinja_env.auto_reload = True
 
+    from icc import enums
+    enums.init_app(app)
+
     return app
 
 
@@ -114,4 +121,6 @@ from icc.models.content import classes as cclasses
 from icc.models.request import classes as rclasses
 from icc.models.user import classes as uclasses
 from icc.models.wiki import classes as wclasses
-classes = {**aclasses, **cclasses, **rclasses, **wclasses, **uclasses}
+from icc.models.search import classes as sclasses
+classes = {**aclasses, **cclasses, **rclasses, **wclasses, **uclasses,
+           **sclasses}
@@ -5,6 +5,7 @@ from flask import (render_template, flash, redirect, url_for, request,
 from flask_login import current_user, login_required
 
 from icc import db
+from icc.cards import AnnotationCards
 from icc.forms import AreYouSureForm
 from icc.funky import generate_next, authorize
 from icc.admin import admin
@@ -68,11 +69,12 @@ def view_deactivated_annotations():
     prev_page = (url_for('admin.view_deactivated_annotations',
                          page=annotations.prev_num, sort=sort) if
                  annotations.has_prev else None)
+    cards = AnnotationCards([a.id for a in annotations.items], current_user)
     return render_template('indexes/annotation_list.html',
                            title="Deactivated Annotations",
                            prev_page=prev_page, next_page=next_page,
                            sort=sort, sorts=sorturls,
-                           annotations=annotations.items)
+                           annotations=cards.annotations, cards=cards)
 
 
 @admin.route('/flags/annotation/all/')
@@ -27,7 +27,7 @@ def edit_review_queue():
 
     sorts = {
         'voted': Edit.query.outerjoin(EditVote).order_by(EditVote.delta.desc()),
-        'annotation': Edit.query.join(Annotation).order_by(Annotation.id.asc()),
+        'annotation': Edit.query.join(Edit.annotation).order_by(Annotation.id.asc()),
         'number': Edit.query.order_by(Edit.num.asc()),
         'editor': Edit.query.join(User).order_by(User.displayname.asc()),
         'time': Edit.query.order_by(Edit.timestamp.asc()),
@@ -51,7 +51,8 @@ def edit_review_queue():
                            title="Edit Review Queue",
                            next_page=next_page, prev_page=prev_page,
                            sort=sort, sorts=sorturls,
-                           edits=edits.items)
+                           edits=edits.items,
+                           votes=current_user.get_votes(edits.items))
 
 
 @admin.route('/annotation/<annotation_id>/edit/<edit_id>/review')
@@ -104,15 +105,15 @@ def delete_edit(edit_id):
     form = AreYouSureForm()
     edit = Edit.query.get_or_404(edit_id)
     redirect_url = generate_next(url_for('main.edit_history',
-                                         annotation_id=edit.annotation_id))
+                                         annotation_id=edit.entity_id))
     if form.validate_on_submit():
         if edit.current:
-            edit.previous.current = True
+            edit.annotation.set_head(edit.previous)
         else:
             for e in edit.annotation.all_edits.order_by(Edit.num.desc()).all():
                 if e.num > edit.num:
                     e.num -= 1
-        flash(f"Edit #{edit.num} of [{edit.annotation_id}] deleted.")
+        flash(f"Edit #{edit.num} of [{edit.entity_id}] deleted.")
         db.session.delete(edit)
         db.session.commit()
         return redirect(redirect_url)
@@ -125,6 +126,6 @@ def delete_edit(edit_id):
     """
     return render_template('forms/delete_check.html',
                            title=f"Delete edit #{edit.num} of "
-                           f"[{edit.annotation_id}]",
+                           f"[{edit.entity_id}]",
                            form=form,
                            text=text)
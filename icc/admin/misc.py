@@ -7,7 +7,7 @@ from icc.funky import generate_next, authorize
 from icc.admin import admin
 from icc.admin.forms import LineForm
 
-from icc.models.content import Line
+from icc.models.content import Line, SectionCache
 
 
 @admin.route('/edit/line/<line_id>/', methods=['GET', 'POST'])
@@ -20,7 +20,8 @@ def edit_line(line_id):
     form = LineForm()
     redirect_url = generate_next(line.url)
     if form.validate_on_submit() and form.line.data is not None:
-        line.body = form.line.data
+        line.edit(form.line.data)
+        SectionCache.invalidate(line.toc_id)
         db.session.commit()
         flash("Line updated.")
         return redirect(redirect_url)
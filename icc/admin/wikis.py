@@ -50,7 +50,8 @@ def wiki_edit_review_queue():
                            title="Wiki Edit Review Queue",
                            next_page=next_page, prev_page=prev_page, page=page,
                            sort=sort, sorts=sorturls,
-                           edits=edits.items)
+                           edits=edits.items,
+                           votes=current_user.get_votes(edits.items))
 
 
 @admin.route('/wiki/<wiki_id>/edit/<edit_id>/review')
@@ -3,12 +3,15 @@ import time
 from string import ascii_lowercase as lowercase
 from datetime import datetime
 
-from flask import request, jsonify, current_app, get_flashed_messages, flash
+from flask import (request, jsonify, current_app, get_flashed_messages, flash,
+                   url_for)
 from flask_login import current_user, login_required
+from sqlalchemy.exc import IntegrityError
 
 from icc import db, classes
+from icc.search import query_prefix
 from icc.models.annotation import Tag
-from icc.models.content import Edition, TOC
+from icc.models.content import Edition, TOC, Line
 from icc.ajax import ajax
 
 
@@ -61,9 +64,11 @@ def vote():
     if not current_user.is_authenticated:
         flash(f"You must login to vote.")
         return jsonify({'success': False, 'rollback': False, 'status': 'login'})
-    entity = entity_cls.query.get(entity_id)
+    entity = entity_cls.get_for_vote(entity_id, current_user)
+    if not entity:
+        return jsonify({'success': False, 'rollback': False,
+                        'status': 'not-a-thing'})
     original_weight = entity.weight
-    vote = current_user.get_vote(entity)
     if isinstance(entity, classes['Annotation']) and not entity.active:
         flash("You cannot vote on deactivated annotations.")
         return jsonify({'success': False, 'rollback': False,
@@ -71,8 +76,15 @@ def vote():
     up = True if request.args.get('up').lower() == 'true' else False
     status = (entity.upvote(current_user) if up else
               entity.downvote(current_user))
-    db.session.commit()
+    # read the weight before the commit expires it
     new_weight = entity.weight
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another request from the same user got their vote in first
+        db.session.rollback()
+        return jsonify({'success': False, 'rollback': False,
+                        'status': 'conflict'})
     change = new_weight - original_weight
     status['change'] = change
     return jsonify(status)
@@ -112,6 +124,36 @@ def line(toc_id):
                     'enum': str(line.enum) })
 
 
+@ajax.route('/search/lines')
+def search_lines():
+    """Search the lines of a text (`?text=<id>`) or an edition
+    (`?edition=<id>`) as the query (`?q=`) is typed, for incremental search.
+    The last word of the query is a prefix. It answers within
+    `SEARCH_PREFIX_TIMEOUT` with at most `SEARCH_PREFIX_LIMIT` lines, with the
+    words that matched highlighted. If it runs out of time, there are no lines
+    and `timed_out` is true (and the next keystroke will try again).
+    """
+    filters = {}
+    for scope in ['text', 'edition']:
+        ident = request.args.get(scope, type=int)
+        if ident is not None:
+            filters[f'{scope}_id'] = ident
+    if not filters:
+        return jsonify({'success': False, 'lines': [], 'timed_out': False})
+    hits, timed_out = query_prefix('line', request.args.get('q', ''), filters)
+    lines = []
+    for id, fields in hits:
+        url = (url_for('main.line_annotations',
+                       text_url=fields['text_url_name'],
+                       edition_num=fields.get('edition_num'),
+                       nums=fields.get('num')) if
+               fields.get('text_url_name') else None)
+        html = Line.highlight_html(fields) or fields.get('html')
+        lines.append({'id': id, 'num': fields.get('num'), 'line': html,
+                      'url': url})
+    return jsonify({'success': True, 'lines': lines, 'timed_out': timed_out})
+
+
 server_start_time = time.time()
 
 
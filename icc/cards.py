@@ -0,0 +1,94 @@
+"""The annotation card loader.
+
+An annotation card (`includes/_annotation_standalone.html`) needs the
+annotation's HEAD, HEAD's tags, toc, and editor, the annotator, the edition,
+it's text and writers, the number of comments, and the user's vote and whether
+they follow it. Rendered in a loop, each of those is a lazy load per card, so a
+page of annotations was dozens of queries. This loads all of it for a whole page in a fixed number of
+batched queries, no matter how many annotations are on the page.
+"""
+from sqlalchemy.orm import selectinload, joinedload
+
+from icc import db
+from icc.models.annotation import Annotation, Comment, Edit
+from icc.models.content import Edition
+
+
+class AnnotationCards:
+    """The annotations of a page of cards, with everything the cards need
+    loaded.
+
+    Attributes
+    ----------
+    annotations : list
+        The annotations, in the order of the ids.
+    votes : dict
+        The user's votes on the annotations, by annotation (see
+        :meth:`User.get_votes`).
+    comment_counts : dict
+        The number of comments on each annotation, by annotation id.
+    followed : set
+        The annotations the user follows (for `includes/_follow.html`, in place
+        of `user.followed_annotations`, which is a query per card).
+    """
+    def __init__(self, ids, user):
+        ids = list(ids)
+        self.user = user
+        self.annotations = []
+        self.votes = {}
+        self.comment_counts = {}
+        self.followed = set()
+        if not ids:
+            return
+
+        head = selectinload(Annotation.HEAD)
+        annotations = Annotation.query.filter(Annotation.id.in_(ids))\
+            .options(head.selectinload(Edit.tags),
+                     head.joinedload(Edit.editor),
+                     head.joinedload(Edit.toc),
+                     joinedload(Annotation.annotator),
+                     selectinload(Annotation.edition)
+                     .joinedload(Edition.text)).all()
+        by_id = {annotation.id: annotation for annotation in annotations}
+        self.annotations = [by_id[i] for i in ids if i in by_id]
+
+        Edition.load_writers({annotation.edition for annotation in
+                              self.annotations})
+
+        counts = db.session\
+            .query(Comment.annotation_id, db.func.count(Comment.id))\
+            .filter(Comment.annotation_id.in_(ids))\
+            .group_by(Comment.annotation_id)
+        self.comment_counts = {i: 0 for i in ids}
+        self.comment_counts.update(counts)
+
+        self.votes = user.get_votes(self.annotations)
+
+        if user.is_authenticated:
+            followers = Annotation.table
+            followed = {i for i, in db.session
+                        .query(followers.c.annotation_id)
+                        .filter(followers.c.user_id==user.id,
+                                followers.c.annotation_id.in_(ids))}
+            self.followed = {annotation for annotation in self.annotations
+                             if annotation.id in followed}
+
+    def __iter__(self):
+        return iter(self.annotations)
+
+    def __len__(self):
+        return len(self.annotations)
+
+    def vote(self, entity):
+        """The user's vote on the entity. Anything that isn't one of the
+        annotations falls back to :meth:`User.get_vote`.
+        """
+        if entity in self.votes:
+            return self.votes[entity]
+        return self.user.get_vote(entity)
+
+    def comment_count(self, annotation):
+        """The number of comments on the annotation."""
+        if annotation.id in self.comment_counts:
+            return self.comment_counts[annotation.id]
+        return annotation.comments.count()
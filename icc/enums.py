@@ -0,0 +1,166 @@
+"""A process-wide registry of the enumerations.
+
+The enums (every :class:`EnumMixin` class: the flag enums, LineEnum, TOCEnum,
+ReputationEnum, AdminRight, etc.) are basically static. They're inserted once
+by the insert scripts and then hardly ever change. But they were queried on
+every request anyway (e.g., the annotation flags in `before_request`). This
+loads all of them once per process, when the app is created (see
+:func:`init_app`), into immutable records.
+
+A class is reloaded:
+
+- when a transaction that inserted, updated, or deleted one of it's enums
+  through the ORM commits (not before, so a transaction that's rolled back
+  never gets cached);
+- when it's been loaded for `ENUM_REGISTRY_TTL` seconds, because a change made
+  by any other process (another app worker, an insert script) can't tell this
+  one. That's the most stale the registry can be.
+- when you call :meth:`EnumRegistry.reload` yourself.
+
+And an id or enum string that isn't in the registry (e.g., it was just added by
+another process) is looked up in the database before we give up on it.
+
+The records are namedtuples of the enum's columns (so they have `id`, `enum`,
+and whatever else the class has, e.g., `min_rep` or `default_delta`), *not*
+ORM objects, so they can't go stale or be detached. If you need the actual
+object (e.g., to assign to a relationship), `query.get()` it by the record's id.
+"""
+import time
+from collections import namedtuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import orm
+from sqlalchemy.exc import SQLAlchemyError
+
+from icc import db
+from icc.models.mixins import EnumMixin
+
+
+class EnumRegistry:
+    """The registry. There's only one, :data:`enums`."""
+
+    def __init__(self):
+        self._records = {}
+        self._values = {}
+
+    @staticmethod
+    def classes():
+        """All of the mapped enum classes."""
+        found = []
+        subclasses = list(EnumMixin.__subclasses__())
+        while subclasses:
+            cls = subclasses.pop(0)
+            subclasses.extend(cls.__subclasses__())
+            if hasattr(cls, '__mapper__') and cls not in found:
+                found.append(cls)
+        return found
+
+    def record(self, cls):
+        """The record type of the enum class, a namedtuple of it's columns that
+        prints like the enum does.
+        """
+        if cls not in self._records:
+            columns = [attr.key for attr in cls.__mapper__.column_attrs]
+            record = namedtuple(f'{cls.__name__}Record', columns)
+            record.__str__ = lambda self: (getattr(self, 'display', None) or
+                                           self.enum)
+            self._records[cls] = record
+        return self._records[cls]
+
+    def _query(self, cls):
+        return db.session.query(*[getattr(cls, column) for column in
+                                  self.record(cls)._fields])
+
+    def _load(self, cls):
+        ttl = current_app.config.get('ENUM_REGISTRY_TTL', 60) if\
+            has_app_context() else None
+        loaded = self._values.get(cls)
+        if loaded is None or\
+                (ttl is not None and time.monotonic() - loaded[0] >= ttl):
+            record = self.record(cls)
+            values = tuple(record(*row) for row in
+                           self._query(cls).order_by(cls.id))
+            loaded = (time.monotonic(), values,
+                      {value.id: value for value in values},
+                      {value.enum: value for value in values})
+            self._values[cls] = loaded
+        return loaded
+
+    def _fetch(self, cls, **kwargs):
+        # a miss is looked up, but not cached (it could be uncommitted)
+        row = self._query(cls).filter_by(**kwargs).first()
+        return self.record(cls)(*row) if row else None
+
+    def all(self, cls):
+        """All of the enums of the class, in order of id."""
+        return self._load(cls)[1]
+
+    def get(self, cls, id):
+        """The enum of the class with the id (or None)."""
+        value = self._load(cls)[2].get(id)
+        if value is None and id is not None:
+            value = self._fetch(cls, id=id)
+        return value
+
+    def by_enum(self, cls, enum):
+        """The enum of the class with the enum string (or None)."""
+        value = self._load(cls)[3].get(enum)
+        if value is None and enum is not None:
+            value = self._fetch(cls, enum=enum)
+        return value
+
+    def load(self, *classes):
+        """Load the classes (default: all of them) now instead of on first
+        use.
+        """
+        for cls in classes or self.classes():
+            self._load(cls)
+
+    def reload(self, cls=None):
+        """Drop the class (or every class) so that it's loaded again on next
+        use.
+        """
+        if cls is None:
+            self._values.clear()
+        else:
+            self._values.pop(cls, None)
+
+
+enums = EnumRegistry()
+
+
+def init_app(app):
+    """Load the enums for the app. The registry is shared by every app in the
+    process (e.g., in the tests), so whatever another app loaded is dropped
+    first. If the tables aren't there (yet), they're loaded on first use
+    instead.
+    """
+    enums.reload()
+    with app.app_context():
+        try:
+            enums.load()
+        except SQLAlchemyError:
+            enums.reload()
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+
+@db.event.listens_for(EnumMixin, 'after_insert', propagate=True)
+@db.event.listens_for(EnumMixin, 'after_update', propagate=True)
+@db.event.listens_for(EnumMixin, 'after_delete', propagate=True)
+def _enum_changed(mapper, connection, target):
+    session = orm.object_session(target)
+    if session is not None:
+        session.info.setdefault('enums_changed', set()).add(mapper.class_)
+
+
+@db.event.listens_for(orm.Session, 'after_commit')
+def _reload_changed_enums(session):
+    for cls in session.info.pop('enums_changed', ()):
+        enums.reload(cls)
+
+
+@db.event.listens_for(orm.Session, 'after_rollback')
+def _forget_changed_enums(session):
+    session.info.pop('enums_changed', None)
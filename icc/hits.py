@@ -0,0 +1,125 @@
+"""The line search hit loader.
+
+A search hit (`indexes/search.html`) needs the line's toc (for it's url), the
+edition, it's text and writers, the lines around it, and the number of
+annotations on each of those. Rendered in a loop, each of those is a lazy load
+per hit (and a count query per line of context), so a page of results was
+dozens of queries. This loads all of it for a whole page in a fixed number of
+batched queries, no matter how many hits are on the page.
+
+With `SEARCH_RESULTS_FROM_INDEX`, it doesn't load the lines at all, the hits
+are shown with the fields that were stored with them in the index (see
+:attr:`Line.__stored__`), which the backend hands back highlighted and with the
+lines around them.
+"""
+from collections import defaultdict
+
+from sqlalchemy.orm import selectinload, joinedload
+
+from icc import db
+from icc.search import document
+from icc.models.annotation import Annotation, AnnotationRange
+from icc.models.content import Line, Edition
+
+
+class LineHits:
+    """The lines of a page of search hits, with everything the results page
+    needs loaded.
+
+    Parameters
+    ----------
+    hits : list
+        The hits from the search backend: ids, or, if the hits are to be shown
+        from the index, (id, fields) tuples.
+
+    Attributes
+    ----------
+    lines : list
+        The lines, in the order of the hits. From the index, they're the dicts
+        of the stored fields (with the line's `id`), not Lines.
+    from_index : bool
+        Whether the lines are from the index.
+    annotation_counts : dict
+        The number of annotations on each line of the context of the lines, by
+        line id.
+    """
+    def __init__(self, hits):
+        hits = list(hits)
+        self.from_index = any(isinstance(hit, tuple) for hit in hits)
+        ids = [hit[0] if isinstance(hit, tuple) else hit for hit in hits]
+        self.lines = []
+        self.annotation_counts = {}
+        if not ids:
+            return
+
+        if self.from_index:
+            sources = {id: fields for id, fields in hits if fields}
+            # lines indexed before they had any stored fields have to come from
+            # the database
+            missing = [i for i in ids if i not in sources]
+            if missing:
+                lines = Line.query.filter(Line.id.in_(missing))\
+                    .options(joinedload(Line.edition)
+                             .joinedload(Edition.text)).all()
+                Edition.load_writers({line.edition for line in lines})
+                sources.update(document(line) for line in lines)
+            self.lines = [{'id': i, **sources[i]} for i in ids if i in sources]
+            # the backend highlights the body, which still has the emphasis
+            # underscores in it
+            for line in self.lines:
+                if 'highlight' in line:
+                    line['highlight'] = Line.highlight_html(line)
+            return
+
+        lines = Line.query.filter(Line.id.in_(ids))\
+            .options(joinedload(Line.toc), joinedload(Line.enum),
+                     joinedload(Line.edition).joinedload(Edition.text),
+                     selectinload(Line.context).joinedload(Line.enum)).all()
+        by_id = {line.id: line for line in lines}
+        self.lines = [by_id[i] for i in ids if i in by_id]
+        if not self.lines:
+            return
+
+        Edition.load_writers({line.edition for line in self.lines})
+
+        # every annotation on any line of the context of any of the hits, in
+        # one query (an annotation in several buckets comes back once per
+        # bucket, hence the distinct)
+        ranges = []
+        for line in self.lines:
+            first, last = line.num - 1, line.num + 1
+            ranges.append(db.and_(
+                AnnotationRange.edition_id==line.edition_id,
+                AnnotationRange.bucket.in_(
+                    list(AnnotationRange.buckets(first, last))),
+                AnnotationRange.first_line_num<=last,
+                AnnotationRange.last_line_num>=first))
+        annotations = db.session\
+            .query(AnnotationRange.annotation_id, AnnotationRange.edition_id,
+                   AnnotationRange.first_line_num,
+                   AnnotationRange.last_line_num)\
+            .join(Annotation).filter(Annotation.active==True, db.or_(*ranges))\
+            .distinct()
+        by_edition = defaultdict(list)
+        for _, edition_id, first, last in annotations:
+            by_edition[edition_id].append((first, last))
+        for line in self.lines:
+            for l in line.context:
+                self.annotation_counts[l.id] = sum(
+                    1 for first, last in by_edition[l.edition_id] if
+                    first <= l.num <= last)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        return self.lines[i]
+
+    def annotation_count(self, line):
+        """The number of annotations on the line."""
+        if line.id in self.annotation_counts:
+            return self.annotation_counts[line.id]
+        return line.annotations.count()
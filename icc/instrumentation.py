@@ -0,0 +1,132 @@
+"""Per-request SQL instrumentation.
+
+This counts the statements every request issues and the total time spent in the
+database. It does three things with that:
+
+- Statements that take longer than `SLOW_QUERY_THRESHOLD` seconds are logged
+  with the route that issued them.
+- In debug (or with `QUERY_HEADERS` on) the count and time are exposed in the
+  `X-Query-Count` and `Server-Timing` headers, so you can see them in the
+  browser's dev tools.
+- Routes can be given a budget in `QUERY_BUDGETS` (by endpoint). A route that
+  goes over its budget is logged, or, in testing, raises
+  :class:`QueryBudgetExceeded`, so that an N+1 fails the tests instead of
+  showing up in production as latency.
+"""
+import time
+
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in testing when a route issues more statements than its budget.
+    """
+    pass
+
+
+class QueryStats:
+    """The statements issued by a single request.
+
+    Attributes
+    ----------
+    count : int
+        The number of statements.
+    duration : float
+        The total time spent executing them, in seconds.
+    """
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.
+
+    def __repr__(self):
+        return f'<QueryStats {self.count} in {self.duration*1000:.1f}ms>'
+
+
+def query_stats():
+    """Return the :class:`QueryStats` of the current request (or None if we're
+    not in a request of an instrumented app).
+    """
+    if not has_request_context() or\
+            'instrumentation' not in current_app.extensions:
+        return None
+    if 'query_stats' not in g:
+        g.query_stats = QueryStats()
+    return g.query_stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _record(conn, statement):
+    """Pop the statement's start off the connection and count it."""
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    stats = query_stats()
+    if stats is None:
+        return
+    stats.count += 1
+    stats.duration += duration
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD']
+    if threshold is not None and duration >= threshold:
+        current_app.logger.warning(
+            f"Slow query ({duration:.3f}s) in {request.endpoint} "
+            f"({request.path}): {statement}")
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    _record(conn, statement)
+
+
+def _handle_error(context):
+    # a statement that fails never gets to after_cursor_execute, so without
+    # this it's start would be left on the (pooled) connection for good
+    conn = context.connection
+    if context.execution_context is None or conn is None or\
+            not conn.info.get('query_start'):
+        return
+    _record(conn, context.statement)
+
+
+def _before_request():
+    # g belongs to the app context, which can outlive the request (e.g., in the
+    # tests), so we start the count fresh.
+    g.query_stats = QueryStats()
+
+
+def _after_request(response):
+    stats = query_stats() or QueryStats()
+    if current_app.debug or current_app.config['QUERY_HEADERS']:
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={stats.duration*1000:.1f};desc="{stats.count} queries"')
+    budget = current_app.config['QUERY_BUDGETS'].get(request.endpoint)
+    if budget is not None and stats.count > budget:
+        message = (f"{request.endpoint} issued {stats.count} queries (budget "
+                   f"{budget}).")
+        if current_app.testing:
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
+
+
+def init_app(app):
+    """Wire the instrumentation into the app. The cursor events are on the
+    Engine class, so they only have to be listened for once no matter how many
+    apps we create (i.e., in the tests).
+    """
+    app.config.setdefault('SLOW_QUERY_THRESHOLD', None)
+    app.config.setdefault('QUERY_HEADERS', False)
+    app.config.setdefault('QUERY_BUDGETS', {})
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.extensions['instrumentation'] = True
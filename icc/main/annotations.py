@@ -8,6 +8,7 @@ from flask import (render_template, flash, redirect, url_for, request, abort,
 from flask_login import current_user, login_required
 
 from icc import db
+from icc.enums import enums
 from icc.main import main
 
 from icc.models.annotation import (Annotation, Comment, Edit, Tag,
@@ -281,10 +282,15 @@ def comments(annotation_id):
         flash("Comment posted")
         return redirect(url_for('main.comments', annotation_id=annotation.id))
 
+    # the replies are rendered recursively, so get the votes on the whole
+    # discussion at once (the comments are in the identity map after this, so
+    # the replies come out as the same objects)
+    votes = current_user.get_votes([annotation] + annotation.comments.all())
     return render_template('indexes/comments.html',
                            title=f"[{annotation.id}] comments", form=form,
-                           flags=CommentFlag.enum_cls.query.all(),
-                           annotation=annotation, comments=comments.items)
+                           flags=enums.all(CommentFlag.enum_cls),
+                           annotation=annotation, comments=comments.items,
+                           votes=votes)
 
 
 @main.route('/annotation/<annotation_id>/comment/<comment_id>/reply',
@@ -1,8 +1,12 @@
 """The routes governing editions."""
 from flask import render_template, url_for, request, abort, current_app
+from flask_login import current_user
+from icc import db
+from icc.cards import AnnotationCards
 from icc.main import main
+from icc.pagination import keyset_paginate
 
-from icc.models.annotation import Annotation, Edit, Comment
+from icc.models.annotation import Annotation, Comment
 from icc.models.content import Text, Edition
 from icc.forms import SearchForm
 
@@ -25,26 +29,29 @@ def edition_annotations(text_url, edition_num):
     default = 'newest'
     sort = request.args.get('sort', default, type=str)
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     text = Text.query.filter_by(title=text_url.replace('_', ' ')).first_or_404()
     edition = text.editions.filter_by(num=edition_num).first_or_404()
 
     sorts = {
-        'newest': edition.annotations.order_by(Annotation.id.desc()),
-        'oldest': edition.annotations.order_by(Annotation.id.asc()),
-        'modified': (edition.annotations.join(Edit)
-                     .filter(Edit.current==True)
-                     .order_by(Edit.timestamp.desc())),
-        'weight': edition.annotations.order_by(Annotation.weight.desc()),
-        'line': (edition.annotations.join(Edit)
-                 .filter(Edit.current==True)
-                 .order_by(Edit.last_line_num.asc())),
-        'active': (edition.annotations.join(Comment).group_by(Annotation.id)
-                   .order_by(Comment.timestamp.desc()))
+        'newest': (edition.annotations, (Annotation.id.desc(),)),
+        'oldest': (edition.annotations, (Annotation.id.asc(),)),
+        'modified': (edition.annotations, (Annotation.modified_at.desc(),
+                                           Annotation.id.desc())),
+        'weight': (edition.annotations, (Annotation.weight.desc(),
+                                         Annotation.id.desc())),
+        'line': (edition.annotations, (Annotation.last_line_num.asc(),
+                                       Annotation.id.asc())),
+        'active': (edition.annotations.join(Comment).group_by(Annotation.id),
+                   (db.func.max(Comment.timestamp).desc(),
+                    Annotation.id.desc()))
     }
 
     sort = sort if sort in sorts else default
-    annotations = sorts[sort].filter(Annotation.active==True)\
-        .paginate(page, current_app.config['ANNOTATIONS_PER_PAGE'], False)
+    query, order = sorts[sort]
+    annotations = keyset_paginate(query.filter(Annotation.active==True), order,
+                                  current_app.config['ANNOTATIONS_PER_PAGE'],
+                                  cursor=cursor, page=page)
     if not annotations.items and page > 1:
         abort(404)
 
@@ -53,14 +60,15 @@ def edition_annotations(text_url, edition_num):
                 sorts.keys()}
     next_page = (url_for('main.edition_annotations', text_url=text.url,
                          edition_num=edition.num, sort=sort,
-                         page=annotations.next_num) if annotations.has_next else
-                 None)
+                         cursor=annotations.next_cursor)
+                 if annotations.has_next else None)
     prev_page = (url_for('main.edition_annotations', text_url=text_url,
                          edition_num=edition.num, sort=sort,
-                         page=annotations.prev_num) if annotations.has_prev else
-                 None)
+                         cursor=annotations.prev_cursor)
+                 if annotations.has_prev else None)
+    cards = AnnotationCards([a.id for a in annotations.items], current_user)
     return render_template('indexes/annotation_list.html',
                            title=f"{str(edition)} - Annotations",
                            next_page=next_page, prev_page=prev_page,
                            sorts=sorturls, sort=sort,
-                           annotations=annotations.items)
+                           annotations=cards.annotations, cards=cards)
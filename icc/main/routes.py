@@ -18,13 +18,19 @@ from collections import defaultdict
 from flask import (render_template, redirect, url_for, request, abort, g, flash,
                    current_app)
 from flask_login import current_user, logout_user, login_user, login_required
+from sqlalchemy.exc import IntegrityError
 
 from icc import db, classes
+from icc.cards import AnnotationCards
+from icc.enums import enums
 from icc.funky import line_check, generate_next
+from icc.pagination import keyset_paginate
 from icc.main import main
 
-from icc.models.annotation import Annotation, Edit, AnnotationFlag, Comment
-from icc.models.content import Text, Edition, Line, TOC, Writer
+from icc.models.annotation import (Annotation, AnnotationFlag, Comment,
+                                   AnnotationRange)
+from icc.models.content import (Text, Edition, Line, TOC, Writer,
+                                SectionCache)
 from icc.models.user import User
 
 from icc.forms import SearchForm
@@ -40,7 +46,7 @@ def before_request():
     if current_user.is_authenticated and current_user.locked:
         logout_user()
     g.search_form = SearchForm()
-    g.aflags = AnnotationFlag.enum_cls.query.all()
+    g.aflags = enums.all(AnnotationFlag.enum_cls)
 
 
 @main.route('/register', methods=['GET', 'POST'])
@@ -162,35 +168,41 @@ def index():
     """
     default = 'newest'
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     sort = request.args.get('sort', default, type=str)
 
     sorts = {
-        'newest': Annotation.query.order_by(Annotation.id.desc()),
-        'oldest': Annotation.query.order_by(Annotation.id.asc()),
-        'modified': (Annotation.query.join(Edit).order_by(Edit.timestamp.desc())
-                     .filter(Edit.current==True)),
-        'weight': Annotation.query.order_by(Annotation.weight.desc()),
-        'active': (Annotation.query.join(Comment).group_by(Annotation.id)
-                   .order_by(Comment.timestamp.desc()))
+        'newest': (Annotation.query, (Annotation.id.desc(),)),
+        'oldest': (Annotation.query, (Annotation.id.asc(),)),
+        'modified': (Annotation.query, (Annotation.modified_at.desc(),
+                                        Annotation.id.desc())),
+        'weight': (Annotation.query, (Annotation.weight.desc(),
+                                      Annotation.id.desc())),
+        'active': (Annotation.query.join(Comment).group_by(Annotation.id),
+                   (db.func.max(Comment.timestamp).desc(),
+                    Annotation.id.desc()))
     }
 
     sort = sort if sort in sorts else default
-    annotations = sorts[sort].filter(Annotation.active==True)\
-        .paginate(page, current_app.config['ANNOTATIONS_PER_PAGE'], False)
+    query, order = sorts[sort]
+    annotations = keyset_paginate(query.filter(Annotation.active==True), order,
+                                  current_app.config['ANNOTATIONS_PER_PAGE'],
+                                  cursor=cursor, page=page)
     if not annotations.items and page > 1:
         abort(404)
 
     sorturls = {key: url_for('main.index', sort=key) for key in
                 sorts.keys()}
-    next_page = (url_for('main.index', page=annotations.next_num, sort=sort) if
-                 annotations.has_next else None)
-    prev_page = (url_for('main.index', page=annotations.prev_num, sort=sort) if
-                 annotations.has_prev else None)
+    next_page = (url_for('main.index', cursor=annotations.next_cursor,
+                         sort=sort) if annotations.has_next else None)
+    prev_page = (url_for('main.index', cursor=annotations.prev_cursor,
+                         sort=sort) if annotations.has_prev else None)
+    cards = AnnotationCards([a.id for a in annotations.items], current_user)
     return render_template('indexes/annotation_list.html',
                            active_page='index',
                            sort=sort, sorts=sorturls,
                            next_page=next_page, prev_page=prev_page,
-                           annotations=annotations.items)
+                           annotations=cards.annotations, cards=cards)
 
 
 def string_to_tuple(string):
@@ -232,24 +244,22 @@ def line_annotations(text_url, edition_num, nums):
                                     Edition.num==edition_num).first_or_404())
 
     intnums = string_to_tuple(nums)
+    # if there is a single num, then we're going to duplicate it
+    intnums = intnums*2 if len(intnums) == 1 else intnums
+
+    annotations = AnnotationRange.annotations(edition, intnums[0],
+                                              intnums[-1], within=True)
 
     sorts = {
-        'newest': edition.annotations.order_by(Annotation.timestamp.desc()),
-        'oldest': edition.annotations.order_by(Annotation.timestamp.asc()),
-        'weight': edition.annotations.order_by(Annotation.weight.desc()),
-        'line': edition.annotations.order_by(Edit.last_line_num.asc()),
-        'modified': (edition.annotations.order_by(Edit.timestamp.desc())
-                     .filter(Edit.current==True))
+        'newest': annotations.order_by(Annotation.timestamp.desc()),
+        'oldest': annotations.order_by(Annotation.timestamp.asc()),
+        'weight': annotations.order_by(Annotation.weight.desc()),
+        'line': annotations.order_by(Annotation.last_line_num.asc()),
+        'modified': annotations.order_by(Annotation.modified_at.desc()),
     }
 
-    # if there is a single num, then we're going to duplicate it
-    intnums = intnums*2 if len(intnums) == 1 else intnums
-
     sort = sort if sort in sorts else default
     annotations = sorts[sort]\
-        .join(Edit).filter(Edit.current==True).group_by(Annotation.id)\
-        .filter(Annotation.active==True, Edit.first_line_num>=intnums[0],
-                Edit.last_line_num<=intnums[-1])\
         .paginate(page, current_app.config['ANNOTATIONS_PER_PAGE'], False)
 
     if not annotations.items and page > 1:
@@ -266,11 +276,12 @@ def line_annotations(text_url, edition_num, nums):
                          edition_num=edition.num, nums=nums, sort=sort,
                          page=annotations.prev_num) if annotations.has_prev else
                  None)
+    cards = AnnotationCards([a.id for a in annotations.items], current_user)
     return render_template('indexes/annotation_list.html',
                            title=f"{text.title} {nums} - Annotations",
                            next_page=next_page, prev_page=prev_page,
                            sorts=sorturls, sort=sort,
-                           annotations=annotations.items)
+                           annotations=cards.annotations, cards=cards)
 
 
 @main.route('/read/<text_url>/edition/<edition_num>/<toc_id>', methods=['GET', 'POST'])
@@ -278,42 +289,6 @@ def line_annotations(text_url, edition_num, nums):
             defaults={'edition_num': None})
 def read(text_url, edition_num, toc_id):
     """The main read route for viewing the text of any edition."""
-    def underscores_to_ems(lines):
-        """Convert all of the underscores to em tags and prepend and
-        append em tags based on line.emphasis values. This is to open and close
-        any emphasis tags that correspond to underscores that span multiple
-        lines. If we *don't* do this, we get all kinds of broken html. And
-        that's never fun.
-
-        This method is ten thousand times faster than an actual markdown
-        pre-processor. The only thing that would be faster is if I put the
-        actual emphasis tags into the database. I may still eventually do that.
-        The issue will be when I begin to use char-by-char annotation. That will
-        be a headache. I still don't know what the char-by-char highlighting
-        will return in javascript. Will it ignore emphasis tags, or include
-        them? This will have to be tested.
-        """
-        us = False
-        underscoredict = {True: '</em>', False: '<em>'}
-        emdict = {'oem': lambda line: f'{line}</em>',
-                  'cem': lambda line: f'<em>{line}',
-                  'em': lambda line: f'<em>{line}</em>',
-                  'nem': lambda line: line}
-        for i, line in enumerate(lines):
-            # I would like to find a method to eliminate this looping crap. I
-            # think it's possible, but I'm not at all sure.
-            linetext = line.body
-            if '_' in linetext:
-                newline = []
-                for c in linetext:
-                    if c == '_':
-                        newline.append(underscoredict[us])
-                        us = not us
-                    else:
-                        newline.append(c)
-                linetext = ''.join(newline)
-                lines[i].body = emdict[line.em](linetext)
-
     text = Text.get_by_url(text_url).first_or_404()
     edition = text.primary if not edition_num else \
         text.editions.filter_by(num=edition_num).first_or_404()
@@ -327,33 +302,68 @@ def read(text_url, edition_num, toc_id):
                                 edition_num=edition.num, first_line=first_line,
                                 last_line=last_line, next=request.full_path))
 
-    lines = toc.lines.all()
-    if not lines:
-        abort(404)
+    # The SectionCache stores the rendered text of the section. On a hit we
+    # don't have to load the lines at all; we only need the annotations to
+    # check the version and to render the annotations beneath the text. On a
+    # miss the lines' emphasis is already rendered in Line.html.
+    cache = SectionCache.get(toc, edition)
+    if cache:
+        lines = None
+        first_line_num, last_line_num = (cache.first_line_num,
+                                         cache.last_line_num)
+    else:
+        lines = toc.lines.all()
+        if not lines:
+            abort(404)
+        first_line_num, last_line_num = lines[0].num, lines[-1].num
 
-    annotations = edition.annotations\
-        .join(Edit)\
-        .filter(Edit.last_line_num<=lines[-1].num,
-                Edit.first_line_num>=lines[0].num,
-                Edit.current==True,
-                Annotation.active==True).all()
+    annotations = AnnotationRange.annotations(edition, first_line_num,
+                                              last_line_num, within=True)\
+        .join(Annotation.HEAD)\
+        .options(db.contains_eager(Annotation.HEAD)).all()
 
     # index the annotations in a dictionary by the line number.
     annotations_idx = defaultdict(list)
     if annotations:
         for a in annotations:
-            annotations_idx[a.HEAD.last_line_num].append(a)
+            annotations_idx[a.last_line_num].append(a)
+
+    version = SectionCache.version_of(annotations)
+    hit = bool(cache) and cache.version == version
+    SectionCache.record(hit)
+    if hit:
+        section_html = cache.body
+    else:
+        if lines is None:
+            lines = toc.lines.all()
+            if not lines:
+                abort(404)
+            first_line_num, last_line_num = lines[0].num, lines[-1].num
+        section_html = render_template('includes/_section.html', toc=toc,
+                                       edition=edition, lines=lines,
+                                       annotations_idx=annotations_idx)
+        SectionCache.store(toc, edition, version, lines, section_html)
 
-    # This is faster than the markdown plugin
-    underscores_to_ems(lines)
     next_page = toc.next.url if toc.next else None
     prev_page = toc.prev.url if toc.prev else None
 
-    return render_template('read.html', title=edition.title, form=form,
+    page = render_template('read.html', title=edition.title, form=form,
                            next_page=next_page, prev_page=prev_page,
                            section=toc.section,
-                           text=text, edition=edition, lines=lines,
-                           toc=toc, annotations_idx=annotations_idx)
+                           text=text, edition=edition, toc=toc,
+                           section_html=section_html,
+                           first_line_num=first_line_num,
+                           last_line_num=last_line_num,
+                           annotations_idx=annotations_idx)
+    # We commit the cache only after rendering because committing expires
+    # everything the template needs.
+    if not hit:
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Somebody else rendered the section at the same time.
+            db.session.rollback()
+    return page
 
 
 @main.route('/vote')
@@ -366,7 +376,9 @@ def vote():
         abort(404)
     if not issubclass(entity_cls, classes['VotableMixin']):
         abort(501)
-    entity = entity_cls.query.get_or_404(entity_id)
+    entity = entity_cls.get_for_vote(entity_id, current_user)
+    if not entity:
+        abort(404)
     redirect_url = generate_next(entity.url)
     if isinstance(entity, classes['Annotation']) and not entity.active:
         flash("You cannot vote on deactivated annotations.")
@@ -382,5 +394,10 @@ def vote():
         entity.upvote(current_user)
     else:
         entity.downvote(current_user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another request from the same user got their vote in first
+        db.session.rollback()
+        flash("Your vote conflicted with another one, please try again.")
     return redirect(redirect_url)
@@ -1,8 +1,11 @@
 """The main routes for examining tags."""
 from flask import render_template, url_for, request, abort, current_app
+from flask_login import current_user
 
 from icc import db
+from icc.cards import AnnotationCards
 from icc.main import main
+from icc.pagination import keyset_paginate
 
 from icc.models.annotation import Annotation,  Edit, Tag, Comment
 from icc.models.tables import tags as tags_table
@@ -57,35 +60,41 @@ def tag_annotations(tag):
     """See all annotations for a given tag."""
     default = 'newest'
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     sort = request.args.get('sort', default, type=str)
     tag = Tag.query.filter_by(tag=tag).first_or_404()
 
     sorts = {
-        'newest': tag.annotations.order_by(Annotation.id.desc()),
-        'oldest': tag.annotations.order_by(Annotation.id.asc()),
-        'weight': tag.annotations.order_by(Annotation.weight.desc()),
-        'modified': (tag.annotations.order_by(Edit.timestamp.desc())
-                     .filter(Edit.current==True)),
-        'active': (tag.annotations.join(Comment).group_by(Annotation.id)
-                   .order_by(Comment.timestamp.desc()))
+        'newest': (tag.annotations, (Annotation.id.desc(),)),
+        'oldest': (tag.annotations, (Annotation.id.asc(),)),
+        'weight': (tag.annotations, (Annotation.weight.desc(),
+                                     Annotation.id.desc())),
+        'modified': (tag.annotations, (Annotation.modified_at.desc(),
+                                       Annotation.id.desc())),
+        'active': (tag.annotations.join(Comment).group_by(Annotation.id),
+                   (db.func.max(Comment.timestamp).desc(),
+                    Annotation.id.desc()))
     }
 
     sort = sort if sort in sorts else default
-    annotations = sorts[sort].filter(Annotation.active==True)\
-        .paginate(page, current_app.config['ANNOTATIONS_PER_PAGE'], False)
+    query, order = sorts[sort]
+    annotations = keyset_paginate(query.filter(Annotation.active==True), order,
+                                  current_app.config['ANNOTATIONS_PER_PAGE'],
+                                  cursor=cursor, page=page)
     if not annotations.items and page > 1:
         abort(404)
 
     sorturls = {key: url_for('main.tag_annotations', tag=tag.tag, sort=key) for
                 key in sorts.keys()}
     next_page = (url_for('main.tag_annotations', tag=tag.tag, sort=sort,
-                         page=annotations.next_num) if annotations.has_next else
-                 None)
+                         cursor=annotations.next_cursor)
+                 if annotations.has_next else None)
     prev_page = (url_for('main.tag_annotations', tag=tag.tag, sort=sort,
-                         page=annotations.prev_num) if annotations.has_prev else
-                 None)
+                         cursor=annotations.prev_cursor)
+                 if annotations.has_prev else None)
+    cards = AnnotationCards([a.id for a in annotations.items], current_user)
     return render_template('indexes/annotation_list.html',
                            title=f"{tag.tag} - Annotations",
                            next_page=next_page, prev_page=prev_page,
                            sorts=sorturls, sort=sort,
-                           annotations=annotations.items)
+                           annotations=cards.annotations, cards=cards)
@@ -1,11 +1,14 @@
 """The main routes for texts."""
 
 from flask import render_template, url_for, request, abort, current_app
+from flask_login import current_user
 
 from icc import db
+from icc.cards import AnnotationCards
 from icc.main import main
+from icc.pagination import keyset_paginate
 
-from icc.models.annotation import Annotation,  Edit, Comment
+from icc.models.annotation import Annotation, Comment
 from icc.models.content import Text, Edition, WriterConnection, Line, WRITERS
 from icc.forms import SearchForm
 
@@ -71,41 +74,43 @@ def text_annotations(text_url):
     """The annotations for a given text."""
     default = 'newest'
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     sort = request.args.get('sort', default, type=str)
     text = Text.query.filter_by(title=text_url.replace('_', ' ')).first_or_404()
 
     sorts = {
-        'newest': text.annotations.order_by(Annotation.id.desc()),
-        'oldest': text.annotations.order_by(Annotation.id.asc()),
-        'weight': text.annotations.order_by(Annotation.weight.desc()),
-        'line': (text.annotations
-                 .join(Edit, Edit.entity_id==Annotation.id)
-                 .filter(Edit.current==True)
-                 .order_by(Edit.last_line_num.asc())),
-        'modified': (text.annotations
-                     .join(Edit, Edit.entity_id==Annotation.id)
-                     .filter(Edit.current==True)
-                     .order_by(Edit.timestamp.desc())),
-        'active': (text.annotations.join(Comment).group_by(Annotation.id)
-                   .order_by(Comment.timestamp.desc()))
+        'newest': (text.annotations, (Annotation.id.desc(),)),
+        'oldest': (text.annotations, (Annotation.id.asc(),)),
+        'weight': (text.annotations, (Annotation.weight.desc(),
+                                      Annotation.id.desc())),
+        'line': (text.annotations, (Annotation.last_line_num.asc(),
+                                    Annotation.id.asc())),
+        'modified': (text.annotations, (Annotation.modified_at.desc(),
+                                        Annotation.id.desc())),
+        'active': (text.annotations.join(Comment).group_by(Annotation.id),
+                   (db.func.max(Comment.timestamp).desc(),
+                    Annotation.id.desc()))
     }
 
     sort = sort if sort in sorts else default
-    annotations = sorts[sort].filter(Annotation.active==True)\
-        .paginate(page, current_app.config['ANNOTATIONS_PER_PAGE'], False)
+    query, order = sorts[sort]
+    annotations = keyset_paginate(query.filter(Annotation.active==True), order,
+                                  current_app.config['ANNOTATIONS_PER_PAGE'],
+                                  cursor=cursor, page=page)
     if not annotations.items and page > 1:
         abort(404)
 
     sorturls = {key: url_for('main.text_annotations', text_url=text_url,
                              sort=key) for key in sorts.keys()}
     next_page = (url_for('main.text_annotations', text_url=text_url, sort=sort,
-                         page=annotations.next_num) if annotations.has_next else
-                 None)
+                         cursor=annotations.next_cursor)
+                 if annotations.has_next else None)
     prev_page = (url_for('main.text_annotations', text_url=text_url, sort=sort,
-                         page=annotations.prev_num) if annotations.has_prev else
-                 None)
+                         cursor=annotations.prev_cursor)
+                 if annotations.has_prev else None)
+    cards = AnnotationCards([a.id for a in annotations.items], current_user)
     return render_template('indexes/annotation_list.html',
                            title=f"{text.title} - Annotations",
                            next_page=next_page, prev_page=prev_page,
                            sorts=sorturls, sort=sort,
-                           annotations=annotations.items)
+                           annotations=cards.annotations, cards=cards)
@@ -1,12 +1,15 @@
 """The main routes for writers."""
 
 from flask import render_template, url_for, request, abort, current_app
+from flask_login import current_user
 
 from icc import db
+from icc.cards import AnnotationCards
 from icc.forms import SearchForm
 from icc.main import main
+from icc.pagination import keyset_paginate
 
-from icc.models.annotation import Annotation, Edit, Comment
+from icc.models.annotation import Annotation, Comment
 from icc.models.content import Edition, Writer, WriterConnection, WRITERS
 
 
@@ -68,37 +71,42 @@ def writer_annotations(writer_url):
     """See all annotations by writer."""
     default = 'newest'
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     sort = request.args.get('sort', default, type=str)
     writer = Writer.query\
         .filter_by(name=writer_url.replace('_', ' ')).first_or_404()
 
     sorts = {
-        'newest': writer.annotations.order_by(Annotation.id.desc()),
-        'oldest': writer.annotations.order_by(Annotation.id.asc()),
-        'weight': writer.annotations.order_by(Annotation.weight.desc()),
-        'modified': (writer.annotations
-                     .join(Edit, Edit.entity_id==Annotation.id)
-                     .order_by(Edit.timestamp.desc())),
-        'active': (writer.annotations.join(Comment).group_by(Annotation.id)
-                   .order_by(Comment.timestamp.desc()))
+        'newest': (writer.annotations, (Annotation.id.desc(),)),
+        'oldest': (writer.annotations, (Annotation.id.asc(),)),
+        'weight': (writer.annotations, (Annotation.weight.desc(),
+                                        Annotation.id.desc())),
+        'modified': (writer.annotations, (Annotation.modified_at.desc(),
+                                          Annotation.id.desc())),
+        'active': (writer.annotations.join(Comment).group_by(Annotation.id),
+                   (db.func.max(Comment.timestamp).desc(),
+                    Annotation.id.desc()))
     }
 
     sort = sort if sort in sorts else default
-    annotations = sorts[sort].filter(Annotation.active==True)\
-        .paginate(page, current_app.config['ANNOTATIONS_PER_PAGE'], False)
+    query, order = sorts[sort]
+    annotations = keyset_paginate(query.filter(Annotation.active==True), order,
+                                  current_app.config['ANNOTATIONS_PER_PAGE'],
+                                  cursor=cursor, page=page)
     if not annotations.items and page > 1:
         abort(404)
 
     sorturls = {key: url_for('main.writer_annotations', writer_url=writer_url,
                              sort=key) for key in sorts.keys()}
     next_page = (url_for('main.writer_annotations', writer_url=writer_url,
-                         sort=sort, page=annotations.next_num) if
+                         sort=sort, cursor=annotations.next_cursor) if
                  annotations.has_next else None)
     prev_page = (url_for('main.writer_annotations', writer_url=writer_url,
-                         sort=sort, page=annotations.prev_num) if
+                         sort=sort, cursor=annotations.prev_cursor) if
                  annotations.has_prev else None)
+    cards = AnnotationCards([a.id for a in annotations.items], current_user)
     return render_template('indexes/annotation_list.html',
                            title=f"{writer.name} - Annotations",
                            next_page=next_page, prev_page=prev_page,
                            sorts=sorturls, sort=sort,
-                           annotations=annotations.items)
+                           annotations=cards.annotations, cards=cards)
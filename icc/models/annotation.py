@@ -9,7 +9,6 @@ from datetime import datetime
 from hashlib import sha1
 from math import log10
 
-from sqlalchemy import orm
 from sqlalchemy.orm import backref
 from flask import url_for, flash, current_app
 
@@ -114,9 +113,8 @@ class Tag(Base, FollowableMixin, LinkableMixin):
 
     wiki = db.relationship('Wiki', backref=backref('tag', uselist=False))
     annotations = db.relationship(
-        'Annotation', secondary='join(tags, Edit, and_(tags.c.edit_id==Edit.id,'
-        'Edit.current==True))', primaryjoin='Tag.id==tags.c.tag_id',
-        secondaryjoin='and_(Edit.entity_id==Annotation.id,'
+        'Annotation', secondary='tags', primaryjoin='Tag.id==tags.c.tag_id',
+        secondaryjoin='and_(tags.c.edit_id==Annotation.head_id,'
         'Annotation.active==True)', lazy='dynamic')
 
     @property
@@ -130,7 +128,8 @@ class Tag(Base, FollowableMixin, LinkableMixin):
         description = ("This tag has no description yet." if not description
                        else description)
         super().__init__(*args, **kwargs)
-        self.wiki = Wiki(body=description, entity_string=str(self))
+        self.wiki = Wiki(body=description, entity_string=str(self),
+                         entity=self)
 
     def __repr__(self):
         return f'<Tag {self.id}: {self.tag}>'
@@ -154,6 +153,10 @@ class CommentVote(Base, VoteMixin):
     entity_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True)
     entity = db.relationship('Comment')
 
+    __table_args__ = (
+        db.UniqueConstraint('voter_id', 'entity_id', name='uq_commentvote_voter'),
+    )
+
     def __repr__(self):
         prefix = super().__repr__()
         return f"{prefix}{self.entity}"
@@ -236,6 +239,10 @@ class AnnotationVote(Base, VoteMixin):
 
     entity = db.relationship('Annotation')
 
+    __table_args__ = (
+        db.UniqueConstraint('voter_id', 'annotation_id', name='uq_annotationvote_voter'),
+    )
+
     def __repr__(self):
         prefix = super().__repr__()
         return f"{prefix}{self.entity}"
@@ -278,6 +285,16 @@ class Annotation(Base, FollowableMixin, LinkableMixin, VotableMixin):
     active : bool
         The flag that indicates the annotation has been deactivated from
         viewing.
+    head_id : int
+        The id of the current :class:`Edit` (i.e., HEAD).
+    first_line_num : int
+        The first line num of HEAD, copied here so that the listings can sort
+        by line without joining the edits.
+    last_line_num : int
+        The last line num of HEAD.
+    modified_at : datetime
+        The UTC date time of HEAD's edit (i.e., when the current version was
+        written, not when it was approved), like the migration backfilled.
     ballots : BaseQuery
         An SQLA BaseQuery of all of the ballots that have been cast for this
         annotation.
@@ -292,7 +309,10 @@ class Annotation(Base, FollowableMixin, LinkableMixin, VotableMixin):
         The text object the edition belongs to upon which the annotation is
         annotated.
     HEAD : :class:`Edit`
-        The edit object that is the current version of the annotation object. I
+        The edit object that is the current version of the annotation object.
+        It has to be changed with :meth:`set_head` so that the columns copied
+        from it stay in sync (`inserts/checkheads.py` will tell you if they
+        don't). I
         want to eventually change this to current, and it seems like it would
         not be hard. But I am hesitant to do it because then it would not be
         unique, and it would no longer be easy to change. All it requires to
@@ -351,6 +371,17 @@ class Annotation(Base, FollowableMixin, LinkableMixin, VotableMixin):
     locked = db.Column(db.Boolean, index=True, default=False)
     active = db.Column(db.Boolean, default=True)
 
+    # denormalized from HEAD by set_head()
+    head_id = db.Column(db.Integer, db.ForeignKey('edit.id', use_alter=True,
+                                                  name='fk_annotation_head_id'))
+    first_line_num = db.Column(db.Integer)
+    last_line_num = db.Column(db.Integer)
+    modified_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_annotation_edition_line', 'edition_id', 'last_line_num'),
+    )
+
     ballots = db.relationship('AnnotationVote', lazy='dynamic')
     annotator = db.relationship('User')
 
@@ -364,8 +395,7 @@ class Annotation(Base, FollowableMixin, LinkableMixin, VotableMixin):
                            uselist=False)
 
     # relationships to `Edit`
-    HEAD = db.relationship('Edit', primaryjoin='and_(Edit.current==True,'
-                           'Edit.entity_id==Annotation.id)', uselist=False)
+    HEAD = db.relationship('Edit', foreign_keys=[head_id], post_update=True)
 
     # history is used for annotation edit history
     history = db.relationship(
@@ -384,13 +414,13 @@ class Annotation(Base, FollowableMixin, LinkableMixin, VotableMixin):
     # relationships to `Line`
     lines = db.relationship(
         'Line', secondary='edit',
-        primaryjoin='and_(Annotation.id==Edit.entity_id,Edit.current==True)',
+        primaryjoin='Annotation.head_id==Edit.id',
         secondaryjoin='and_(Line.num>=Edit.first_line_num,'
         'Line.num<=Edit.last_line_num,Line.edition_id==Annotation.edition_id)',
         viewonly=True, uselist=True)
     context = db.relationship(
         'Line', secondary='edit',
-        primaryjoin='and_(Annotation.id==Edit.entity_id,Edit.current==True)',
+        primaryjoin='Annotation.head_id==Edit.id',
         secondaryjoin=f'and_(Line.num>=Edit.first_line_num-{CONTEXT},'
         f'Line.num<=Edit.last_line_num+{CONTEXT},'
         'Line.edition_id==Annotation.edition_id)', viewonly=True, uselist=True)
@@ -430,7 +460,7 @@ class Annotation(Base, FollowableMixin, LinkableMixin, VotableMixin):
             first_char_idx=fc, last_char_idx=lc, body=body, tags=tags, num=0,
             reason="initial version")
         db.session.add(current)
-        self.HEAD = current
+        self.set_head(current)
 
     def edit(self, *ignore, editor, reason, fl, ll, fc, lc, body, tags):
         """This method creates an edit for the annotation. It is much more
@@ -458,14 +488,31 @@ class Annotation(Base, FollowableMixin, LinkableMixin, VotableMixin):
         elif editor == self.annotator or\
                 editor.is_authorized('immediate_edits'):
             edit.approved = True
-            self.HEAD.current = False
-            edit.current = True
+            self.set_head(edit)
             flash("Edit approved.")
         else:
             flash("Edit submitted for review.")
         db.session.add(edit)
         return True
 
+    def set_head(self, edit):
+        """Make the edit the current version of the annotation. This is the
+        only place HEAD should be changed, because it also copies the edit's
+        lines onto the annotation and moves the annotation in the
+        :class:`AnnotationRange` index.
+        """
+        if self.HEAD and self.HEAD is not edit:
+            self.HEAD.current = False
+        edit.current = True
+        self.HEAD = edit
+        self.first_line_num = edit.first_line_num
+        self.last_line_num = edit.last_line_num
+        if edit.timestamp is None:
+            # it hasn't been flushed yet
+            edit.timestamp = datetime.utcnow()
+        self.modified_at = edit.timestamp
+        AnnotationRange.index(edit)
+
     def up_power(self, voter):
         """An int that represents the user's current upvote power.
 
@@ -512,6 +559,10 @@ class EditVote(Base, VoteMixin):
     edit_id = db.Column(db.Integer, db.ForeignKey('edit.id'), index=True)
     entity = db.relationship('Edit', backref=backref('ballots', lazy='dynamic'))
 
+    __table_args__ = (
+        db.UniqueConstraint('voter_id', 'edit_id', name='uq_editvote_voter'),
+    )
+
     def __repr__(self):
         prefix = super().__repr__()
         return f"{prefix}{self.edit}"
@@ -589,14 +640,14 @@ class Edit(Base, EditMixin, VotableMixin):
     toc = db.relationship('TOC')
     entity_id = db.Column(db.Integer, db.ForeignKey('annotation.id'),
                           index=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow())
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
     first_line_num = db.Column(db.Integer, db.ForeignKey('line.num'))
     last_line_num = db.Column(db.Integer, db.ForeignKey('line.num'), index=True)
     first_char_idx = db.Column(db.Integer)
     last_char_idx = db.Column(db.Integer)
 
-    annotation = db.relationship('Annotation')
+    annotation = db.relationship('Annotation', foreign_keys=[entity_id])
     tags = db.relationship('Tag', secondary='tags')
     lines = db.relationship(
         'Line', primaryjoin='and_(Line.num>=Edit.first_line_num,'
@@ -614,32 +665,28 @@ class Edit(Base, EditMixin, VotableMixin):
     def first_line(self):
         return self.lines[0]
 
-    @orm.reconstructor
-    def __init_on_load__(self):
-        """Create the hash_id that recognizes when an edit differs from it's
-        previous version to prevent dupe edits.
+    @property
+    def hash_id(self):
+        """The hash that recognizes when an edit differs from it's previous
+        version to prevent dupe edits. This used to be computed in a
+        reconstructor, but that meant a query for the tags of every single edit
+        we ever loaded, even if we never compared them.
         """
         s = (f'{self.first_line_num},{self.last_line_num},'
              f'{self.first_char_idx},{self.last_char_idx},'
              f'{self.body},{self.tags}')
-        self.hash_id = sha1(s.encode('utf8')).hexdigest()
+        return sha1(s.encode('utf8')).hexdigest()
 
     def __init__(self, *args, **kwargs):
         """This init checks to see if the first line and last line aren't
         reversed, because that can be a problem. I should probably make it do
         the same for the characters.
-
-        It also generates the hash_id to check against the previous edit.
         """
         super().__init__(*args, **kwargs)
         if self.first_line_num > self.last_line_num:
             tmp = self.last_line_num
             self.last_line_num = self.first_line_num
             self.first_line_num = tmp
-        s = (f'{self.first_line_num},{self.last_line_num},'
-             f'{self.first_char_idx},{self.last_char_idx},'
-             f'{self.body},{self.tags}')
-        self.hash_id = sha1(s.encode('utf8')).hexdigest()
 
     def __repr__(self):
         prefix = super().__repr__()
@@ -669,6 +716,129 @@ class Edit(Base, EditMixin, VotableMixin):
             return url_for('admin.review_edit',
                            annotation_id=self.annotation.id, edit_id=self.id)
 
+    def approve(self):
+        """Approve the edit and make it the annotation's HEAD."""
+        super().approve()
+        self.annotation.set_head(self)
+
+
+class AnnotationRange(Base):
+    """An interval index of the line ranges of the current edits of the
+    annotations.
+
+    Finding the annotations on a range of lines with `Edit.first_line_num <= n
+    <= Edit.last_line_num` can't use an index for more than one of the two
+    bounds, so it scans every current edit of the edition before the range. It
+    gets slower with every annotation.
+
+    Instead, the lines of each edition are cut into buckets of `BUCKET` lines
+    and every annotation has one row for each bucket its current edit touches.
+    A lookup then only has to read the rows of the buckets the range touches,
+    which is a range scan on the (edition_id, bucket, first_line_num) index.
+    That's logarithmic in the number of annotations in the edition (plus the
+    annotations in those buckets, which we were going to load anyway).
+    Annotations are rarely longer than a few lines, so almost every annotation
+    has only one row.
+
+    The index is maintained by :meth:`index` whenever an edit becomes current,
+    i.e., in :meth:`Annotation.set_head`.
+
+    Attributes
+    ----------
+    BUCKET : int
+        The number of lines in a bucket.
+    annotation_id : int
+        The id of the annotation.
+    edition_id : int
+        The id of the edition the annotation is on.
+    bucket : int
+        The number of the bucket, i.e., the line num // BUCKET.
+    first_line_num : int
+        The first line num of the annotation's current edit (*not* clipped to
+        the bucket).
+    last_line_num : int
+        The last line num of the annotation's current edit.
+    """
+    BUCKET = 64
+
+    annotation_id = db.Column(db.Integer, db.ForeignKey('annotation.id'),
+                              index=True)
+    annotation = db.relationship(
+        'Annotation', backref=backref('ranges', cascade='all, delete-orphan'))
+    edition_id = db.Column(db.Integer, db.ForeignKey('edition.id'))
+    edition = db.relationship('Edition')
+    bucket = db.Column(db.Integer)
+    first_line_num = db.Column(db.Integer)
+    last_line_num = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_annotationrange_lookup', 'edition_id', 'bucket',
+                 'first_line_num'),
+    )
+
+    def __repr__(self):
+        return (f'<AnnotationRange {self.annotation} '
+                f'{self.first_line_num}-{self.last_line_num} '
+                f'in bucket {self.bucket}>')
+
+    @classmethod
+    def buckets(cls, first_line_num, last_line_num):
+        """The range of the buckets that the lines touch."""
+        return range(first_line_num // cls.BUCKET,
+                     last_line_num // cls.BUCKET + 1)
+
+    @classmethod
+    def index(cls, edit):
+        """Replace the rows of the edit's annotation with the rows for the
+        edit's lines. The edit has to be the annotation's current edit.
+        """
+        edit.annotation.ranges = [
+            cls(edition=edit.edition, bucket=bucket,
+                first_line_num=edit.first_line_num,
+                last_line_num=edit.last_line_num)
+            for bucket in cls.buckets(edit.first_line_num, edit.last_line_num)]
+
+    @classmethod
+    def annotations(cls, edition, first_line_num, last_line_num, within=False):
+        """Get all of the active annotations on the edition that overlap the
+        line range.
+
+        Parameters
+        ----------
+        edition : :class:`Edition`
+            The edition, or it's id.
+        first_line_num : int
+            The first line of the range.
+        last_line_num : int
+            The last line of the range.
+        within : bool
+            Only get the annotations that are entirely within the range instead
+            of all of the annotations that overlap the range.
+
+        Returns
+        -------
+        BaseQuery
+            A query of the annotations. Every annotation appears exactly once,
+            so it can be ordered and paginated like any other annotation query.
+        """
+        edition_id = getattr(edition, 'id', edition)
+        buckets = cls.buckets(first_line_num, last_line_num)
+        # An annotation spanning several buckets has a row in each of them, so
+        # we only take the row in the annotation's first bucket, or, if that is
+        # before the range, the row in the range's first bucket.
+        query = Annotation.query.join(cls)\
+            .filter(cls.edition_id==edition_id,
+                    cls.bucket>=buckets.start, cls.bucket<buckets.stop,
+                    cls.first_line_num<=last_line_num,
+                    cls.last_line_num>=first_line_num,
+                    db.or_(cls.bucket==buckets.start,
+                           cls.first_line_num>=cls.bucket*cls.BUCKET),
+                    Annotation.active==True)
+        if within:
+            query = query.filter(cls.first_line_num>=first_line_num,
+                                 cls.last_line_num<=last_line_num)
+        return query
+
 
 classes = dict(inspect.getmembers(sys.modules[__name__], inspect.isclass))
 classes['AnnotationFlagEnum'] = AnnotationFlag.enum_cls
@@ -10,6 +10,7 @@ import sys
 
 from collections import defaultdict
 from datetime import datetime
+from hashlib import sha1
 
 from flask import url_for
 
@@ -22,6 +23,7 @@ from icc import db
 from icc.models.mixins import (Base, EnumeratedMixin, SearchableMixin,
                                FollowableMixin, LinkableMixin, SearchLinesMixin)
 from icc.models.wiki import Wiki
+from icc.models.annotation import AnnotationRange
 
 
 # These 2 sets of tuples/dictionaries are for enumerated types that don't need
@@ -29,10 +31,44 @@ from icc.models.wiki import Wiki
 # resources, etc)
 EMPHASIS = ('nem', 'oem', 'em', 'cem')
 
+# The wrappers for the emphasis status of a line. See On Emphasis in the wiki.
+EMPHASIS_WRAPPERS = {
+    'nem': lambda line: line,
+    'oem': lambda line: f'{line}</em>',
+    'em': lambda line: f'<em>{line}</em>',
+    'cem': lambda line: f'<em>{line}',
+}
+
 WRITERS = ('author', 'editor', 'translator')
 WRITERS_REVERSE = {val: idx for idx, val in enumerate(WRITERS)}
 
 
+def underscores_to_ems(body, em):
+    """Convert all of the underscores in a line's body to em tags and prepend
+    and append em tags based on the line's emphasis status. This is to open and
+    close any emphasis tags that correspond to underscores that span multiple
+    lines. If we *don't* do this, we get all kinds of broken html.
+
+    This used to be done in the read route, carrying the underscore state from
+    line to line, on every request. But the emphasis status of the line already
+    tells us whether the line starts inside of an emphasis, so each line can be
+    rendered on its own, once, when it is created or edited.
+    """
+    if body is None:
+        return None
+    if '_' in body:
+        # A line that closes or continues an emphasis starts inside of it.
+        us = em in ('em', 'cem')
+        segments = body.split('_')
+        newline = [segments[0]]
+        for segment in segments[1:]:
+            newline.append('</em>' if us else '<em>')
+            newline.append(segment)
+            us = not us
+        body = ''.join(newline)
+    return EMPHASIS_WRAPPERS[em](body)
+
+
 class Text(Base, FollowableMixin, LinkableMixin, SearchLinesMixin):
     __linkable__ = 'title'
     """The text-object. A text is more a categorical, or philosophical concept.
@@ -168,7 +204,8 @@ class Text(Base, FollowableMixin, LinkableMixin, SearchLinesMixin):
         description = kwargs.pop('description', None)
         description = "This wiki is blank." if not description else description
         super().__init__(*args, **kwargs)
-        self.wiki = Wiki(body=description, entity_string=str(self))
+        self.wiki = Wiki(body=description, entity_string=str(self),
+                         entity=self)
 
     def __repr__(self):
         return f'<Text {self.id}: {self.title}>'
@@ -261,18 +298,39 @@ class Edition(Base, FollowableMixin, SearchLinesMixin):
         description = kwargs.pop('description', None)
         description = 'This wiki is blank.' if not description else description
         super().__init__(*args, **kwargs)
-        self.wiki = Wiki(body=description, entity_string=str(self))
+        self.wiki = Wiki(body=description, entity_string=str(self),
+                         entity=self)
 
-    @orm.reconstructor
-    def __init_on_load__(self):
-        """Creates a defaultdict of lists of writers based on their connection
-        type (e.g., author, editor, translator, etc.)
+    @classmethod
+    def load_writers(cls, editions=None):
+        """Build the writers of the editions in one query. By default, that is
+        every edition in the session that doesn't have them yet, so that a
+        listing only ever costs one query for the writers.
+
+        This used to be done in a reconstructor, which meant a query every time
+        an edition was loaded, whether we were going to show it's writers or
+        not.
         """
-        self._create_writers()
+        if editions is None:
+            editions = [obj for obj in db.session.identity_map.values() if
+                        isinstance(obj, cls)]
+        editions = [edition for edition in editions if edition.id is not None
+                    and '_writers' not in edition.__dict__]
+        if not editions:
+            return
+        writers = {edition.id: defaultdict(list) for edition in editions}
+        connections = WriterConnection.query\
+            .filter(WriterConnection.edition_id.in_(writers.keys()))\
+            .options(orm.joinedload(WriterConnection.writer))\
+            .order_by(WriterConnection.id)
+        for conn in connections:
+            writers[conn.edition_id][conn.enum].append(conn.writer)
+        for edition in editions:
+            edition._writers = writers[edition.id]
 
     def _create_writers(self):
-        """This creates the _writers attr. It's abstracted for use by writers()
-        and __init_on_load__().
+        """This creates the _writers attr for a single edition (i.e., one that
+        hasn't been flushed yet, so load_writers can't find it).
         """
         self._writers = defaultdict(list)
         for conn in self.connections.all():
@@ -280,12 +338,13 @@ class Edition(Base, FollowableMixin, SearchLinesMixin):
 
     @property
     def writers(self):
-        """This by using a property to access the writerslist I ensure that it
-        will always exist before it is accessed. This prevents the error I get
-        when first creating this thing where I try to access writers and it
-        doesn't exist when indexing on a first run through.
+        """A defaultdict of lists of writers based on their connection type
+        (e.g., author, editor, translator, etc.). They're loaded the first time
+        they're accessed, for every edition in the session at once.
         """
-        if not hasattr(self, '_writers'):
+        if '_writers' not in self.__dict__:
+            Edition.load_writers()
+        if '_writers' not in self.__dict__:
             self._create_writers()
         return self._writers
 
@@ -372,14 +431,42 @@ class Writer(Base, FollowableMixin, LinkableMixin, SearchLinesMixin):
         description = 'This writer does not have a biography yet.'\
             if not description else description
         super().__init__(*args, **kwargs)
-        self.wiki = Wiki(body=description, entity_string=str(self))
+        self.wiki = Wiki(body=description, entity_string=str(self),
+                         entity=self)
 
-    @orm.reconstructor
-    def __init_on_load__(self):
-        """Creates a dictionary mapping the writer's role to the editions."""
-        self.works = defaultdict(list)
-        for conn in self.connections.all():
-            self.works[conn.enum].append(conn.edition)
+    @classmethod
+    def load_works(cls, writers=None):
+        """Build the works of the writers (by default, every writer in the
+        session that doesn't have them yet) in one query, just like
+        :meth:`Edition.load_writers`.
+        """
+        if writers is None:
+            writers = [obj for obj in db.session.identity_map.values() if
+                       isinstance(obj, cls)]
+        writers = [writer for writer in writers if writer.id is not None and
+                   '_works' not in writer.__dict__]
+        if not writers:
+            return
+        works = {writer.id: defaultdict(list) for writer in writers}
+        connections = WriterConnection.query\
+            .filter(WriterConnection.writer_id.in_(works.keys()))\
+            .options(orm.joinedload(WriterConnection.edition))\
+            .order_by(WriterConnection.id)
+        for conn in connections:
+            works[conn.writer_id][conn.enum].append(conn.edition)
+        for writer in writers:
+            writer._works = works[writer.id]
+
+    @property
+    def works(self):
+        """A dictionary mapping the writer's role to the editions."""
+        if '_works' not in self.__dict__:
+            Writer.load_works()
+        if '_works' not in self.__dict__:
+            self._works = defaultdict(list)
+            for conn in self.connections.all():
+                self._works[conn.enum].append(conn.edition)
+        return self._works
 
     def __repr__(self):
         return f'<Writer: {self.name}>'
@@ -499,6 +586,111 @@ class TOC(EnumeratedMixin, Base):
         return self.body
 
 
+class SectionCache(Base):
+    """A persistent cache of the rendered text of a section (i.e., a TOC with
+    lines) for the read view. Processing the emphasis and rendering every line
+    of a long chapter of War and Peace on every hit is what makes the read
+    route slow, and the result only changes when a line is edited or the set
+    of annotations on the section changes.
+
+    The cache is keyed by the edition, the toc, and the version of the
+    annotation set. Each toc only ever has one row. When the version of the
+    annotations on the section changes the row is re-rendered and overwritten
+    in place.
+
+    Attributes
+    ----------
+    toc_id : int
+        The id of the section that has been rendered.
+    edition_id : int
+        The id of the edition the section belongs to.
+    version : str
+        A sha1 hash of the annotations (and their current edits) that were
+        present on the section when it was rendered.
+    first_line_num : int
+        The num of the first line of the section. Cached so that we don't have
+        to load the lines to find the annotations on a hit.
+    last_line_num : int
+        The num of the last line of the section.
+    body : str
+        The rendered html of the section.
+    timestamp : DateTime
+        When the section was last rendered.
+    hits : int
+        A class-level count of the cache hits in this process.
+    misses : int
+        A class-level count of the cache misses in this process.
+    """
+    hits = 0
+    misses = 0
+
+    toc_id = db.Column(db.Integer, db.ForeignKey('toc.id'), index=True,
+                       unique=True)
+    edition_id = db.Column(db.Integer, db.ForeignKey('edition.id'),
+                           index=True)
+    version = db.Column(db.String(40))
+    first_line_num = db.Column(db.Integer)
+    last_line_num = db.Column(db.Integer)
+    body = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow,
+                          onupdate=datetime.utcnow)
+
+    toc = db.relationship('TOC')
+    edition = db.relationship('Edition')
+
+    @staticmethod
+    def version_of(annotations):
+        """Compute the version hash of a list of annotations from their ids
+        and their HEAD's ids.
+        """
+        s = ','.join(sorted(f'{a.id}:{a.head_id}' for a in annotations))
+        return sha1(s.encode('utf8')).hexdigest()
+
+    @classmethod
+    def get(cls, toc, edition):
+        """Get the cache row for the section, if there is one."""
+        return cls.query.filter_by(toc_id=toc.id, edition_id=edition.id).first()
+
+    @classmethod
+    def store(cls, toc, edition, version, lines, body):
+        """Store the rendered body for the section, overwriting the old row if
+        there is one. Returns the row.
+        """
+        cache = cls.get(toc, edition)
+        if not cache:
+            cache = cls(toc=toc, edition=edition)
+            db.session.add(cache)
+        cache.version = version
+        cache.first_line_num = lines[0].num
+        cache.last_line_num = lines[-1].num
+        cache.body = body
+        return cache
+
+    @classmethod
+    def invalidate(cls, toc_id):
+        """Drop the cache for a section (e.g., because one of its lines was
+        edited).
+        """
+        cls.query.filter_by(toc_id=toc_id).delete()
+
+    @classmethod
+    def record(cls, hit):
+        """Record a hit or miss."""
+        if hit:
+            cls.hits += 1
+        else:
+            cls.misses += 1
+
+    @classmethod
+    def stats(cls):
+        """Report the hit and miss counts for this process."""
+        return {'hits': cls.hits, 'misses': cls.misses,
+                'sections': cls.query.count()}
+
+    def __repr__(self):
+        return f'<SectionCache {self.toc_id} at {self.version}>'
+
+
 class Line(EnumeratedMixin, SearchableMixin, Base):
     """A line. This is actually a very important class. It is the only
     searchable type so far. Eventually this won't be the case. Then I'll have to
@@ -511,6 +703,12 @@ class Line(EnumeratedMixin, SearchableMixin, Base):
         A list of strings that correspond to the attributes that should be
         indexed in elasticsearch. It's defined by :class:`SearchableMixin` so
         see that for more information.
+    __stored__ : list
+        The attributes that are stored in the index to show the line in the
+        search results with (see :class:`SearchableMixin`).
+    __context__ : tuple
+        The lines around a hit in the search results are the ones in the same
+        edition with the nearest nums.
     num : int
         The line number within the edition.
     em : str
@@ -520,6 +718,10 @@ class Line(EnumeratedMixin, SearchableMixin, Base):
         The section the line is in in the TOC. See On the TOC in the Wiki.
     body : str
         The actual text of the line. Processed in my processor.
+    html : str
+        The body of the line with the emphasis resolved into html (see
+        :func:`underscores_to_ems`). It is rendered when the line is created or
+        edited so that the read route doesn't have to do any string processing.
     text : Text
         An association proxy to the text for ease of reference.
     text_title : str
@@ -530,12 +732,16 @@ class Line(EnumeratedMixin, SearchableMixin, Base):
         A list of all line's surrounding lines (+/- 5 lines)
     annotations : BaseQuery
         An SQLA BaseQuery for all the annotations that contain this line in
-        their target. It's a nasty relationship.
+        their target. It's looked up in the :class:`AnnotationRange` index.
     """
     __searchable__ = ['body', 'text_id', 'edition_id', 'writer_id']
+    __stored__ = ['num', 'toc_id', 'html', 'em', 'edition_num', 'verse',
+                  'text_title', 'text_url_name', 'authors']
+    __context__ = ('edition_id', 'num')
 
     num = db.Column(db.Integer, index=True)
     body = db.Column(db.Text)
+    html = db.Column(db.Text)
     em_id = db.Column(db.Integer)
 
     toc_id = db.Column(db.Integer, db.ForeignKey('toc.id'), index=True)
@@ -554,14 +760,11 @@ class Line(EnumeratedMixin, SearchableMixin, Base):
         'remote(Line.edition_id)==Line.edition_id)',
         foreign_keys=[num, edition_id], remote_side=[num, edition_id],
         uselist=True, viewonly=True)
-    annotations = db.relationship(
-        'Annotation', secondary='edit',
-        primaryjoin='and_(Edit.first_line_num<=foreign(Line.num),'
-        'Edit.last_line_num>=foreign(Line.num),'
-        'Edit.edition_id==foreign(Line.edition_id),Edit.current==True)',
-        secondaryjoin='and_(foreign(Edit.entity_id)==Annotation.id,'
-        'Annotation.active==True)', foreign_keys=[num, edition_id],
-        uselist=True, lazy='dynamic')
+
+    @property
+    def annotations(self):
+        return AnnotationRange.annotations(self.edition_id, self.num,
+                                           self.num)
 
     @property
     def writers(self):
@@ -575,6 +778,79 @@ class Line(EnumeratedMixin, SearchableMixin, Base):
                 out.append(writer.id)
         return out
 
+    @property
+    def edition_num(self):
+        return self.edition.num
+
+    @property
+    def verse(self):
+        return self.edition.verse
+
+    @property
+    def text_title(self):
+        return self.edition.text_title
+
+    @property
+    def text_url_name(self):
+        return self.text.url_name
+
+    @property
+    def authors(self):
+        """The names of the authors (for the search results)."""
+        return [writer.name for writer in self.writers['author']]
+
+    @classmethod
+    def search_documents(cls, query, batch_size=1000):
+        """The search documents of the lines of the query, streamed as plain
+        rows instead of Lines. Everything in a line's document but the line's
+        own columns is the same for every line in the edition, so it's looked
+        up once per edition (before the rows start streaming, because a
+        streaming cursor can't share it's connection) instead of walking
+        `edition.writers` per line.
+        """
+        edition_ids = [edition_id for edition_id, in
+                       query.with_entities(cls.edition_id).distinct()]
+        editions = Edition.query.filter(Edition.id.in_(edition_ids))\
+            .options(orm.joinedload(Edition.text)).all()
+        Edition.load_writers(editions)
+        fields = {edition.id: {
+            'text_id': edition.text_id,
+            'writer_id': [writer.id for writers in edition.writers.values()
+                          for writer in writers],
+            'edition_num': edition.num,
+            'verse': edition.verse,
+            'text_title': edition.text_title,
+            'text_url_name': edition.text.url_name,
+            'authors': [writer.name for writer in edition.writers['author']],
+        } for edition in editions}
+
+        rows = query.with_entities(cls.id, cls.body, cls.edition_id, cls.num,
+                                   cls.toc_id, cls.html, cls.em_id)\
+            .order_by(cls.id).yield_per(batch_size)
+        for id, body, edition_id, num, toc_id, html, em_id in rows:
+            yield id, {'body': body, 'edition_id': edition_id, 'num': num,
+                       'toc_id': toc_id, 'html': html, 'em': EMPHASIS[em_id],
+                       **fields.get(edition_id, {'text_id': None,
+                                                 'writer_id': []})}
+
+    @staticmethod
+    def highlight_html(fields):
+        """Render the highlighted body of a line from the index (i.e., it's
+        body with the words that matched in <mark>'s) like :attr:`html`, from
+        the line's stored fields. None if it has no highlight.
+        """
+        if not fields.get('highlight'):
+            return None
+        return underscores_to_ems(fields['highlight'], fields.get('em', 'nem'))
+
+    @classmethod
+    def hits(cls, hits):
+        """The lines of a page of search hits, with everything the results
+        show loaded (see :class:`icc.hits.LineHits`).
+        """
+        from icc.hits import LineHits
+        return LineHits(hits)
+
     @property
     def url(self):
         """The url for the smallest precedence section to read, in is the
@@ -583,14 +859,21 @@ class Line(EnumeratedMixin, SearchableMixin, Base):
         return self.toc.url
 
     def __init__(self, *args, **kwargs):
-        self.em_id = EMPHASIS.index(kwargs.pop('em'))
+        self.em = kwargs.pop('em')
+        self.em_id = EMPHASIS.index(self.em)
         super().__init__(*args, **kwargs)
+        self.html = underscores_to_ems(self.body, self.em)
 
     @orm.reconstructor
     def __init_on_load__(self):
         """Resolves the em_id to the line's emphasis status."""
         self.em = EMPHASIS[self.em_id]
 
+    def edit(self, body):
+        """Change the body of the line and re-render its html."""
+        self.body = body
+        self.html = underscores_to_ems(body, self.em)
+
     def __repr__(self):
         return (f"<l{self.num} {self.edition}>")
 
@@ -1,15 +1,15 @@
 """This module contains all the Mixins that I use throughout the models."""
 from datetime import datetime
 
-from sqlalchemy.orm import backref
+from sqlalchemy import and_
+from sqlalchemy.orm import backref, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.declarative import declared_attr
 
 from flask import flash, current_app
-from flask_login import current_user
 
 from icc import db
-from icc.search import (add_to_index, remove_from_index, query_index,
-                        bulk_index, query_lines)
+from icc.search import query_index, query_lines, reindex, document
 
 
 class Base(db.Model):
@@ -297,6 +297,46 @@ class VotableMixin:
                      the reputation change to, if there is one.>
     """
 
+    @classmethod
+    def get_for_vote(cls, id, voter=None):
+        """Get the object by id with the user whose reputation the vote changes
+        (i.e., the __reputable__) loaded along with it, and, if there's a voter,
+        the voter's vote on it in the same query (the unique constraint on the
+        vote tables means there's at most one). That saves voteprep from having
+        to query for it.
+        """
+        query = cls.query.options(joinedload(getattr(cls, cls.__reputable__)))
+        if voter is None or not voter.is_authenticated:
+            return query.get(id)
+        vote_cls = cls.__vote__
+        row = query.add_entity(vote_cls)\
+            .outerjoin(vote_cls, and_(cls.vote_entity_id()==cls.id,
+                                      vote_cls.voter_id==voter.id))\
+            .filter(cls.id==id).first()
+        if not row:
+            return None
+        entity, vote = row
+        entity._votes = {voter.id: vote}
+        return entity
+
+    @classmethod
+    def vote_entity_id(cls):
+        """The column of the vote class that references the entity (they
+        aren't all named the same).
+        """
+        return list(cls.__vote__.entity.property.local_columns)[0]
+
+    def add_weight(self, delta):
+        """Add the delta to the weight in the database (i.e., `weight = weight
+        + delta`) instead of writing back what we read, which lost votes when
+        two came in at once. The weight in memory is kept in step, but isn't
+        marked dirty, so the ORM won't write it back over the top.
+        """
+        table = type(self).__table__
+        db.session.execute(table.update().where(table.c.id==self.id)
+                           .values(weight=table.c.weight + delta))
+        set_committed_value(self, 'weight', self.weight + delta)
+
     @property
     def readable_weight(self):
         """This property produces a readable weight, rather than a computer-like
@@ -320,13 +360,19 @@ class VotableMixin:
             flash("You cannot vote on your own submissions.")
             status['status'] = 'self-vote'
             return status
-        ov = voter.get_vote(self)
+        votes = self.__dict__.get('_votes', {})
+        ov = votes[voter.id] if voter.id in votes else voter.get_vote(self)
+        votes.pop(voter.id, None)
         if ov:
             self.rollback(ov)
             status['rollback'] = True
             if (not (ov.is_up ^ up)):
                 # not ^ is if and only if
                 return status
+            # the unit of work inserts before it deletes, so get the old vote
+            # out of the way of the unique constraint before the new one goes
+            # in
+            db.session.flush()
         status['success'] = True
         return status
 
@@ -339,7 +385,7 @@ class VotableMixin:
         weight = self.up_power(voter) if hasattr(self, 'up_power') else 1
         vote = self.__vote__(voter=voter, entity=self, delta=weight,
                              repchange=repchange)
-        self.weight += vote.delta
+        self.add_weight(vote.delta)
         db.session.add(vote)
         if (hasattr(self, '__approvable__') and
                 (self.weight >= current_app.config[self.__margin_approvable__]
@@ -357,7 +403,7 @@ class VotableMixin:
         weight = self.down_power(voter) if hasattr(self, 'down_power') else -1
         vote = self.__vote__(voter=voter, entity=self, delta=weight,
                              repchange=repchange)
-        self.weight += vote.delta
+        self.add_weight(vote.delta)
         db.session.add(vote)
         if (hasattr(self, 'rejected')
                 and (self.weight <= current_app.config[self.__margin_rejectable__]
@@ -367,8 +413,12 @@ class VotableMixin:
         return status
 
     def rollback(self, vote):
-        self.weight -= vote.delta
-        if vote.repchange:
+        from icc.models.user import ReputationChange
+        self.add_weight(-vote.delta)
+        if vote.reputationchange_id:
+            ReputationChange.rollback(vote.reputationchange_id)
+        elif vote.repchange:
+            # it hasn't been flushed yet
             vote.repchange.user.rollback_repchange(vote.repchange)
         db.session.delete(vote)
 
@@ -446,7 +496,9 @@ class SearchLinesMixin:
     easier to limit line searches to specific Texts, Writers, or Editions."""
     def searchlines(self, expression, page, per_page):
         """Search with a given string."""
-        lines, total = query_lines(self, expression, page, per_page)
+        lines, total = query_lines(
+            self, expression, page, per_page,
+            source=current_app.config['SEARCH_RESULTS_FROM_INDEX'])
         return lines, total
 
 
@@ -454,65 +506,89 @@ class SearchLinesMixin:
 # attribute <x>` what you have done is specify an id# instead of an object. Use
 # the ORM. if that is not the case, it is because, for example, in the case of
 # Annotation.HEAD, you have created a new Annotation and Edit for HEAD to point
-# to, but because of the complex relationship to form HEAD, HEAD is still empty.
-# Simply add the expression `<annotation>.HEAD = <edit>` and you'll be gold,
-# even if it _is_ unecessary.
+# to, but HEAD is still empty. Simply add the expression
+# `<annotation>.set_head(<edit>)` and you'll be gold.
 class SearchableMixin:
     """The Mixin for a searchable class. This might need to be expanded with a
     classmethod for searching across indexes (i.e., an omni search).
+
+    Changes to searchable objects are queued for the index when they're flushed
+    (see :mod:`icc.models.search`).
+
+    Attributes
+    ----------
+    __stored__ : list
+        The attributes that are stored in the index along with the
+        `__searchable__` ones, but not searched. They're what the results can
+        be shown with without going back to the database (see
+        `SEARCH_RESULTS_FROM_INDEX`).
+    __context__ : tuple
+        The field that groups the objects and the field that orders them in
+        the group (e.g., a line's edition and number), if the results from the
+        index are shown with the objects around them.
     """
+    __stored__ = []
+    __context__ = None
+
+    @classmethod
+    def search_context(cls):
+        """The context to ask the search backend for with the results (see
+        :meth:`icc.search.SearchBackend.query`): the `SEARCH_CONTEXT_LINES`
+        objects on either side of a hit.
+        """
+        if not cls.__context__:
+            return None
+        return (*cls.__context__, current_app.config['SEARCH_CONTEXT_LINES'])
+
     @classmethod
     def search(cls, expression, page, per_page):
         """Search with a given string."""
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        source = current_app.config['SEARCH_RESULTS_FROM_INDEX']
+        hits, total = query_index(
+            cls.__tablename__, expression, page, per_page, source=source,
+            context=cls.search_context() if source else None)
         if isinstance(total, dict):
             total = total.get('value', 0)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)).all(), total
+        return cls.hits(hits), total
 
     @classmethod
-    def before_commit(cls, session):
-        """A method called before any commit."""
-        if current_user and current_user.is_authenticated:
-            current_user.last_seen = datetime.utcnow()
-        session._changes = {
-                'add': list(session.new),
-                'update': list(session.dirty),
-                'delete': list(session.deleted)
-                }
-        # This accesses all the necessary fields in searchable so they are
-        # loaded into memory from sqlalchemy before we commit
-        for key, change in session._changes.items():
-            for obj in change:
-                if isinstance(obj, SearchableMixin):
-                    for field in obj.__searchable__:
-                        getattr(obj, field)
+    def hits(cls, hits):
+        """The objects of a page of search hits (ids, or (id, fields) tuples),
+        in the order of the hits. They're loaded in one query and put in order
+        here rather than with a `CASE` in the query. Override this to load
+        whatever the results page shows with them.
+        """
+        ids = [hit[0] if isinstance(hit, tuple) else hit for hit in hits]
+        if not ids:
+            return []
+        by_id = {obj.id: obj for obj in cls.query.filter(cls.id.in_(ids))}
+        return [by_id[i] for i in ids if i in by_id]
 
     @classmethod
-    def after_commit(cls, session):
-        """A method called after any commit."""
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+    def search_documents(cls, query, batch_size=1000):
+        """Generate the search documents (see :func:`icc.search.document`) of
+        the objects of the query, loading them `batch_size` at a time. Override
+        this if there's a cheaper way to get the fields than loading every
+        object.
+        """
+        for obj in query.yield_per(batch_size):
+            yield document(obj)
 
     @classmethod
-    def reindex(cls, **kwargs):
-        """This reindexes all the objects in a searchable class."""
+    def reindex(cls, chunk_size=1000, workers=1, progress=None, **kwargs):
+        """This reindexes all the objects in a searchable class (or just the
+        ones that match the kwargs, e.g., `Line.reindex(edition=edition)`).
+        The objects are streamed into the index in chunks (see
+        :func:`icc.search.reindex`) rather than all being loaded at once.
+
+        Returns
+        -------
+        ReindexStats
+            How many objects were indexed, and how fast.
+        """
         qry = cls.query if not kwargs else cls.query.filter_by(**kwargs)
-        bulk_index(cls.__tablename__, qry.all())
-
+        return reindex(cls.__tablename__,
+                       cls.search_documents(qry, batch_size=chunk_size),
+                       chunk_size=chunk_size, workers=workers,
+                       progress=progress)
 
-# register before and after commits.
-#db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
-#db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
@@ -16,6 +16,10 @@ class TextRequestVote(Base, VoteMixin):
                                 index=True)
     entity = db.relationship('TextRequest', backref=backref('ballots'))
 
+    __table_args__ = (
+        db.UniqueConstraint('voter_id', 'text_request_id', name='uq_textrequestvote_voter'),
+    )
+
     def __repr__(self):
         prefix = super().__repr__()
         return f"{prefix}{self.text_request}"
@@ -51,7 +55,8 @@ class TextRequest(Base, FollowableMixin, VotableMixin):
         description = kwargs.pop('description', None)
         description = "This wiki is blank." if not description else description
         super().__init__(*args, **kwargs)
-        self.wiki = Wiki(body=description, entity_string=str(self))
+        self.wiki = Wiki(body=description, entity_string=str(self),
+                         entity=self)
 
     def __repr__(self):
         return f'<Request for {self.title}>'
@@ -65,6 +70,10 @@ class TagRequestVote(Base, VoteMixin):
                                index=True)
     entity = db.relationship('TagRequest', backref=backref('ballots'))
 
+    __table_args__ = (
+        db.UniqueConstraint('voter_id', 'tag_request_id', name='uq_tagrequestvote_voter'),
+    )
+
     def __repr__(self):
         prefix = super().__repr__()
         return f"{prefix}{self.tag_request}"
@@ -98,7 +107,8 @@ class TagRequest(Base, FollowableMixin, VotableMixin):
         description = kwargs.pop('description', None)
         description = "This wiki is blank." if not description else description
         super().__init__(*args, **kwargs)
-        self.wiki = Wiki(body=description, entity_string=str(self))
+        self.wiki = Wiki(body=description, entity_string=str(self),
+                         entity=self)
 
     def __repr__(self):
         return f'<Request for {self.tag}>'
@@ -0,0 +1,85 @@
+"""The search index queue.
+
+Changes to searchable objects aren't sent to the search backend in the request
+that makes them (that would make every commit wait on Elasticsearch). Instead,
+every flush queues an :class:`IndexOperation` for each searchable object it
+inserted, changed, or deleted, in the same transaction, so the queue is exactly
+as durable as the change itself. The queue is drained in batches by
+:func:`icc.search.drain_index_queue`, either in the background worker
+(`SEARCH_WORKER`) or by `inserts/drainindex.py`.
+"""
+import sys
+import inspect
+from datetime import datetime
+
+from sqlalchemy import orm
+
+from icc import db
+from icc.models.mixins import Base, SearchableMixin
+
+
+class IndexOperation(Base):
+    """A queued change to the search index.
+
+    Attributes
+    ----------
+    index_name : str
+        The index (i.e., the table of the object).
+    entity_id : int
+        The id of the object.
+    op : str
+        Either 'add' (which also covers updates) or 'remove'.
+    queued : DateTime
+        When it was queued. The oldest one pending is the lag of the index.
+    attempts : int
+        How many times indexing it has failed.
+    retry_at : DateTime
+        When it can be tried (again). This is pushed back exponentially every
+        time it fails.
+    error : str
+        The last error, if it failed.
+    """
+    index_name = db.Column(db.String(64), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(8), nullable=False, default='add')
+    queued = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    attempts = db.Column(db.Integer, default=0)
+    retry_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_indexoperation_entity', 'index_name', 'entity_id'),
+    )
+
+    def __repr__(self):
+        return f'<{self.op} {self.index_name} {self.entity_id}>'
+
+
+@db.event.listens_for(orm.Session, 'after_flush')
+def _queue_index_operations(session, flush_context):
+    """Queue the searchable objects the flush touched (once each, however many
+    times they were touched).
+    """
+    from icc.search import search_backend
+    if not search_backend():
+        return
+    ops = {}
+    for obj in session.new:
+        if isinstance(obj, SearchableMixin):
+            ops[obj.__tablename__, obj.id] = 'add'
+    for obj in session.dirty:
+        if isinstance(obj, SearchableMixin) and\
+                session.is_modified(obj, include_collections=False):
+            ops[obj.__tablename__, obj.id] = 'add'
+    for obj in session.deleted:
+        if isinstance(obj, SearchableMixin):
+            ops[obj.__tablename__, obj.id] = 'remove'
+    if not ops:
+        return
+    now = datetime.utcnow()
+    session.execute(IndexOperation.__table__.insert(), [
+        {'index_name': index, 'entity_id': id, 'op': op, 'queued': now,
+         'attempts': 0, 'retry_at': now} for (index, id), op in ops.items()])
+
+
+classes = dict(inspect.getmembers(sys.modules[__name__], inspect.isclass))
@@ -7,7 +7,7 @@ from datetime import datetime
 from time import time
 from hashlib import md5
 
-from flask import abort, url_for, current_app as app
+from flask import abort, url_for, g, has_app_context, current_app as app
 from flask_login import UserMixin, AnonymousUserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import orm
@@ -16,6 +16,7 @@ from sqlalchemy.ext.associationproxy import association_proxy
 
 from icc import db, login
 from icc.models.mixins import Base, EnumMixin, FlagMixin
+from icc.enums import enums
 
 
 @login.user_loader
@@ -49,6 +50,10 @@ class MyAnonymousUserMixin(AnonymousUserMixin):
         """Dummy vote return method"""
         return None
 
+    def get_votes(self, entities):
+        """Dummy votes return method"""
+        return {entity: None for entity in entities}
+
 
 # override the AnonymouseUserMixin
 login.anonymous_user = MyAnonymousUserMixin
@@ -163,10 +168,10 @@ class User(UserMixin, Base):
 
     def repchange(self, enumstring):
         """Change a user's reputation given the enumstring."""
-        enum = ReputationEnum.query.filter_by(enum=enumstring).first()
+        enum = enums.by_enum(ReputationEnum, enumstring)
         if not enum:
             return
-        repchange = ReputationChange(enum=enum, user=self,
+        repchange = ReputationChange(enum_id=enum.id, user=self,
                                      delta=enum.default_delta)
         if self.reputation + repchange.delta <= 0:
             repchange.delta = -self.reputation
@@ -212,12 +217,26 @@ class User(UserMixin, Base):
         return User.query.get(id)
 
     # admin authorization methods
+    @property
+    def effective_rights(self):
+        """The set of the names of all of the rights the user has, whether
+        outright or by reputation. It's built from the enum registry and
+        memoized for the request (by reputation, because that can change
+        mid-request when the user's votes are counted), so authorization checks
+        are just set lookups.
+        """
+        memo = g.setdefault('effective_rights', {}) if has_app_context() else {}
+        key = (self.id, self.reputation)
+        if key not in memo:
+            ids = {r.id for r in self.rights}
+            memo[key] = frozenset(
+                r.enum for r in enums.all(AdminRight) if r.id in ids or
+                (r.min_rep and self.reputation >= r.min_rep))
+        return memo[key]
+
     def is_authorized(self, right):
         """Check if a user is authorized with a particular right."""
-        r = AdminRight.query.filter_by(enum=right).first()
-        if not r:
-            return False
-        return r in self.rights or (r.min_rep and self.reputation >= r.min_rep)
+        return right in self.effective_rights
 
     def is_auth_all(self, rights):
         """This is like is_authorized but takes a list and only returns true if
@@ -263,6 +282,36 @@ class User(UserMixin, Base):
         return vote_cls.query.filter(vote_cls.voter==self,
                                      vote_cls.entity==obj).first()
 
+    def get_votes(self, objs):
+        """Get the votes on a bunch of objects at once, in one query per vote
+        class instead of one per object (i.e., for a page of them).
+
+        Parameters
+        ----------
+        objs : iterable
+            The objects. They can be of any (and of mixed) VotableMixin
+            classes.
+
+        Returns
+        -------
+        dict
+            The vote on each of the objects (or None if the user hasn't voted
+            on it), by object.
+        """
+        votes = {}
+        by_class = {}
+        for obj in objs:
+            votes[obj] = None
+            by_class.setdefault(type(obj), {})[obj.id] = obj
+        for cls, objs_by_id in by_class.items():
+            entity_id = cls.vote_entity_id()
+            vote_cls = cls.__vote__
+            query = vote_cls.query.filter(vote_cls.voter_id==self.id,
+                                          entity_id.in_(objs_by_id))
+            for vote in query:
+                votes[objs_by_id[getattr(vote, entity_id.key)]] = vote
+        return votes
+
 
 class AdminRight(Base, EnumMixin):
     """The class used to represent a user's rights.
@@ -342,7 +391,21 @@ class ReputationChange(Base):
         # this is cleaner than the entity population of the wiki system, but it
         # relies on the existence of the enum to call on. Since that is
         # necessary, wiki can't use the same method.
-        self.entity = getattr(self, self.enum.entity.lower(), None)
+        enum = enums.get(ReputationEnum, self.enum_id)
+        self.entity = getattr(self, enum.entity.lower(), None) if enum else\
+            None
+
+    @staticmethod
+    def rollback(*ids):
+        """Queue the reputation changes (by id) to be rolled back. Rolling them
+        back through the ORM means loading every change, it's user, and every
+        vote backref on the change (to null them out) just to delete a row and
+        subtract a number. Instead, they're rolled back after the next flush
+        (i.e., after the votes that point at them are deleted) in two
+        statements, no matter how many there are. See
+        :func:`_flush_repchange_rollbacks`.
+        """
+        db.session.info.setdefault('repchange_rollbacks', set()).update(ids)
 
 
 class UserFlag(Base, FlagMixin):
@@ -352,5 +415,47 @@ class UserFlag(Base, FlagMixin):
                              backref=backref('flags', lazy='dynamic'))
 
 
+@db.event.listens_for(AdminRight, 'after_insert')
+@db.event.listens_for(AdminRight, 'after_update')
+@db.event.listens_for(AdminRight, 'after_delete')
+@db.event.listens_for(User.rights, 'append')
+@db.event.listens_for(User.rights, 'remove')
+def _invalidate_rights(*args):
+    """Drop every memoized set of rights when the rights change."""
+    if has_app_context():
+        g.pop('effective_rights', None)
+
+
+@db.event.listens_for(orm.Session, 'after_flush')
+def _flush_repchange_rollbacks(session, flush_context):
+    """Roll back the queued reputation changes: subtract their deltas from
+    their users' reputations (floored at zero, like
+    :meth:`User.rollback_repchange`) in one update and delete them in one
+    delete.
+    """
+    ids = session.info.pop('repchange_rollbacks', None)
+    if not ids:
+        return
+    changes = ReputationChange.__table__
+    users = User.__table__
+    total = db.select([db.func.sum(changes.c.delta)])\
+        .where(db.and_(changes.c.user_id==users.c.id, changes.c.id.in_(ids)))\
+        .as_scalar()
+    session.execute(
+        users.update()
+        .where(users.c.id.in_(db.select([changes.c.user_id])
+                              .where(changes.c.id.in_(ids))))
+        .values(reputation=db.case([(users.c.reputation - total < 0, 0)],
+                                   else_=users.c.reputation - total)))
+    session.execute(changes.delete().where(changes.c.id.in_(ids)))
+
+    # anything we have loaded is out of date now
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, User):
+            session.expire(obj, ['reputation'])
+        elif isinstance(obj, ReputationChange) and obj.id in ids:
+            session.expunge(obj)
+
+
 classes = dict(inspect.getmembers(sys.modules[__name__], inspect.isclass))
 classes['UserFlagEnum'] = UserFlag.enum_cls
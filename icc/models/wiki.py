@@ -12,10 +12,28 @@ from icc import db
 
 
 class Wiki(Base):
-    """An actual wiki. It has some idiosyncracies I'm not fond of, notably in
-    init_on_load. But it's modelled after my Annotation system.
+    """An actual wiki. It's modelled after my Annotation system.
+
+    Attributes
+    ----------
+    entity_string : str
+        The string of the entity at the time the wiki was created.
+    entity_type : str
+        The name of the class of the entity the wiki belongs to (e.g., 'Text').
+    entity_id : int
+        The id of the entity the wiki belongs to. The foreign key is on the
+        entity's side (entity.wiki_id), and the entity is inserted after the
+        wiki, so this is filled in after the entity is inserted.
+    entity
+        The entity the wiki belongs to.
     """
     entity_string = db.Column(db.String(191), index=True)
+    entity_type = db.Column(db.String(64))
+    entity_id = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_wiki_entity', 'entity_type', 'entity_id'),
+    )
 
     current = db.relationship(
         'WikiEdit', primaryjoin='and_(WikiEdit.entity_id==Wiki.id,'
@@ -27,23 +45,32 @@ class Wiki(Base):
         'WikiEdit.approved==False, WikiEdit.rejected==False)',
         passive_deletes=False)
 
-    @orm.reconstructor
-    def __init_on_load__(self):
-        """The primary purpose of this method is to load the entity reference.
+    @property
+    def entity(self):
+        """The entity the wiki belongs to. This used to be found in a
+        reconstructor by probing every one of the entity backrefs, which was six
+        queries for every wiki we loaded. Now it's resolved when it's asked for,
+        by primary key (so it's free if the entity is already in the session).
         """
-        # This is a hack and needs to be improved.
-        # Basically, we rely on the backref defined on the entity in order to
-        # get the entity. I really want to make this more explicit and less
-        # hacky.
-        self.entity = list(
-            filter(None, [self.writer, self.text, self.tag, self.edition,
-                          self.textrequest, self.tagrequest]))[0]
+        if '_entity' not in self.__dict__:
+            from icc import classes
+            cls = classes[self.entity_type]
+            if self.entity_id is not None:
+                self._entity = cls.query.get(self.entity_id)
+            else:
+                # the backref on the entity is the lowercased class name
+                self._entity = getattr(self, self.entity_type.lower())
+        return self._entity
 
     def __init__(self, *args, **kwargs):
         """Creating a new wiki also populates the first edit."""
         body = kwargs.pop('body', None)
         body = 'This wiki is currently blank.' if not body else body
+        entity = kwargs.pop('entity', None)
         super().__init__(*args, **kwargs)
+        if entity is not None:
+            self.entity_type = type(entity).__name__
+            self._entity = entity
         self.versions.append(
             WikiEdit(current=True, body=body, approved=True,
                      reason='Initial Version.'))
@@ -72,6 +99,10 @@ class WikiEditVote(Base, VoteMixin):
     entity = db.relationship('WikiEdit', backref=backref('ballots',
                                                          passive_deletes=True))
 
+    __table_args__ = (
+        db.UniqueConstraint('voter_id', 'edit_id', name='uq_wikieditvote_voter'),
+    )
+
     def __repr__(self):
         prefix = super().__repr__()
         return f"{prefix}{self.edit}"
@@ -101,4 +132,17 @@ class WikiEdit(Base, EditMixin, VotableMixin):
                            edit_id=self.id)
 
 
+@db.event.listens_for(Base, 'after_insert', propagate=True)
+def set_wiki_entity_id(mapper, connection, target):
+    """Fill in the entity_id of the wiki of a newly inserted entity."""
+    wiki = target.__dict__.get('wiki')
+    if not isinstance(wiki, Wiki) or wiki.entity_id is not None or\
+            not hasattr(target, 'wiki_id'):
+        return
+    connection.execute(Wiki.__table__.update()
+                       .where(Wiki.__table__.c.id==target.wiki_id)
+                       .values(entity_id=target.id))
+    orm.attributes.set_committed_value(wiki, 'entity_id', target.id)
+
+
 classes = dict(inspect.getmembers(sys.modules[__name__], inspect.isclass))
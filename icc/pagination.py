@@ -0,0 +1,182 @@
+"""A module for keyset (a.k.a. seek) pagination.
+
+Flask-SQLAlchemy's `.paginate()` uses an OFFSET, which means the database has
+to read and throw away every row before the page (so deep pages get slower and
+slower), and it issues a separate COUNT query on every page. Keyset pagination
+instead remembers the sort key of the last row of the page and asks for the
+rows after it, which is an index seek no matter how deep the page is.
+
+The sort key of the last row (and the first row, for the previous page) is
+encoded into an opaque cursor that goes into the `cursor` url argument.
+"""
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import and_, or_
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.functions import FunctionElement
+
+
+class KeysetPage:
+    """A page of a keyset paginated query. It quacks mostly like
+    Flask-SQLAlchemy's Pagination object, but with cursors instead of page
+    numbers.
+
+    Attributes
+    ----------
+    items : list
+        The objects on the page.
+    has_next : bool
+        Whether there is a next page.
+    has_prev : bool
+        Whether there is a previous page.
+    next_cursor : str
+        The cursor for the next page (None if there isn't one).
+    prev_cursor : str
+        The cursor for the previous page (None if there isn't one).
+    total : int
+        The total number of objects in the query. This is None unless a count
+        was asked for, because that's a whole other query.
+    per_page : int
+        The number of items per page.
+    """
+    def __init__(self, items, keys, has_next, has_prev, per_page, total=None):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.per_page = per_page
+        self.total = total
+        self.next_cursor = (encode_cursor('n', keys[-1]) if has_next else
+                            None)
+        self.prev_cursor = (encode_cursor('p', keys[0]) if has_prev else
+                            None)
+
+    def __repr__(self):
+        return (f'<KeysetPage of {len(self.items)} next={self.has_next} '
+                f'prev={self.has_prev}>')
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return {'dt': obj.isoformat()}
+    raise TypeError(f"Can't put a {type(obj)} in a cursor.")
+
+
+def _hook(obj):
+    if 'dt' in obj:
+        return datetime.fromisoformat(obj['dt'])
+    return obj
+
+
+def encode_cursor(direction, values):
+    """Encode the direction ('n' for next, 'p' for previous) and the sort key
+    values of a row into a url-safe cursor.
+    """
+    s = json.dumps([direction, list(values)], default=_default,
+                   separators=(',', ':'))
+    return urlsafe_b64encode(s.encode('utf8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into the direction and the sort key values. Raises a
+    ValueError if the cursor is garbage.
+    """
+    try:
+        s = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(s.decode('utf8'), object_hook=_hook)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor.")
+    if direction not in ('n', 'p') or not isinstance(values, list):
+        raise ValueError("Invalid cursor.")
+    return direction, values
+
+
+def _seek(keys, values, reverse):
+    """Build the condition for the rows after (or before, if reverse) the row
+    with the values, i.e., a row value comparison that works with mixed sort
+    directions: (k1 > v1) or (k1 == v1 and k2 > v2) or ...
+    """
+    clauses = []
+    for i, (key, desc) in enumerate(keys):
+        after = (key < values[i]) if desc != reverse else (key > values[i])
+        equals = [k == v for (k, _), v in zip(keys[:i], values[:i])]
+        clauses.append(and_(*equals, after))
+    return or_(*clauses)
+
+
+def keyset_paginate(query, order, per_page, cursor=None, page=None,
+                    count=False):
+    """Paginate the query by the keyset of the order.
+
+    Parameters
+    ----------
+    query : BaseQuery
+        The query to paginate, *without* an order_by.
+    order : tuple
+        The order_by expressions (e.g., `(Annotation.weight.desc(),
+        Annotation.id.desc())`). The last one has to be unique (i.e., the id)
+        so that the cursor points at exactly one row. Functions (e.g.,
+        `db.func.max(Comment.timestamp)`) are treated as aggregates of a
+        grouped query, so the seek goes in the HAVING clause.
+    per_page : int
+        The number of items per page.
+    cursor : str
+        The cursor from a previous page. If it is None, the first page is
+        returned (or the page by number).
+    page : int
+        The page number. This is only here so that the old `?page=` urls keep
+        working. It uses an OFFSET (but still no COUNT), and the pages after it
+        use cursors.
+    count : bool
+        Whether to count the total number of items in the query.
+
+    Returns
+    -------
+    :class:`KeysetPage`
+        The page.
+    """
+    keys = []
+    for expression in order:
+        modifier = getattr(expression, 'modifier', None)
+        keys.append((expression.element if modifier else expression,
+                     modifier is operators.desc_op))
+    aggregate = any(isinstance(key, FunctionElement) for key, _ in keys)
+
+    direction, values = 'n', None
+    if cursor:
+        try:
+            direction, values = decode_cursor(cursor)
+        except ValueError:
+            abort(404)
+        if len(values) != len(keys):
+            abort(404)
+    reverse = direction == 'p'
+
+    total = query.order_by(None).count() if count else None
+
+    # The keys are added as columns so that we can read them off of the rows
+    # (they aren't necessarily columns of the entity).
+    q = query.add_columns(*[key for key, _ in keys])
+    if values is not None:
+        seek = _seek(keys, values, reverse)
+        q = q.having(seek) if aggregate else q.filter(seek)
+    q = q.order_by(*[key.desc() if desc != reverse else key.asc() for key, desc
+                     in keys])
+    if values is None and page and page > 1:
+        q = q.offset((page - 1) * per_page)
+    rows = q.limit(per_page + 1).all()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next = more
+        has_prev = values is not None or bool(page and page > 1)
+
+    return KeysetPage([row[0] for row in rows], [row[1:] for row in rows],
+                      has_next and bool(rows), has_prev and bool(rows),
+                      per_page, total)
@@ -41,7 +41,8 @@ def tag_request_index():
     return render_template('indexes/tag_requests.html', title="Tag Requests",
                            next_page=next_page, prev_page=prev_page,
                            sort=sort, sorts=sorturls,
-                           tag_requests=requests.items)
+                           tag_requests=requests.items,
+                           votes=current_user.get_votes(requests.items))
 
 
 @requests.route('/tag/<request_id>')
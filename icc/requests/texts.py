@@ -43,7 +43,8 @@ def text_request_index():
                            title="Text Requests",
                            next_page=next_page, prev_page=prev_page,
                            sort=sort, sorts=sorturls,
-                           requests=requests.items)
+                           requests=requests.items,
+                           votes=current_user.get_votes(requests.items))
 
 
 @requests.route('/text/<request_id>')
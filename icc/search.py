@@ -1,104 +1,835 @@
-"""A module devoted to my search system."""
-import string
+"""A module devoted to my search system.
+
+The rest of the app only ever calls the functions at the bottom of this module
+(:func:`add_to_index`, :func:`remove_from_index`, :func:`bulk_index`,
+:func:`query_index`, :func:`query_lines`, and :func:`query_prefix`). They hand
+off to whichever backend the app was set up with (see :func:`init_app`):
+
+- `elasticsearch`: the original. It needs an Elasticsearch server at
+  `ELASTICSEARCH_URL`.
+- `sqlite`: a full-text index in a SQLite file (`SEARCH_INDEX`) using FTS5. It
+  doesn't need anything running, so it's what you get on the test and staging
+  boxes (and anywhere else without `ELASTICSEARCH_URL`).
+
+If there's no backend at all the functions quietly do nothing (and searches
+come back empty), which is how it's always worked without Elasticsearch.
+
+Commits don't index anything themselves, they queue what they changed (see
+:mod:`icc.models.search`), and :func:`drain_index_queue` sends the queue to the
+backend in batches. :func:`start_index_worker` does that in the background.
+"""
+import re
+import json
+import time
+import sqlite3
+import threading
+from itertools import islice
+from collections import namedtuple, deque, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from flask import current_app
 from elasticsearch import helpers
+from elasticsearch.exceptions import ConnectionTimeout
 from icc import models, db
 
 
+def document(obj):
+    """The document of the object for the index: it's id and a dict of it's
+    `__searchable__` fields, and it's `__stored__` fields (which aren't
+    searched, they're only there to be handed back with the results, see
+    :meth:`SearchBackend.query`).
+    """
+    return obj.id, {field: getattr(obj, field) for field in
+                    obj.__searchable__ + obj.__stored__}
+
+
+class SearchBackend:
+    """The interface of a search backend. An index is named after the table of
+    the objects in it, and the objects are indexed by id with their
+    `__searchable__` fields (see :func:`document`).
+    """
+    def index_documents(self, index, documents):
+        """Add (or update) the documents (an iterable of id, fields tuples) in
+        the index.
+        """
+        raise NotImplementedError
+
+    def bulk_index(self, index, objs):
+        """Add (or update) the objects in the index."""
+        self.index_documents(index, (document(obj) for obj in objs))
+
+    def add_to_index(self, index, model):
+        """Add (or update) the object in the index."""
+        self.bulk_index(index, [model])
+
+    def remove_from_index(self, index, model):
+        """Remove the object from the index."""
+        self.bulk_remove(index, [model.id])
+
+    def bulk_remove(self, index, ids):
+        """Remove the objects with the ids from the index in bulk."""
+        raise NotImplementedError
+
+    def query(self, index, query, page, per_page, filters=None, source=False,
+              context=None):
+        """Search the `body` of the objects in the index, best matches first.
+
+        Parameters
+        ----------
+        index : str
+            The name of the index.
+        query : str
+            The search string.
+        page : int
+            The page of results (1-indexed).
+        per_page : int
+            The number of results on a page.
+        filters : dict
+            Field values the objects must also have (e.g., `{'edition_id':
+            1}`). If the field is a list on the object, any of it's values
+            match.
+        source : bool
+            Return the documents the objects were indexed with along with their
+            ids, with the body highlighted (the words that matched in `<mark>`
+            tags) in a `highlight` field.
+        context : tuple
+            With `source`, also return the documents around each hit in a
+            `context` field: a (field, order_field, n) tuple, for the objects
+            with the same `field` as the hit whose `order_field` is within `n`
+            of the hit's, in order (e.g., `('edition_id', 'num', 2)` for the
+            two lines on either side of a line, and the line itself).
+
+        Returns
+        -------
+        tuple
+            The ids of the page of objects (or, with `source`, (id, fields)
+            tuples, where the fields are None if the object was indexed without
+            them) and the total number of matches.
+        """
+        raise NotImplementedError
+
+    def prefix_query(self, index, query, limit, filters=None, timeout=None):
+        """Search the `body` of the objects in the index as it's typed: the
+        objects with all of the words in the query, the last one as a prefix
+        (so `cascade of ur` finds `cascade of urine`), best matches first.
+
+        Parameters
+        ----------
+        index : str
+            The name of the index.
+        query : str
+            The search string so far.
+        limit : int
+            The most hits to return.
+        filters : dict
+            Field values the objects must also have (see :meth:`query`).
+        timeout : float
+            How long the search can take, in seconds.
+
+        Returns
+        -------
+        tuple
+            The hits, as (id, fields) tuples like :meth:`query` with `source`,
+            and whether the search ran out of time (in which case the hits are
+            empty).
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _add_context(hits, documents, context):
+        """Put the documents (with their ids in them) in the `context` of the
+        hits they're around.
+        """
+        field, order, n = context
+        around = defaultdict(list)
+        for doc in documents:
+            around[doc.get(field)].append(doc)
+        for _, fields in hits:
+            if fields is None:
+                continue
+            fields['context'] = sorted(
+                (doc for doc in around[fields.get(field)] if
+                 abs(doc[order] - fields[order]) <= n),
+                key=lambda doc: doc[order])
+
+    @staticmethod
+    def _windows(hits, context):
+        """The (field value, first, last) windows of the context of the hits.
+        """
+        field, order, n = context
+        return {(fields.get(field), fields[order] - n, fields[order] + n) for
+                _, fields in hits if fields is not None and
+                fields.get(order) is not None}
+
+
+class ElasticsearchBackend(SearchBackend):
+    """The Elasticsearch backend."""
+    def __init__(self, client):
+        self.client = client
+
+    # the standard tokenizer keeps underscores in words, so the emphasis
+    # underscores in the bodies (`_vast_`) would keep the words they're on from
+    # matching. They're mapped to spaces before tokenizing instead (which
+    # keeps the highlight offsets on the body as it is).
+    SETTINGS = {'analysis': {
+        'char_filter': {'underscores': {'type': 'mapping',
+                                        'mappings': ['_ => \\u0020']}},
+        'analyzer': {'default': {'type': 'custom', 'tokenizer': 'standard',
+                                 'char_filter': ['underscores'],
+                                 'filter': ['lowercase']}}}}
+
+    def _create(self, index):
+        if not self.client.indices.exists(index):
+            self.client.indices.create(index, body={'settings': self.SETTINGS})
+
+    def index_documents(self, index, documents):
+        self._create(index)
+        # a generator, so helpers.bulk can chunk it without it ever all being
+        # in memory. The bodies go in as they are (they're shown from the
+        # index), the analyzer takes care of the punctuation.
+        actions = ({'_index': index, '_type': index, '_id': id,
+                    '_source': fields} for id, fields in documents)
+        helpers.bulk(self.client, actions)
+
+    def add_to_index(self, index, model):
+        self._create(index)
+        id, payload = document(model)
+        self.client.index(index=index, doc_type=index, id=id, body=payload)
+
+    def remove_from_index(self, index, model):
+        self._create(index)
+        self.client.delete(index=index, doc_type=index, id=model.id)
+
+    def bulk_remove(self, index, ids):
+        self._create(index)
+        actions = [{'_op_type': 'delete', '_index': index, '_type': index,
+                    '_id': id} for id in ids]
+        _, errors = helpers.bulk(self.client, actions, raise_on_error=False)
+        # it's fine if they were never indexed in the first place
+        errors = [error for error in errors if
+                  error.get('delete', {}).get('status') != 404]
+        if errors:
+            raise helpers.BulkIndexError(
+                f"{len(errors)} document(s) failed to delete.", errors)
+
+    def query(self, index, query, page, per_page, filters=None, source=False,
+              context=None):
+        if filters:
+            must = [{'match': {field: value}} for field, value in
+                    filters.items()]
+            must.append({'match': {'body': query}})
+            body = {'query': {'bool': {'must': must}}}
+        else:
+            body = {'query': {'multi_match': {'query': query,
+                                              'fields': ['body']}}}
+        body['from'] = (page - 1) * per_page
+        body['size'] = per_page
+        body['_source'] = source
+        if source:
+            # number_of_fragments 0 is the whole (highlighted) body
+            body['highlight'] = {'fields': {'body': {
+                'pre_tags': ['<mark>'], 'post_tags': ['</mark>'],
+                'number_of_fragments': 0}}}
+        search = self.client.search(index=index, doc_type=index, body=body)
+
+        total = search['hits']['total']
+        if isinstance(total, dict):
+            total = total.get('value', 0)
+        if not source:
+            ids = [int(hit['_id']) for hit in search['hits']['hits']]
+            return ids, total
+
+        hits = []
+        for hit in search['hits']['hits']:
+            fields = hit.get('_source')
+            if fields is not None:
+                fields['highlight'] = ''.join(
+                    hit.get('highlight', {}).get('body', [fields.get('body')]))
+            hits.append((int(hit['_id']), fields))
+        windows = self._windows(hits, context) if context else None
+        if windows:
+            field, order, _ = context
+            should = [{'bool': {'filter': [
+                {'term': {field: value}},
+                {'range': {order: {'gte': first, 'lte': last}}}]}} for
+                      value, first, last in windows]
+            around = self.client.search(
+                index=index, doc_type=index,
+                body={'query': {'bool': {'should': should,
+                                         'minimum_should_match': 1}},
+                      'size': sum(last - first + 1 for _, first, last in
+                                  windows)})
+            self._add_context(hits, [{'id': int(doc['_id']), **doc['_source']}
+                                     for doc in around['hits']['hits']],
+                              context)
+        return hits, total
+
+    def prefix_query(self, index, query, limit, filters=None, timeout=None):
+        must = [{'match': {field: value}} for field, value in
+                (filters or {}).items()]
+        # all of the words, anywhere, in any order (like the SQLite backend),
+        # not the phrase, which match_phrase_prefix on the whole query would be
+        words = re.findall(r'\w+', query or '')
+        if not words:
+            return [], False
+        *words, last = words
+        must.extend({'match': {'body': word}} for word in words)
+        must.append({'match_phrase_prefix': {'body': {'query': last}}})
+        body = {'query': {'bool': {'must': must}}, 'size': limit,
+                'highlight': {'fields': {'body': {
+                    'pre_tags': ['<mark>'], 'post_tags': ['</mark>'],
+                    'number_of_fragments': 0}}}}
+        kwargs = {}
+        if timeout:
+            # the search itself stops at the timeout, and we stop waiting for
+            # it shortly after, in case it's stuck somewhere else
+            body['timeout'] = f'{int(timeout * 1000)}ms'
+            kwargs['request_timeout'] = timeout * 2
+        try:
+            search = self.client.search(index=index, doc_type=index,
+                                        body=body, **kwargs)
+        except ConnectionTimeout:
+            return [], True
+        if search.get('timed_out'):
+            return [], True
+        hits = []
+        for hit in search['hits']['hits']:
+            fields = hit.get('_source') or {}
+            fields['highlight'] = ''.join(
+                hit.get('highlight', {}).get('body', [fields.get('body')]))
+            hits.append((int(hit['_id']), fields))
+        return hits, False
+
+
+class PrefixCache:
+    """The results of recent prefix searches, so that typing (and deleting)
+    doesn't search for the same prefix over and over. Results are kept for
+    `ttl` seconds (so they're at most that stale), and the least recently used
+    are dropped past `size` of them.
+    """
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is None:
+                return None
+            expires, results = cached
+            if expires < time.monotonic():
+                del self._results[key]
+                return None
+            self._results.move_to_end(key)
+            return results
+
+    def set(self, key, results):
+        with self._lock:
+            self._results[key] = (time.monotonic() + self.ttl, results)
+            self._results.move_to_end(key)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+class SQLiteBackend(SearchBackend):
+    """A backend on SQLite's FTS5 full-text search.
+
+    Every index is three tables: an FTS5 table of the `body` field, keyed by
+    the object's id as the rowid, a plain table of the rest of the integer
+    fields (one row per value, so list fields like `Line.writer_id` can be
+    filtered on) for the filters, and a table of the whole documents (as json)
+    to hand back with the results. Results are ranked by FTS5's bm25, and,
+    like Elasticsearch's `match`, an object matches if it has any of the words
+    in the query.
+
+    Parameters
+    ----------
+    path : str
+        The path of the SQLite file the index is in (or `:memory:`).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._indexes = set()
+        # a :memory: database only exists in the one connection, so there is
+        # only the one connection, and we take turns with it
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path,
+                                               check_same_thread=False)
+        return self._connection
+
+    def _create(self, index):
+        if index in self._indexes:
+            return
+        if not re.fullmatch(r'\w+', index):
+            raise ValueError(f"{index} is not a valid index name.")
+        self.connection.executescript(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS "{index}" USING fts5(
+                body, prefix='2 3');
+            CREATE TABLE IF NOT EXISTS "{index}_fields" (
+                id INTEGER NOT NULL, field TEXT NOT NULL, value);
+            CREATE INDEX IF NOT EXISTS "ix_{index}_fields_value"
+                ON "{index}_fields" (field, value, id);
+            CREATE INDEX IF NOT EXISTS "ix_{index}_fields_id"
+                ON "{index}_fields" (id);
+            CREATE TABLE IF NOT EXISTS "{index}_source" (
+                id INTEGER PRIMARY KEY, source TEXT NOT NULL);
+        ''')
+        self._indexes.add(index)
+
+    def _delete(self, index, ids):
+        self.connection.executemany(f'DELETE FROM "{index}" WHERE rowid = ?',
+                                    [(i,) for i in ids])
+        self.connection.executemany(
+            f'DELETE FROM "{index}_fields" WHERE id = ?', [(i,) for i in ids])
+        self.connection.executemany(
+            f'DELETE FROM "{index}_source" WHERE id = ?', [(i,) for i in ids])
+
+    def index_documents(self, index, documents):
+        bodies = []
+        values = []
+        sources = []
+        for id, fields in documents:
+            sources.append((id, json.dumps(fields)))
+            for field, data in fields.items():
+                if field == 'body':
+                    bodies.append((id, data))
+                    continue
+                data = data if isinstance(data, (list, tuple, set)) else [data]
+                # only ids are ever filtered on
+                values.extend((id, field, value) for value in data if
+                              type(value) is int)
+        with self._lock, self.connection:
+            self._create(index)
+            self._delete(index, [id for id, _ in bodies])
+            self.connection.executemany(
+                f'INSERT INTO "{index}" (rowid, body) VALUES (?, ?)', bodies)
+            self.connection.executemany(
+                f'INSERT INTO "{index}_fields" (id, field, value) '
+                'VALUES (?, ?, ?)', values)
+            self.connection.executemany(
+                f'INSERT INTO "{index}_source" (id, source) VALUES (?, ?)',
+                sources)
+
+    def bulk_remove(self, index, ids):
+        with self._lock, self.connection:
+            self._create(index)
+            self._delete(index, ids)
+
+    @staticmethod
+    def _search(index, match, filters):
+        """The FROM and WHERE of a search of the index, and their params."""
+        joins = []
+        params = []
+        for i, (field, value) in enumerate((filters or {}).items()):
+            joins.append(f'JOIN "{index}_fields" AS f{i} ON f{i}.id = '
+                         f'"{index}".rowid AND f{i}.field = ? AND '
+                         f'f{i}.value = ?')
+            params.extend([field, value])
+        search = (f'FROM "{index}" {" ".join(joins)} '
+                  f'LEFT JOIN "{index}_source" ON "{index}_source".id = '
+                  f'"{index}".rowid WHERE "{index}" MATCH ?')
+        params.append(match)
+        return search, params
+
+    def query(self, index, query, page, per_page, filters=None, source=False,
+              context=None):
+        # quote every word so nothing in the query is taken for FTS5 syntax
+        words = re.findall(r'\w+', query or '')
+        if not words:
+            return [], 0
+        match = ' OR '.join(f'"{word}"' for word in words)
+
+        search, params = self._search(index, match, filters)
+
+        with self._lock:
+            self._create(index)
+            total, = self.connection.execute(f'SELECT count(*) {search}',
+                                             params).fetchone()
+            columns = (f'"{index}".rowid, "{index}_source".source, '
+                       f"highlight(\"{index}\", 0, '<mark>', '</mark>')" if
+                       source else f'"{index}".rowid')
+            rows = self.connection.execute(
+                f'SELECT {columns} {search} '
+                f'ORDER BY "{index}".rank, "{index}".rowid LIMIT ? OFFSET ?',
+                params + [per_page, (page - 1) * per_page]).fetchall()
+            if not source:
+                return [row[0] for row in rows], total
+
+            hits = []
+            for id, fields, highlight in rows:
+                fields = json.loads(fields) if fields else None
+                if fields is not None:
+                    fields['highlight'] = highlight
+                hits.append((id, fields))
+            windows = self._windows(hits, context) if context else None
+            if windows:
+                # the documents in any of the windows, off the filter table
+                field, order, _ = context
+                where = ' OR '.join(
+                    ['(g.value = ? AND o.value BETWEEN ? AND ?)'] *
+                    len(windows))
+                around = self.connection.execute(
+                    f'SELECT s.id, s.source FROM "{index}_fields" AS g '
+                    f'JOIN "{index}_fields" AS o ON o.id = g.id AND '
+                    f'o.field = ? JOIN "{index}_source" AS s ON s.id = g.id '
+                    f'WHERE g.field = ? AND ({where})',
+                    [order, field] + [v for window in windows for v in window])
+                self._add_context(hits, [{'id': id, **json.loads(doc)} for id,
+                                         doc in around], context)
+        return hits, total
+
+    def prefix_query(self, index, query, limit, filters=None, timeout=None):
+        words = re.findall(r'\w+', query or '')
+        if not words:
+            return [], False
+        # every word, and the last one as a prefix (which the prefix indexes
+        # on the table make cheap for the first few letters)
+        match = ' AND '.join([f'"{word}"' for word in words[:-1]] +
+                             [f'"{words[-1]}"*'])
+        search, params = self._search(index, match, filters)
+
+        deadline = time.monotonic() + timeout if timeout else None
+        # waiting for the connection counts against the timeout too
+        if not self._lock.acquire(timeout=timeout or -1):
+            return [], True
+        try:
+            if deadline and time.monotonic() > deadline:
+                return [], True
+            self._create(index)
+            if deadline:
+                # sqlite calls this every 1000 instructions, and gives up on
+                # the query the first time it returns true
+                self.connection.set_progress_handler(
+                    lambda: time.monotonic() > deadline, 1000)
+            rows = self.connection.execute(
+                f'SELECT "{index}".rowid, "{index}_source".source, '
+                f"highlight(\"{index}\", 0, '<mark>', '</mark>') {search} "
+                f'ORDER BY "{index}".rank, "{index}".rowid LIMIT ?',
+                params + [limit]).fetchall()
+        except sqlite3.OperationalError as e:
+            if deadline and 'interrupted' in str(e):
+                return [], True
+            raise
+        finally:
+            self.connection.set_progress_handler(None, 0)
+            self._lock.release()
+        hits = []
+        for id, fields, highlight in rows:
+            fields = json.loads(fields) if fields else {}
+            fields['highlight'] = highlight
+            hits.append((id, fields))
+        return hits, False
+
+
+def init_app(app):
+    """Set up the app's search backend (in `app.extensions['search']`). The
+    backend is `SEARCH_BACKEND` if it's set, otherwise Elasticsearch if there's
+    an `ELASTICSEARCH_URL`, otherwise SQLite.
+    """
+    app.config.setdefault('SEARCH_BACKEND', None)
+    app.config.setdefault('SEARCH_INDEX', ':memory:')
+    app.config.setdefault('SEARCH_WORKER', False)
+    app.config.setdefault('SEARCH_WORKER_INTERVAL', 5)
+    app.config.setdefault('SEARCH_QUEUE_BATCH_SIZE', 500)
+    app.config.setdefault('SEARCH_QUEUE_MAX_ATTEMPTS', 10)
+    app.config.setdefault('SEARCH_RESULTS_FROM_INDEX', False)
+    app.config.setdefault('SEARCH_CONTEXT_LINES', 1)
+    app.config.setdefault('SEARCH_PREFIX_LIMIT', 10)
+    app.config.setdefault('SEARCH_PREFIX_TIMEOUT', 0.25)
+    app.config.setdefault('SEARCH_PREFIX_CACHE_SIZE', 1024)
+    app.config.setdefault('SEARCH_PREFIX_CACHE_SECONDS', 30)
+    backend = app.config['SEARCH_BACKEND'] or\
+        ('elasticsearch' if app.config['ELASTICSEARCH_URL'] else 'sqlite')
+    if backend == 'elasticsearch':
+        app.extensions['search'] = (ElasticsearchBackend(app.elasticsearch) if
+                                    app.elasticsearch else None)
+    elif backend == 'sqlite':
+        app.extensions['search'] = SQLiteBackend(app.config['SEARCH_INDEX'])
+    else:
+        raise ValueError(f"There is no {backend} search backend.")
+    app.extensions['search_prefixes'] = PrefixCache(
+        app.config['SEARCH_PREFIX_CACHE_SIZE'],
+        app.config['SEARCH_PREFIX_CACHE_SECONDS'])
+    if app.config['SEARCH_WORKER'] and app.extensions['search']:
+        # not until the first request, so that it's started in every process
+        # that serves them (i.e., after gunicorn forks) and not before the app
+        # is all set up
+        app.before_first_request(lambda: start_index_worker(app))
+
+
+def search_backend():
+    """The app's search backend (or None if it doesn't have one)."""
+    return current_app.extensions.get('search')
+
+
+QueueStats = namedtuple('QueueStats', ['pending', 'failed', 'lag'])
+
+
+def index_queue_stats():
+    """How far behind the search index is.
+
+    Returns
+    -------
+    QueueStats
+        The number of operations pending (still to be tried), the number that
+        have given up (see `SEARCH_QUEUE_MAX_ATTEMPTS`) and never will be, and
+        the lag: how long, in seconds, the oldest pending operation has been
+        waiting (0 if there are none). The ones that have given up don't count
+        towards the lag, or it would only ever grow.
+    """
+    IndexOperation = models.search.IndexOperation
+    retryable = IndexOperation.attempts <\
+        current_app.config['SEARCH_QUEUE_MAX_ATTEMPTS']
+    pending, failed, oldest = db.session.query(
+        db.func.count(db.case([(retryable, IndexOperation.id)])),
+        db.func.count(db.case([(~retryable, IndexOperation.id)])),
+        db.func.min(db.case([(retryable, IndexOperation.queued)]))).one()
+    lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+    return QueueStats(pending, failed, lag)
+
+
+def drain_index_queue(batch_size=None):
+    """Send a batch of queued operations to the search backend and commit.
+
+    The operations are coalesced, so an object that was queued more than once
+    (e.g., a line edited twice) is only indexed once, as it is now, or removed
+    if the last thing that happened to it was a delete. If the backend fails
+    on an index, that index's operations are tried again later, backing off
+    exponentially, until they've failed `SEARCH_QUEUE_MAX_ATTEMPTS` times.
+
+    Returns
+    -------
+    int
+        The number of operations in the batch (i.e., 0 once the queue is
+        drained).
+    """
+    from icc import classes
+    IndexOperation = models.search.IndexOperation
+    backend = search_backend()
+    if not backend:
+        return 0
+    batch_size = batch_size or current_app.config['SEARCH_QUEUE_BATCH_SIZE']
+    max_attempts = current_app.config['SEARCH_QUEUE_MAX_ATTEMPTS']
+    now = datetime.utcnow()
+    ops = IndexOperation.query\
+        .filter(IndexOperation.retry_at<=now,
+                IndexOperation.attempts<max_attempts)\
+        .order_by(IndexOperation.id).limit(batch_size).all()
+    if not ops:
+        return 0
+
+    # the last operation on an object is the one that counts
+    latest = {}
+    for op in ops:
+        latest.setdefault(op.index_name, {})[op.entity_id] = op.op
+    searchable = {cls.__tablename__: cls for cls in classes.values() if
+                  isinstance(cls, type) and
+                  issubclass(cls, models.mixins.SearchableMixin) and
+                  hasattr(cls, '__table__')}
+    last_id = ops[-1].id
+    for index, entities in latest.items():
+        cls = searchable[index]
+        add = [id for id, op in entities.items() if op == 'add']
+        objs = cls.query.filter(cls.id.in_(add)).all() if add else []
+        # anything that's gone since it was queued gets removed
+        remove = set(entities) - {obj.id for obj in objs}
+        try:
+            if objs:
+                backend.bulk_index(index, objs)
+            if remove:
+                backend.bulk_remove(index, list(remove))
+        except Exception as e:
+            current_app.logger.warning(f"Indexing {index} failed: {e!r}")
+            for op in ops:
+                if op.index_name == index:
+                    op.attempts += 1
+                    op.error = repr(e)
+                    op.retry_at = now + timedelta(seconds=2**op.attempts)
+            continue
+        # including any older operations on the same objects that didn't make
+        # the batch
+        IndexOperation.query\
+            .filter(IndexOperation.index_name==index,
+                    IndexOperation.entity_id.in_(entities),
+                    IndexOperation.id<=last_id)\
+            .delete(synchronize_session=False)
+    db.session.commit()
+    return len(ops)
+
+
+def _index_worker(app, interval):
+    while True:
+        with app.app_context():
+            try:
+                while drain_index_queue():
+                    pass
+                stats = index_queue_stats()
+                if stats.pending:
+                    app.logger.info(f"Search index queue: {stats.pending} "
+                                    f"pending ({stats.failed} failed), "
+                                    f"{stats.lag:.1f}s behind.")
+            except Exception as e:
+                app.logger.exception(f"The search index worker failed: {e!r}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+        time.sleep(interval)
+
+
+def start_index_worker(app, interval=None):
+    """Drain the index queue in a background (daemon) thread, every `interval`
+    seconds (`SEARCH_WORKER_INTERVAL`).
+    """
+    interval = interval or app.config['SEARCH_WORKER_INTERVAL']
+    worker = threading.Thread(target=_index_worker, args=(app, interval),
+                              daemon=True, name='search-index-worker')
+    worker.start()
+    return worker
+
+
 def bulk_index(index, objs):
     """Add objects to the index in bulk."""
-    if not current_app.elasticsearch:
+    if not search_backend():
         return
-    if not current_app.elasticsearch.indices.exists(index):
-        current_app.elasticsearch.indices.create(index)
-    actions = []
-    for obj in objs:
-        payload = {}
-        for field in obj.__searchable__:
-            try:
-                data = getattr(obj, field)
-            except AttributeError:
-                print(obj)
-                print(obj.id)
-                raise AttributeError
-            payload[field] = (data.translate(
-                str.maketrans('', '', string.punctuation))
-                              if isinstance(data, str) else data)
-        actions.append(
-            {'_index': index, '_type': index,
-             '_id': obj.id, '_source': payload})
-    helpers.bulk(current_app.elasticsearch, actions)
+    search_backend().bulk_index(index, objs)
+
+
+ReindexStats = namedtuple('ReindexStats', ['count', 'seconds', 'rate'])
+
+
+def reindex(index, documents, chunk_size=1000, workers=1, progress=None):
+    """Stream documents into the index in chunks.
+
+    The documents are only pulled from the iterable as there's room for them,
+    so with a generator (e.g., :meth:`SearchableMixin.search_documents`) there
+    are never more than a few chunks of them in memory, no matter how big the
+    index is.
+
+    Parameters
+    ----------
+    index : str
+        The name of the index.
+    documents : iterable
+        The (id, fields) documents to index (see :func:`document`).
+    chunk_size : int
+        The number of documents sent to the backend at a time.
+    workers : int
+        The number of chunks sent at once (in a thread pool).
+    progress : callable
+        Called with the stats so far after every chunk (and by default, they're
+        logged).
+
+    Returns
+    -------
+    ReindexStats
+        The number of documents indexed, the seconds it took, and the
+        documents per second.
+    """
+    backend = search_backend()
+    if not backend:
+        return ReindexStats(0, 0., 0.)
+    logger = current_app.logger
+    if progress is None:
+        progress = lambda stats: logger.info(
+            f"Indexed {stats.count} {index}s ({stats.rate:.0f}/s).")
+    documents = iter(documents)
+    start = time.perf_counter()
+    count = 0
+
+    def stats():
+        seconds = time.perf_counter() - start
+        return ReindexStats(count, seconds, count / seconds if seconds else 0.)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        while True:
+            chunk = list(islice(documents, chunk_size))
+            if chunk:
+                pending.append((pool.submit(backend.index_documents, index,
+                                            chunk), len(chunk)))
+            # wait for the oldest chunk once the pool is full (or at the end)
+            while pending and (len(pending) > workers or not chunk):
+                future, size = pending.popleft()
+                future.result()
+                count += size
+                progress(stats())
+            if not chunk:
+                break
+    return stats()
 
 
 def add_to_index(index, model):
     """Add an object to the index for that object."""
-    if not current_app.elasticsearch:
+    if not search_backend():
         return
-    if not current_app.elasticsearch.indices.exists(index):
-        current_app.elasticsearch.indices.create(index)
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id,
-                                    body=payload)
+    search_backend().add_to_index(index, model)
 
 
 def remove_from_index(index, model):
     """Remove the object from the index."""
-    if not current_app.elasticsearch:
+    if not search_backend():
         return
-    if not current_app.elasticsearch.indices.exists(index):
-        current_app.elasticsearch.indices.create(index)
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    search_backend().remove_from_index(index, model)
 
 
-def query_index(index, query, page, per_page):
-    """Search the index."""
-    if not current_app.elasticsearch:
+def query_index(index, query, page, per_page, source=False, context=None):
+    """Search the index (see :meth:`SearchBackend.query`)."""
+    if not search_backend():
         return [], 0
-    body = {
-        'query': {'multi_match':
-                  {'query': query, 'fields': ['body']}
-                  },
-        'from': (page - 1) * per_page,
-        'size': per_page}
+    return search_backend().query(index, query, page, per_page, source=source,
+                                  context=context)
 
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index, body=body)
 
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']
+def query_lines(field, query, page, per_page, source=False):
+    """Search lines within a given object (text, writer, edition). The lines
+    come back as :meth:`Line.hits`.
+    """
+    Line = models.content.Line # Hack to avoid circular import
+    if not search_backend():
+        return Line.hits([]), 0
+    hits, total = search_backend().query(
+        'line', query, page, per_page, {f'{field.__tablename__}_id': field.id},
+        source=source, context=Line.search_context() if source else None)
+    return Line.hits(hits), total
 
 
-def query_lines(field, query, page, per_page):
-    """Search lines within a given object (text, writer, edition)"""
-    if not current_app.elasticsearch:
-        return [], 0
-    Line = models.content.Line # Hack to avoid circular import
-    body = {'query':
-            {'bool':
-             {'must':
-              [
-                  {'match': {f'{field.__tablename__}_id': field.id}},
-                  {'match': {'body': query}}
-              ]
-              }
-             },
-            'from': (page - 1) * per_page, 'size': per_page
-            }
-    search = current_app.elasticsearch.search(index='line', doc_type='line',
-                                              body=body)
-
-    total = search['hits']['total']
-    if isinstance(total, dict):
-        total = total.get('value', 0)
-    if total == 0:
-        return Line.query.filter_by(id=0), 0
-
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    when = []
-    when = [(ids[i], i) for i in range(len(ids))]
-
-    return Line.query.filter(Line.id.in_(ids))\
-        .order_by(db.case(when, value=Line.id)).all(), total
+def query_prefix(index, query, filters=None):
+    """Search the index as the query is typed (see
+    :meth:`SearchBackend.prefix_query`), with the app's `SEARCH_PREFIX_LIMIT`
+    and `SEARCH_PREFIX_TIMEOUT`. Recent prefixes are answered from the cache.
+
+    Returns
+    -------
+    tuple
+        The hits and whether the search ran out of time.
+    """
+    if not search_backend():
+        return [], False
+    # the same words are the same search, however they're typed
+    words = ' '.join(re.findall(r'\w+', query.lower()))
+    if not words:
+        return [], False
+    key = (index, words, tuple(sorted((filters or {}).items())))
+    cache = current_app.extensions['search_prefixes']
+    cached = cache.get(key)
+    if cached is not None:
+        return cached, False
+    hits, timed_out = search_backend().prefix_query(
+        index, words, current_app.config['SEARCH_PREFIX_LIMIT'], filters,
+        timeout=current_app.config['SEARCH_PREFIX_TIMEOUT'])
+    # (running out of time isn't an answer, so it isn't kept)
+    if not timed_out:
+        cache.set(key, hits)
+    return hits, timed_out
@@ -6,7 +6,10 @@ from flask_login import current_user, login_required
 from sqlalchemy import and_
 
 from icc import db
+from icc.cards import AnnotationCards
+from icc.enums import enums
 from icc.funky import generate_next
+from icc.pagination import keyset_paginate
 from icc.user import user
 
 from icc.models.annotation import Annotation, Edit
@@ -52,7 +55,7 @@ def index():
 def profile(user_id):
     """A user profile."""
     user = User.query.get_or_404(user_id)
-    userflags = UserFlag.enum_cls.query.all()
+    userflags = enums.all(UserFlag.enum_cls)
     return render_template('view/user.html', title=f"User {user.displayname}",
                            userflags=userflags, user=user)
 
@@ -76,36 +79,42 @@ def user_annotations(user_id):
     default = 'newest'
     sort = request.args.get('sort', default, type=str)
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None, type=str)
     user = User.query.get_or_404(user_id)
 
     sorts = {
-        'newest': user.annotations.order_by(Annotation.timestamp.desc()),
-        'oldest': user.annotations.order_by(Annotation.timestamp.asc()),
-        'modified': (user.annotations.join(Edit)
-                     .filter(Edit.current==True)
-                     .order_by(Edit.timestamp.desc())),
-        'weight': user.annotations.order_by(Annotation.weight.desc()),
+        'newest': (user.annotations, (Annotation.timestamp.desc(),
+                                      Annotation.id.desc())),
+        'oldest': (user.annotations, (Annotation.timestamp.asc(),
+                                      Annotation.id.asc())),
+        'modified': (user.annotations, (Annotation.modified_at.desc(),
+                                        Annotation.id.desc())),
+        'weight': (user.annotations, (Annotation.weight.desc(),
+                                      Annotation.id.desc()))
     }
 
     sort = sort if sort in sorts else default
-    annotations = sorts[sort].filter(Annotation.active==True)\
-        .paginate(page, current_app.config['ANNOTATIONS_PER_PAGE'], False)
+    query, order = sorts[sort]
+    annotations = keyset_paginate(query.filter(Annotation.active==True), order,
+                                  current_app.config['ANNOTATIONS_PER_PAGE'],
+                                  cursor=cursor, page=page)
     if not annotations.items and page > 1:
         abort(404)
 
     sorturls = {key: url_for('user.user_annotations', user_id=user_id,
                              page=page, sort=key) for key in sorts.keys()}
     next_page = (url_for('user.user_annotations', user_id=user_id, sort=sort,
-                         page=annotations.next_num) if annotations.has_next else
-                 None)
+                         cursor=annotations.next_cursor)
+                 if annotations.has_next else None)
     prev_page = (url_for('user.user_annotations', user_id=user_id, sort=sort,
-                         page=annotations.prev_num) if annotations.has_prev else
-                 None)
+                         cursor=annotations.prev_cursor)
+                 if annotations.has_prev else None)
+    cards = AnnotationCards([a.id for a in annotations.items], current_user)
     return render_template('indexes/annotation_list.html',
                            title=f"{user.displayname} - Annotations",
                            next_page=next_page, prev_page=prev_page,
                            sorts=sorturls, sort=sort,
-                           annotations=annotations.items)
+                           annotations=cards.annotations, cards=cards)
 
 
 @user.route('/<user_id>/reputation')
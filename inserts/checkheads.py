@@ -0,0 +1,73 @@
+"""Check that the HEAD columns denormalized onto the annotations (head_id,
+first_line_num, last_line_num, modified_at) agree with the edits flagged
+current, and optionally fix the ones that don't.
+"""
+import sys
+import argparse
+
+sys.path.insert(1, '../icc')
+
+from icc import db, create_app
+from icc.models.annotation import Annotation, Edit
+
+
+def find_problems():
+    """Return a list of tuples of the annotations that are out of sync, their
+    current edit (or None), and a description of the problem.
+    """
+    problems = []
+    currents = db.session.query(Edit.entity_id, db.func.count(Edit.id))\
+        .filter(Edit.current==True).group_by(Edit.entity_id)
+    counts = {annotation_id: cnt for annotation_id, cnt in currents}
+    for annotation in Annotation.query.yield_per(1000):
+        cnt = counts.get(annotation.id, 0)
+        if cnt != 1:
+            edit = annotation.history.order_by(Edit.num.desc()).first()
+            problems.append((annotation, edit,
+                             f"{cnt} current edits"))
+            continue
+        edit = annotation.all_edits.filter(Edit.current==True).first()
+        if annotation.head_id != edit.id:
+            problems.append((annotation, edit,
+                             f"head_id {annotation.head_id} is not {edit.id}"))
+        elif (annotation.first_line_num != edit.first_line_num
+              or annotation.last_line_num != edit.last_line_num):
+            problems.append((annotation, edit,
+                             f"lines {annotation.first_line_num}-"
+                             f"{annotation.last_line_num} are not "
+                             f"{edit.first_line_num}-{edit.last_line_num}"))
+        elif annotation.modified_at != edit.timestamp:
+            problems.append((annotation, edit,
+                             f"modified_at {annotation.modified_at} is not "
+                             f"{edit.timestamp}"))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Check that the annotations' HEAD columns agree with their edits.")
+    parser.add_argument('-f', '--fix', action='store_true',
+                        help="Make the current edit (or the latest approved "
+                        "edit if there isn't exactly one) HEAD.")
+    parser.add_argument('-d', '--dryrun', action='store_true',
+                        help="Flag for a dry run test.")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        problems = find_problems()
+        for annotation, edit, problem in problems:
+            print(f"{annotation}: {problem}")
+            if args.fix and edit:
+                for e in annotation.all_edits.filter(Edit.current==True):
+                    e.current = False
+                annotation.set_head(edit)
+        print(f"{len(problems)} annotations out of sync.")
+        if args.fix and not args.dryrun:
+            db.session.commit()
+            print("Fixed.")
+        sys.exit(1 if problems and not args.fix else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Drain the search index queue (see icc/search.py). Run it once to catch the
+index up, or with --forever in place of the SEARCH_WORKER thread (e.g., when
+there's more than one app process).
+"""
+import sys
+import time
+import argparse
+
+sys.path.insert(1, '../icc')
+
+from icc import db, create_app
+from icc.search import drain_index_queue, index_queue_stats
+
+
+def print_stats():
+    stats = index_queue_stats()
+    print(f"{stats.pending} pending ({stats.failed} failed), "
+          f"{stats.lag:.1f}s behind.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Send the queued search index operations to the search backend.")
+    parser.add_argument('-b', '--batch_size', action='store', type=int,
+                        help="The number of operations per batch. Defaults to "
+                        "SEARCH_QUEUE_BATCH_SIZE.")
+    parser.add_argument('-f', '--forever', action='store_true',
+                        help="Keep draining the queue as it fills.")
+    parser.add_argument('-i', '--interval', action='store', type=float,
+                        default=5, help="The seconds to wait between checks "
+                        "of the queue with --forever.")
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help="Only print how far behind the index is.")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.stats:
+            print_stats()
+            return
+        while True:
+            cnt = 0
+            while True:
+                batch = drain_index_queue(args.batch_size)
+                if not batch:
+                    break
+                cnt += batch
+            if cnt:
+                print(f"Indexed {cnt} operations.")
+                print_stats()
+            if not args.forever:
+                break
+            db.session.remove()
+            time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
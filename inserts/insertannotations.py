@@ -1,29 +1,42 @@
-"""Parse annotations from json file into the prepopulated database."""
+"""Parse annotations from json file into the prepopulated database.
+
+The annotations say which line they're on by it's body, not it's num. The lines
+of the edition are read once into a map from their (normalized) bodies to where
+they are, every annotation is looked up in that, and then they're all inserted
+in bulk. The lines that can't be found, or that are in the edition more than
+once, are reported.
+"""
 import sys
 import argparse
 import json
 import os
+import unicodedata
+from collections import namedtuple, defaultdict
+from datetime import datetime
 
 sys.path.insert(1, '../icc')
 
 from icc import db, create_app
 from icc.models.content import Line, Text
 from icc.models.user import User
-from icc.models.annotation import Annotation, Tag
+from icc.models.annotation import (Annotation, Edit, AnnotationRange, Tag,
+                                   Comment)
+from icc.models.tables import tags as tags_table
 
 
 def get_community():
     community = User.query.filter_by(displayname='community').first()
-    if not community and __name__ == ' __main__':
+    if not community and __name__ == '__main__':
         sys.exit("The Community user hasn't been created in the database yet.")
     return community
 
 
 def get_tags(annotator):
     original_tag = Tag.query.filter_by(tag='original').first()
-    annotator_tag = Tag.query.filter_by(tag=annotator).first()
+    name = annotator.lower().replace(' ', '-')
+    annotator_tag = Tag.query.filter_by(tag=name).first()
     if annotator_tag is None:
-        annotator_tag = Tag(tag=annotator.lower().replace(' ', '-'),
+        annotator_tag = Tag(tag=name,
                             description="Original annotations from "
                             f"[[Writer:{annotator}]]")
         db.session.add(annotator_tag)
@@ -32,40 +45,172 @@ def get_tags(annotator):
 
 def get_edition(title, num):
     text = Text.query.filter_by(title=title).first()
+    if not text:
+        sys.exit(f"The text {title} was not found.")
     edition = text.editions.filter_by(num=num).first()
-    if __name__ == '__main__':
-        if not text:
-            parser.error(f"The text {title} was not found.")
-        if not edition:
-            parser.error(f"The edition number {edition_num} was not found for "
-                         f"{text.title}")
+    if not edition:
+        sys.exit(f"The edition number {num} was not found for {text.title}.")
     return edition
 
 
-def populate_annotations(title, edition_num, annotator, annotations):
-    community = get_community()
-    print(community)
-    tags = get_tags(annotator)
-    edition = get_edition(title, edition_num)
+def normalize(body):
+    """Normalize a line's body for matching: the same unicode form, no
+    emphasis underscores, and all whitespace collapsed to single spaces.
+    """
+    body = unicodedata.normalize('NFC', body).replace('_', '')
+    return ' '.join(body.split())
+
+
+def get_lines(edition):
+    """Map the normalized body of every line of the edition to where it is, a
+    list of (num, toc_id)'s in order (more than one if the line's repeated).
+    """
+    lines = defaultdict(list)
+    qry = db.session.query(Line.body, Line.num, Line.toc_id)\
+        .filter(Line.edition_id==edition.id).order_by(Line.num)
+    for body, num, toc_id in qry.yield_per(5000):
+        lines[normalize(body)].append((num, toc_id))
+    return lines
 
-    cnt = 0
+
+Matches = namedtuple('Matches', ['matched', 'ambiguous', 'unmatched'])
+
+
+def match_lines(annotations, lines):
+    """Find the line of each annotation in the map from :func:`get_lines`.
+
+    Returns
+    -------
+    Matches
+        The (annotation, num, toc_id)'s of the annotations that were found, the
+        (annotation, nums)'s of those whose line is in the edition more than
+        once (they're matched to the first), and the annotations whose line
+        isn't in the edition at all.
+    """
+    matched, ambiguous, unmatched = [], [], []
     for annotation in annotations:
-        line = Line.query.filter_by(body=annotation['line']).first()
+        found = lines.get(normalize(annotation['line']))
+        if not found:
+            unmatched.append(annotation)
+            continue
+        if len(found) > 1:
+            ambiguous.append((annotation, [num for num, _ in found]))
+        matched.append((annotation, *found[0]))
+    return Matches(matched, ambiguous, unmatched)
 
-        if not line:
-            db.session.rollback()
-            sys.exit(f"Fail on {cnt}: {annotation}")
 
-        annotation = Annotation(edition=edition, annotator=community,
-                                fl=line.num, ll=line.num, fc=0, lc=-1,
-                                toc=line.toc, body=annotation['annotation'],
-                                tags=tags)
-        db.session.add(annotation)
+def bulk_insert_annotations(annotator, annotations):
+    """Insert the annotations with Core inserts, each with it's initial
+    :class:`Edit`, tags, :class:`AnnotationRange`, and comments, the same rows
+    as `Annotation(...)` (and appending `Comment`'s to it) makes.
+
+    Like :func:`insertlines.bulk_populate_lines`, the ids are given out here
+    (from the highest in the database), so don't run this alongside anything
+    else that makes annotations.
 
-        cnt += 1
-        if cnt % 25 == 0 and __name__ == '__main__':
-            print(cnt)
-    return cnt
+    Parameters
+    ----------
+    annotator : :class:`User`
+        The annotator of all of them (and the poster of all the comments).
+    annotations : list
+        The dicts of the annotations: their `edition_id`, `toc_id`, `fl`, `ll`,
+        `fc`, `lc`, `body`, and `tag_ids`, and optionally whether they're
+        `locked` and their `comments` (dicts of their `id`, `parent_id`,
+        `depth`, `weight`, and `body`; the ids are only used to link the
+        comments to their parents, they get new ones).
+
+    Returns
+    -------
+    int
+        The number of annotations inserted.
+    """
+    if not annotations:
+        return 0
+    db.session.flush()
+    now = datetime.utcnow()
+
+    def next_id(cls):
+        return (db.session.query(db.func.max(cls.id)).scalar() or 0) + 1
+    next_annotation, next_edit = next_id(Annotation), next_id(Edit)
+    next_comment = next_id(Comment)
+
+    rows, edits, tag_rows, ranges, comments = [], [], [], [], []
+    for i, annotation in enumerate(annotations):
+        annotation_id, edit_id = next_annotation + i, next_edit + i
+        fl, ll = sorted((annotation['fl'], annotation['ll']))
+        rows.append({
+            'id': annotation_id, 'annotator_id': annotator.id,
+            'edition_id': annotation['edition_id'],
+            'locked': annotation.get('locked', False), 'active': True,
+            'weight': 0, 'timestamp': now, 'modified_at': now,
+            'first_line_num': fl, 'last_line_num': ll})
+        edits.append({
+            'id': edit_id, 'entity_id': annotation_id,
+            'edition_id': annotation['edition_id'],
+            'toc_id': annotation['toc_id'], 'editor_id': annotator.id,
+            'num': 0, 'current': True, 'approved': True, 'rejected': False,
+            'weight': 0, 'reason': "initial version", 'timestamp': now,
+            'first_line_num': fl, 'last_line_num': ll,
+            'first_char_idx': annotation['fc'],
+            'last_char_idx': annotation['lc'], 'body': annotation['body']})
+        tag_rows.extend({'tag_id': tag_id, 'edit_id': edit_id}
+                        for tag_id in annotation['tag_ids'])
+        ranges.extend({'annotation_id': annotation_id,
+                       'edition_id': annotation['edition_id'],
+                       'bucket': bucket, 'first_line_num': fl,
+                       'last_line_num': ll}
+                      for bucket in AnnotationRange.buckets(fl, ll))
+        ids = {}
+        for comment in sorted(annotation.get('comments', []),
+                              key=lambda c: c['id']):
+            ids[comment['id']] = next_comment
+            comments.append({
+                'id': next_comment, 'annotation_id': annotation_id,
+                'poster_id': annotator.id,
+                'parent_id': ids.get(comment['parent_id']),
+                'depth': comment['depth'], 'weight': comment['weight'],
+                'body': comment['body'], 'timestamp': now})
+            next_comment += 1
+
+    # the annotations and their edits point at each other, so the annotations
+    # go in without their heads and get them after the edits are in
+    db.session.execute(Annotation.__table__.insert(), rows)
+    db.session.execute(Edit.__table__.insert(), edits)
+    table = Annotation.__table__
+    db.session.execute(
+        table.update().where(table.c.id==db.bindparam('annotation_id'))
+        .values(head_id=db.bindparam('edit_id')),
+        [{'annotation_id': edit['entity_id'], 'edit_id': edit['id']}
+         for edit in edits])
+    if tag_rows:
+        db.session.execute(tags_table.insert(), tag_rows)
+    db.session.execute(AnnotationRange.__table__.insert(), ranges)
+    if comments:
+        db.session.execute(Comment.__table__.insert(), comments)
+    return len(rows)
+
+
+def populate_annotations(title, edition_num, annotator, annotations):
+    """Insert the annotations on the lines they match in the edition. Return
+    the :class:`Matches`.
+    """
+    community = get_community()
+    tags = get_tags(annotator)
+    edition = get_edition(title, edition_num)
+
+    matches = match_lines(annotations, get_lines(edition))
+    for annotation, nums in matches.ambiguous:
+        print(f"Ambiguous: \"{annotation['line']}\" is lines {nums}, using "
+              f"{nums[0]}.")
+    for annotation in matches.unmatched:
+        print(f"Unmatched: \"{annotation['line']}\" isn't in {edition}.")
+    db.session.flush()
+    bulk_insert_annotations(community, [
+        {'edition_id': edition.id, 'toc_id': toc_id, 'fl': num, 'll': num,
+         'fc': 0, 'lc': -1, 'body': annotation['annotation'],
+         'tag_ids': [tag.id for tag in tags]}
+        for annotation, num, toc_id in matches.matched])
+    return matches
 
 
 def main():
@@ -86,14 +231,24 @@ def main():
                         "form of a tag (i.e., no spaces)")
     parser.add_argument('-d', '--dryrun', action='store_true',
                         help="Flag for a dry run test.")
+    parser.add_argument('-s', '--skip-unmatched', action='store_true',
+                        help="Commit the annotations that were matched even if "
+                        "some weren't (otherwise nothing is committed).")
     args = parser.parse_args()
     app = create_app()
     fin = open(args.fin, 'rt') if args.fin else sys.stdin.buffer
     annotations = json.load(fin)
 
     with app.app_context():
-        cnt = populate_annotations(args.title, args.edition_num, args.annotator,
-                                   annotations)
+        matches = populate_annotations(args.title, args.edition_num,
+                                       args.annotator, annotations)
+        cnt = len(matches.matched)
+        print(f"{cnt} matched, {len(matches.ambiguous)} ambiguous, "
+              f"{len(matches.unmatched)} unmatched.")
+        if matches.unmatched and not args.skip_unmatched:
+            db.session.rollback()
+            sys.exit(f"{len(matches.unmatched)} annotations weren't matched, "
+                     "nothing committed (see --skip-unmatched).")
         if not args.dryrun:
             print(f"{cnt} annotations added.")
             print("Now committing...")
@@ -111,4 +266,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
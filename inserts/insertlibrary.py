@@ -0,0 +1,247 @@
+"""Populate a whole library of texts at once, instead of one `insertlines.py`
+(and one app, and one commit, and one reindex) per edition.
+
+Every directory with a `meta.yml` under the paths is an edition. They're loaded
+concurrently, each by a worker process with its own app (and so it's own
+database connection) and in it's own transaction, so one bad edition (one that
+can't be read, or can't be inserted) doesn't take the rest with it. The things the editions share are made once, up front,
+by this process:
+
+- the texts, writers, and line and toc enums, so the workers only ever look
+  them up and never race each other to create them;
+- the toc ids. The bulk loader numbers the tocs itself (see
+  :func:`bulk_populate_lines`), so each edition gets it's own block of ids,
+  counted in the first pass over the lines.
+
+The lines aren't queued for the index as they're inserted. Once they're all in,
+they're indexed in one pass.
+
+This needs a database that more than one process can connect to (i.e., not an
+in-memory SQLite database). With a SQLite file, the workers take turns
+writing, so the parallelism is only in reading and parsing the lines.
+"""
+import sys
+import os
+import time
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(1, '../icc')
+
+from icc import db, create_app
+from icc.search import reindex
+from icc.models.content import (Text, Line, TOC, Writer, WRITERS_REVERSE)
+from config import Config
+
+from inserts.insertlines import (get_text, get_edition, add_writer_connections,
+                                 bulk_populate_lines, parse_files, read_lines,
+                                 print_progress)
+
+
+Scan = namedtuple('Scan', ['path', 'meta', 'line_enums', 'toc_enums', 'tocs',
+                           'lines'])
+
+
+def find_editions(paths):
+    """Find the editions at the paths: any path with a `meta.yml` is one,
+    otherwise it's searched for directories with `meta.yml`'s (which aren't
+    searched any further).
+    """
+    editions = []
+    for path in paths:
+        path = path.rstrip('/')
+        if os.path.exists(f'{path}/meta.yml'):
+            editions.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            if 'meta.yml' in files:
+                editions.append(root)
+                dirs.clear()
+    return editions
+
+
+def scan(path):
+    """Read the edition at the path without inserting anything: it's meta, the
+    names of the enums of it's lines and tocs, and how many of each there are.
+    """
+    meta, lines = parse_files(path)
+    line_enums, toc_enums = set(), set()
+    tocs = count = 0
+    for line in lines:
+        if 'precedence' in line:
+            toc_enums.add(line['enum'])
+            tocs += 1
+        else:
+            line_enums.add(line['enum'])
+            count += 1
+    return Scan(path, meta, line_enums, toc_enums, tocs, count)
+
+
+def prepare(scans):
+    """Create everything the editions share (see the module docstring) and
+    commit it. Return the id of the first toc of each edition, by path.
+    """
+    for cls, names in [
+            (Line.enum_cls, set().union(*[s.line_enums for s in scans])),
+            (TOC.enum_cls, set().union(*[s.toc_enums for s in scans]))]:
+        existing = {enum.enum for enum in cls.query}
+        for name in sorted(names - existing):
+            db.session.add(cls(enum=name))
+            print(f"Created {cls.__name__} {name}.")
+
+    writers = {writer.name for writer in Writer.query}
+    texts = {text.title for text in Text.query}
+    for s in scans:
+        if s.meta['title'] not in texts:
+            db.session.add(Text(title=s.meta['title'],
+                                sort_title=s.meta['sort_title'],
+                                published=s.meta['publication_date'],
+                                description=s.meta['description']))
+            texts.add(s.meta['title'])
+            print(f"Created text {s.meta['title']}.")
+        for role in WRITERS_REVERSE:
+            for writer in s.meta['edition'][role]:
+                if writer['name'] not in writers:
+                    db.session.add(Writer(**writer))
+                    writers.add(writer['name'])
+                    print(f"Created writer {writer['name']}.")
+
+    next_id = (db.session.query(db.func.max(TOC.id)).scalar() or 0) + 1
+    first_toc_ids = {}
+    for s in scans:
+        first_toc_ids[s.path] = next_id
+        next_id += s.tocs
+    db.session.commit()
+    return first_toc_ids
+
+
+def start_worker(config_class):
+    """Give the worker process it's own app (and so it's own connection)."""
+    app = create_app(config_class)
+    app.app_context().push()
+
+
+def load(path, meta, first_toc_id, batch_size=5000):
+    """Insert the edition at the path (in the worker). Return the edition's id
+    and the :class:`InsertStats` of it's lines.
+    """
+    try:
+        text = get_text(meta)
+        edition = get_edition(meta['edition'], text)
+        add_writer_connections(meta, edition)
+        stats = bulk_populate_lines(read_lines(path), edition,
+                                    batch_size=batch_size,
+                                    first_toc_id=first_toc_id, queue=False)
+        db.session.commit()
+        return edition.id, stats
+    except:
+        db.session.rollback()
+        raise
+
+
+def populate_library(paths, workers=None, batch_size=5000, noindex=False,
+                     config_class=Config):
+    """Insert all the editions at the paths, `workers` at a time, and then
+    index all their lines.
+
+    Parameters
+    ----------
+    paths : list
+        The edition directories, or directories to find them in.
+    workers : int
+        The number of worker processes (default: one per cpu).
+    batch_size : int
+        The number of lines each worker inserts at a time.
+    noindex : bool
+        Don't index the lines.
+    config_class : class
+        The config the workers create their apps with (it has to be the same
+        database as this app's).
+
+    Returns
+    -------
+    tuple
+        The ids of the editions inserted, and the paths of the ones that
+        failed (to be read or inserted), with their exceptions.
+    """
+    paths = find_editions(paths)
+    print(f"Found {len(paths)} editions.")
+    start = time.perf_counter()
+
+    # the workers get their own connections, they can't share ours
+    db.session.remove()
+    db.engine.dispose()
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker,
+                             initargs=(config_class,)) as pool:
+        futures = {pool.submit(scan, path): path for path in paths}
+        scanned = {}
+        failed = []
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                scanned[path] = future.result()
+            except Exception as e:
+                failed.append((path, e))
+                print(f"Failed to read {path}: {e!r}")
+        scans = [scanned[path] for path in paths if path in scanned]
+        first_toc_ids = prepare(scans)
+        db.session.remove()
+        db.engine.dispose()
+
+        futures = {pool.submit(load, s.path, s.meta, first_toc_ids[s.path],
+                               batch_size): s for s in scans}
+        editions = []
+        for future in as_completed(futures):
+            s = futures[future]
+            try:
+                edition_id, stats = future.result()
+            except Exception as e:
+                failed.append((s.path, e))
+                print(f"Failed to insert {s.path}: {e!r}")
+                continue
+            editions.append(edition_id)
+            print(f"Inserted {stats.count} lines from {s.path} in "
+                  f"{stats.seconds:.1f}s ({stats.rate:.0f}/s).")
+
+    count = sum(s.lines for s in scans if s.path not in dict(failed))
+    seconds = time.perf_counter() - start
+    print(f"Inserted {count} lines from {len(editions)} editions in "
+          f"{seconds:.1f}s ({count / seconds:.0f}/s).")
+
+    if editions and not noindex:
+        print("Reindexing...")
+        qry = Line.query.filter(Line.edition_id.in_(editions))
+        stats = reindex(Line.__tablename__, Line.search_documents(qry),
+                        progress=print_progress)
+        print(f"\nDone. Indexed {stats.count} lines in {stats.seconds:.1f}s "
+              f"({stats.rate:.0f}/s).")
+    return editions, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        "Insert a library of texts into the icc database in parallel.")
+    parser.add_argument('paths', action='store', type=str, nargs='+',
+                        help="The edition directories (containing meta.yml and "
+                        "lines.json or lines.jsonl), or directories to find "
+                        "them in.")
+    parser.add_argument('-w', '--workers', action='store', type=int,
+                        default=None,
+                        help="The number of worker processes (default: one "
+                        "per cpu).")
+    parser.add_argument('-b', '--batch-size', action='store', type=int,
+                        default=5000,
+                        help="The number of lines to insert at a time.")
+    parser.add_argument('--noindex', action='store_true', default=False,
+                        help="Don't index the lines.")
+
+    args = parser.parse_args()
+
+    app = create_app()
+
+    with app.app_context():
+        _, failed = populate_library(args.paths, args.workers,
+                                     args.batch_size, args.noindex)
+    sys.exit(1 if failed else 0)
@@ -1,19 +1,28 @@
 """Populate the text, authors, edition, writer connections, and lines for a
-text. Requires a `meta.yml` file.
+text. Requires a `meta.yml` file, and the lines in either `lines.jsonl` (one
+json object per line, see `tojsonl.py`) or `lines.json` (a json array). Either
+way they're read one at a time, so the size of the text doesn't matter.
 """
 import pdb
 import sys
 import os
 import io
+import time
 import argparse
 import yaml
 import json
+from collections import namedtuple
+from datetime import datetime
+from types import SimpleNamespace
 
 sys.path.insert(1, '../icc')
 
 from icc import db, create_app
+from icc.search import search_backend
 from icc.models.content import (Text, Edition, Line, TOC, WriterConnection,
-                                Writer, WRITERS_REVERSE)
+                                Writer, WRITERS_REVERSE, EMPHASIS,
+                                underscores_to_ems)
+from icc.models.search import IndexOperation
 
 
 def get_text(meta):
@@ -23,7 +32,7 @@ def get_text(meta):
     text = Text.query.filter_by(title=meta['title']).first()
     if text:
         print(f"Found {text.title} in the database.")
-        if meta['edition']['primary']:
+        if meta['edition']['primary'] and text.primary:
             print("Deactivating previous primary {text.primary}.")
             deactivate_previous_primary(text)
     else:
@@ -86,25 +95,30 @@ def add_writer_connections(meta, edition):
                 print(f"Added {writer_obj.name} as {value}.")
 
 
+def find_parent(precedence, lasttoc):
+    """Find the parent of a new toc of the precedence from the lasttoc (anything
+    with a precedence and a parent will do, so this works for the bulk loader's
+    rows too).
+    """
+    if not lasttoc:
+        return None
+    if precedence == lasttoc.precedence:
+        # the new toc is the same level as the lasttoc
+        return lasttoc.parent
+    elif precedence > lasttoc.precedence:
+        # the new toc is deeper in precedence than the lasttoc
+        return lasttoc
+    # the new toc is higher than the lasttoc
+    while lasttoc.precedence > precedence:
+        lasttoc = lasttoc.parent
+    return None if lasttoc.precedence == 1 else lasttoc.parent
+
+
 def addtoc(line, lasttoc, tocenums, edition):
     """Process a toc."""
     enum = line.pop('enum')
     enum = tocenums[enum] if enum in tocenums else TOC.enum_cls(enum=enum)
-
-    if lasttoc:
-        if line['precedence'] == lasttoc.precedence:
-            # the new toc is the same level as the lasttoc
-            parent = lasttoc.parent
-        elif line['precedence'] > lasttoc.precedence:
-            # the new toc is deeper in precedence than the lasttoc
-            parent = lasttoc
-        else:
-            # the new toc is higher than the lasttoc
-            while lasttoc.precedence > line['precedence']:
-                lasttoc = lasttoc.parent
-            parent = None if lasttoc.precedence == 1 else lasttoc.parent
-    else:
-        parent = None
+    parent = find_parent(line['precedence'], lasttoc)
     toc = TOC(**line, enum=enum, edition=edition, parent=parent)
     return toc
 
@@ -112,11 +126,17 @@ def addtoc(line, lasttoc, tocenums, edition):
 def populate_lines(lines, edition):
     """Populate the database with the lines and their attributes. Return the
     count of lines added to the database.
+
+    This is the old ORM way, one object per line (see
+    :func:`bulk_populate_lines` for the fast way). The lines can be a
+    generator (see :func:`read_lines`), and they're flushed and let go of
+    every 1000, so the session doesn't grow with the size of the text.
     """
     lineenums = {enum.enum: enum for enum in Line.enum_cls.query.all()}
     tocenums = {enum.enum: enum for enum in TOC.enum_cls.query.all()}
     lasttoc = None
     tocs = []
+    i = 0
 
     for i, line in enumerate(lines):
         if 'precedence' in line:
@@ -124,8 +144,9 @@ def populate_lines(lines, edition):
             db.session.add(lasttoc)
         else:
             enum = line.pop('enum')
-            enum = (lineenums[enum] if enum in lineenums else
-                    Line.enum_cls(enum=enum))
+            if enum not in lineenums:
+                lineenums[enum] = Line.enum_cls(enum=enum)
+            enum = lineenums[enum]
             if not lasttoc.haslines:
                 lasttoc.haslines = True
             lineobj = Line(**line, enum=enum, toc=lasttoc, edition=edition)
@@ -138,25 +159,266 @@ def populate_lines(lines, edition):
 
         if i % 1000 == 0:
             print(i)
+            # the lines are only ever reached through queries (toc.lines and
+            # edition.lines are dynamic), so once they're in the database the
+            # session doesn't need them
+            db.session.flush()
+            for obj in [obj for obj in db.session if isinstance(obj, Line)]:
+                db.session.expunge(obj)
 
     return i
 
 
+InsertStats = namedtuple('InsertStats', ['count', 'seconds', 'rate'])
+
+
+def get_enum_ids(cls):
+    """A function that returns the id of the enum of the class with that name,
+    creating it the first time it's asked for if it doesn't exist yet.
+    """
+    ids = {enum.enum: enum.id for enum in cls.query}
+
+    def get(name):
+        if name not in ids:
+            enum = cls(enum=name)
+            db.session.add(enum)
+            db.session.flush()
+            ids[name] = enum.id
+        return ids[name]
+    return get
+
+
+def bulk_populate_lines(lines, edition, batch_size=5000, progress=None,
+                        first_toc_id=None, queue=True):
+    """Populate the database with the lines and their tocs like
+    :func:`populate_lines`, but with Core inserts, `batch_size` rows at a time,
+    instead of an ORM object per line. `lines` can be any iterable (e.g.,
+    :func:`stream_json`), and only the current batch and the tocs above the
+    current one are ever in memory.
+
+    The tocs' parents and prevs have to be known before they're inserted, so
+    the tocs are given their ids here (from the highest toc id in the
+    database, unless they're given a `first_toc_id`). Don't run this alongside
+    anything else that makes tocs, unless the ids it will use are reserved
+    for it (see `insertlibrary.py`).
+
+    Parameters
+    ----------
+    lines : iterable
+        The dicts of the tocs and lines, in order.
+    edition : Edition
+        The edition they're in (it's flushed if it hasn't been).
+    batch_size : int
+        The number of lines (or tocs) inserted at a time.
+    progress : function
+        Called with the :class:`InsertStats` so far after every batch of lines
+        is written.
+    first_toc_id : int
+        The id of the first toc. The rest are numbered up from it.
+    queue : bool
+        Whether to queue the lines for the search index (when whoever's
+        calling this is going to index them all at once anyway, they don't
+        need to be).
+
+    Returns
+    -------
+    InsertStats
+        The number of lines inserted, and how fast.
+    """
+    if edition.id is None:
+        db.session.flush()
+    line_enum = get_enum_ids(Line.enum_cls)
+    toc_enum = get_enum_ids(TOC.enum_cls)
+    next_id = first_toc_id or\
+        (db.session.query(db.func.max(TOC.id)).scalar() or 0) + 1
+
+    tocs = []
+    rows = []
+    lasttoc = None
+    # the last toc with lines, i.e., the prev of the next one to have lines
+    prevtoc = None
+    count = 0
+    start = time.perf_counter()
+
+    def stats():
+        seconds = time.perf_counter() - start
+        return InsertStats(count, seconds, count / seconds if seconds else 0)
+
+    def write(last=False):
+        # the lasttoc can still get lines (and so it's haslines and prev), so
+        # it waits, unless it already has them (or it's the last write)
+        ready = tocs if last or not tocs or tocs[-1].haslines else tocs[:-1]
+        if ready:
+            db.session.execute(TOC.__table__.insert(), [
+                {**toc.row, 'haslines': toc.haslines,
+                 'prev_id': toc.prev.id if toc.prev else None}
+                for toc in ready])
+            del tocs[:len(ready)]
+        if rows:
+            db.session.execute(Line.__table__.insert(), rows)
+            rows.clear()
+            if progress:
+                progress(stats())
+
+    for line in lines:
+        if 'precedence' in line:
+            parent = find_parent(line['precedence'], lasttoc)
+            lasttoc = SimpleNamespace(
+                id=next_id, precedence=line['precedence'], parent=parent,
+                haslines=False, prev=None,
+                row={'id': next_id, 'num': line.get('num'),
+                     'precedence': line['precedence'],
+                     'body': line.get('body'), 'edition_id': edition.id,
+                     'parent_id': parent.id if parent else None,
+                     'enum_id': toc_enum(line['enum'])})
+            next_id += 1
+            tocs.append(lasttoc)
+            if len(tocs) >= batch_size:
+                write()
+            continue
+
+        if not lasttoc.haslines:
+            lasttoc.haslines = True
+            lasttoc.prev = prevtoc
+            prevtoc = lasttoc
+        em = line.get('em', 'nem')
+        rows.append({'num': line.get('num'), 'body': line['body'],
+                     'html': underscores_to_ems(line['body'], em),
+                     'em_id': EMPHASIS.index(em), 'toc_id': lasttoc.id,
+                     'edition_id': edition.id,
+                     'enum_id': line_enum(line['enum'])})
+        count += 1
+        if len(rows) >= batch_size:
+            write()
+    write(last=True)
+
+    # the lines are queued for the index like the ORM would have (the flush
+    # listener doesn't see Core inserts)
+    if queue and search_backend():
+        now = datetime.utcnow()
+        lineids = db.select([db.literal('line'), Line.id, db.literal('add'),
+                             db.literal(now), db.literal(0), db.literal(now)])\
+            .where(Line.edition_id==edition.id)
+        db.session.execute(IndexOperation.__table__.insert().from_select(
+            ['index_name', 'entity_id', 'op', 'queued', 'attempts',
+             'retry_at'], lineids))
+    return stats()
+
+
+def unqueue_lines(edition):
+    """Take the lines of the edition back out of the search index queue (the
+    ORM queues them as they're flushed), for when they're going to be indexed
+    all at once instead.
+    """
+    lineids = db.select([Line.id]).where(Line.edition_id==edition.id)
+    IndexOperation.query.filter(IndexOperation.index_name=='line',
+                                IndexOperation.entity_id.in_(lineids))\
+        .delete(synchronize_session=False)
+
+
+def stream_json(fin, chunk_size=1 << 16):
+    """Generate the items of the json array in the file one at a time, reading
+    the file `chunk_size` characters at a time, instead of loading the whole
+    thing.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        # skip to the next item
+        while pos < len(buf) and (buf[pos].isspace() or
+                                  buf[pos] == (',' if started else '[')):
+            if buf[pos] == '[':
+                started = True
+            pos += 1
+        if pos < len(buf) and started and buf[pos] == ']':
+            return
+        try:
+            if pos >= len(buf):
+                raise ValueError("Need more.")
+            item, end = decoder.raw_decode(buf, pos)
+            # an item is only whole once what comes after it is in the buffer
+            # (e.g., `1.` decodes as 1 when it's the start of `1.25`)
+            after = end
+            while after < len(buf) and buf[after].isspace():
+                after += 1
+            if not eof and (after == len(buf) or buf[after] not in ',]'):
+                raise ValueError("Need more.")
+        except ValueError:
+            if eof:
+                raise
+            chunk = fin.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+
+def stream_jsonl(fin):
+    """Generate the objects in a line-delimited json file (one per line, blank
+    lines are skipped).
+    """
+    for num, line in enumerate(fin, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {num} of {fin.name}: {e}") from e
+
+
+def read_lines(path):
+    """Generate the lines of the text at the path, from `lines.jsonl` if it's
+    there, otherwise from `lines.json`.
+    """
+    path = path.rstrip('/')
+    if os.path.exists(f'{path}/lines.jsonl'):
+        with io.open(f'{path}/lines.jsonl', 'r', encoding='utf-8-sig') as fin:
+            yield from stream_jsonl(fin)
+    else:
+        with io.open(f'{path}/lines.json', 'r', encoding='utf-8-sig') as fin:
+            yield from stream_json(fin)
+
+
 def parse_files(path):
+    """Load the meta of the text at the path, and a generator of it's lines
+    (see :func:`read_lines`).
+    """
     path = path.rstrip('/')
     meta = yaml.load(open(f'{path}/meta.yml', 'rt'), Loader=yaml.FullLoader)
-    fin = io.open(f'{path}/lines.json', 'r', encoding='utf-8-sig')
-    lines = json.load(fin)
-    return meta, lines
+    return meta, read_lines(path)
+
+
+def print_progress(stats):
+    print(f"\rIndexed {stats.count} lines ({stats.rate:.0f}/s)...", end='')
 
 
-def main(path, dryrun=False, noindex=False):
+def print_insert_progress(stats):
+    print(f"\rInserted {stats.count} lines ({stats.rate:.0f}/s)...", end='')
+
+
+def main(path, dryrun=False, noindex=False, orm=False, batch_size=5000):
     meta, lines = parse_files(path)
     text = get_text(meta)
     edition = get_edition(meta['edition'], text)
     add_writer_connections(meta, edition)
-    i = populate_lines(lines, edition)
-    print(f"After an arduous {i} lines, we are done.")
+    # the lines are indexed right here (unless they're not to be indexed at
+    # all), so they're not queued for the index too
+    if orm:
+        i = populate_lines(lines, edition)
+        db.session.flush()
+        unqueue_lines(edition)
+        print(f"After an arduous {i} lines, we are done.")
+    else:
+        stats = bulk_populate_lines(lines, edition, batch_size=batch_size,
+                                    progress=print_insert_progress,
+                                    queue=False)
+        print(f"\nInserted {stats.count} lines in {stats.seconds:.1f}s "
+              f"({stats.rate:.0f}/s).")
 
     if dryrun:
         db.session.rollback()
@@ -165,10 +427,11 @@ def main(path, dryrun=False, noindex=False):
         print("Now committing...")
         db.session.commit()
         print(f"Done.")
-        if not args.noindex:
+        if not noindex:
             print("Reindexing...")
-            Line.reindex(edition=edition)
-            print("Done.")
+            stats = Line.reindex(edition=edition, progress=print_progress)
+            print(f"\nDone. Indexed {stats.count} lines in "
+                  f"{stats.seconds:.1f}s ({stats.rate:.0f}/s).")
         else:
             print("Skipping indexing.")
 
@@ -182,6 +445,13 @@ if __name__ == '__main__':
                         help="Flag for a dry run test.")
     parser.add_argument('--noindex', action='store_true', default=False,
                         help="Don't index the lines.")
+    parser.add_argument('--orm', action='store_true', default=False,
+                        help="Insert the lines as ORM objects (the old, slow "
+                        "way) instead of in bulk.")
+    parser.add_argument('-b', '--batch-size', action='store', type=int,
+                        default=5000,
+                        help="The number of lines to insert at a time in "
+                        "bulk.")
 
     args = parser.parse_args()
 
@@ -189,4 +459,4 @@ if __name__ == '__main__':
     app = create_app()
 
     with app.app_context():
-        main(args.path, args.dryrun, args.noindex)
+        main(args.path, args.dryrun, args.noindex, args.orm, args.batch_size)
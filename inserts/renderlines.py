@@ -0,0 +1,81 @@
+"""Render the emphasis html of the lines already in the database. New lines are
+rendered when they are inserted, so this is only needed for editions that were
+inserted before Line.html existed (or if the emphasis processor changes).
+"""
+import sys
+import argparse
+
+sys.path.insert(1, '../icc')
+
+from icc import db, create_app
+from icc.models.content import (Text, Edition, Line, SectionCache, EMPHASIS,
+                                underscores_to_ems)
+
+
+def get_editions(title=None, edition_num=None):
+    """Get the editions to render. All of them if there is no title."""
+    if not title:
+        return Edition.query.all()
+    text = Text.query.filter_by(title=title).first()
+    if not text:
+        sys.exit(f"The text {title} was not found.")
+    if edition_num is None:
+        return text.editions.all()
+    edition = text.editions.filter_by(num=edition_num).first()
+    if not edition:
+        sys.exit(f"The edition number {edition_num} was not found for "
+                 f"{text.title}.")
+    return [edition]
+
+
+def render_lines(edition, batch_size=1000):
+    """Render the html of every line in the edition in batches. Returns the
+    count of lines rendered.
+    """
+    rows = db.session.query(Line.id, Line.body, Line.em_id)\
+        .filter(Line.edition_id==edition.id).order_by(Line.id)
+    cnt = 0
+    mappings = []
+    for id, body, em_id in rows.yield_per(batch_size):
+        mappings.append({'id': id,
+                         'html': underscores_to_ems(body, EMPHASIS[em_id])})
+        if len(mappings) >= batch_size:
+            db.session.bulk_update_mappings(Line, mappings)
+            cnt += len(mappings)
+            mappings = []
+    if mappings:
+        db.session.bulk_update_mappings(Line, mappings)
+        cnt += len(mappings)
+    # the cached sections were rendered from the old html.
+    SectionCache.query.filter_by(edition_id=edition.id).delete()
+    return cnt
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Render the emphasis html of lines already in the icc database.")
+    parser.add_argument('-t', '--title', action='store', type=str,
+                        help="The title of the text to render. If omitted, "
+                        "every edition is rendered.")
+    parser.add_argument('-e', '--edition_num', action='store', type=int,
+                        help="The edition number of the text to render. If "
+                        "omitted, every edition of the text is rendered.")
+    parser.add_argument('-d', '--dryrun', action='store_true',
+                        help="Flag for a dry run test.")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        for edition in get_editions(args.title, args.edition_num):
+            cnt = render_lines(edition)
+            print(f"Rendered {cnt} lines of {edition}.")
+        if args.dryrun:
+            db.session.rollback()
+            print("Nothing committed.")
+        else:
+            db.session.commit()
+            print("Done.")
+
+
+if __name__ == '__main__':
+    main()
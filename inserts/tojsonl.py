@@ -0,0 +1,53 @@
+"""Rewrite the `lines.json` of texts in the library as `lines.jsonl` (one json
+object per line), which `insertlines.py` reads in preference to `lines.json`.
+The array is read one item at a time, so this works on files of any size.
+"""
+import os
+import io
+import sys
+import json
+import argparse
+
+sys.path.insert(1, '../icc')
+
+from inserts.insertlines import stream_json
+
+
+def convert(path, remove=False):
+    """Write the `lines.jsonl` for the `lines.json` in the directory at the
+    path. It's written to a temporary file first, so a failed conversion never
+    leaves half a `lines.jsonl` behind. Return the number of lines written.
+    """
+    path = path.rstrip('/')
+    source = f'{path}/lines.json'
+    target = f'{path}/lines.jsonl'
+    count = 0
+    with io.open(source, 'r', encoding='utf-8-sig') as fin,\
+            io.open(f'{target}.tmp', 'w', encoding='utf-8') as fout:
+        for line in stream_json(fin):
+            fout.write(json.dumps(line, ensure_ascii=False))
+            fout.write('\n')
+            count += 1
+    os.replace(f'{target}.tmp', target)
+    if remove:
+        os.remove(source)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Convert lines.json files to line-delimited lines.jsonl files.")
+    parser.add_argument('paths', action='store', type=str, nargs='+',
+                        help="The text directories (containing lines.json) "
+                        "to convert.")
+    parser.add_argument('-r', '--remove', action='store_true', default=False,
+                        help="Remove the lines.json after converting it.")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        count = convert(path, args.remove)
+        print(f"Wrote {count} lines to {path.rstrip('/')}/lines.jsonl.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,15 @@
 """Test admin.annotations routes."""
 
 import math
+from datetime import datetime
 from flask import url_for
 
 from icc import db
 from icc.models.annotation import Annotation
 from icc.models.user import User
 
-from tests.utils import login, TESTADMIN, TESTUSER2, looptest
+from tests.utils import login, get_token, TESTADMIN, TESTUSER2, looptest
+from inserts.checkheads import find_problems
 
 
 def test_edit_review_queue(popclient):
@@ -60,3 +62,46 @@ def test_edit_review_queue(popclient):
             assert bytes(test, 'utf-8') not in rv.data
         rv = client.get(f'{url}?sort={sort}&page={max_pages+1}')
         assert rv.status_code == 404
+
+
+def test_delete_current_edit(popclient):
+    """Test that deleting the current edit makes the previous edit HEAD
+    again.
+    """
+    app, client = popclient
+
+    with app.test_request_context():
+        annotation = Annotation.query.first()
+        head = annotation.HEAD
+        user = User.query.filter_by(email=TESTUSER2).first()
+        annotation.edit(editor=user, reason="Just 'cause",
+                        fl=head.first_line_num+1, ll=head.last_line_num+1,
+                        fc=head.first_char_idx, lc=head.last_char_idx,
+                        body=f'{head.body} is stupid.', tags=head.tags)
+        edit = annotation.edit_pending[0]
+        # approved later (by vote), it's still modified when it was written
+        edit.timestamp = datetime(2020, 1, 1)
+        edit.approve()
+        db.session.commit()
+        assert annotation.head_id == edit.id
+        assert annotation.last_line_num == head.last_line_num+1
+        assert annotation.modified_at == edit.timestamp
+        assert find_problems() == []
+
+        user = User.query.filter_by(email=TESTADMIN).first()
+        login(user, client)
+        url = url_for('admin.delete_edit', edit_id=edit.id)
+        rv = client.get(url)
+        rv = client.post(url, data={'csrf_token': get_token(rv.data)},
+                         follow_redirects=True)
+        assert rv.status_code == 200
+
+        annotation = Annotation.query.get(annotation.id)
+        assert annotation.head_id == head.id
+        assert annotation.HEAD.current
+        assert annotation.last_line_num == head.last_line_num
+        assert annotation.modified_at == annotation.HEAD.timestamp
+
+        annotation.modified_at = datetime(2000, 1, 1)
+        assert [(a, problem.split()[0]) for a, _, problem in find_problems()]\
+            == [(annotation, 'modified_at')]
@@ -0,0 +1,110 @@
+"""A benchmark of the :class:`AnnotationRange` index against the old
+`Edit.first_line_num <= n <= Edit.last_line_num` lookup.
+
+This isn't a test, so pytest won't collect it. Run it from the root directory
+with
+
+    python -m tests.benchmark_annotationranges
+
+It fills an in-memory sqlite database with one edition of `--lines` lines and
+`--annotations` annotations (by default, 50,000 and 100,000; about War and
+Peace with two annotations per line) and looks up the annotations on random
+sections of the edition both ways. It checks that both lookups return the same
+annotations and prints the average time per lookup as the number of annotations
+grows.
+"""
+import random
+import argparse
+from timeit import default_timer as timer
+
+from icc import db, create_app
+from icc.models.annotation import Annotation, Edit, AnnotationRange
+
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    TESTING = True
+    ELASTICSEARCH_URL = None
+
+
+def populate(n, lines, start=0):
+    """Insert annotations `start` to `n` with random line ranges (mostly one to
+    five lines, but some up to a few hundred).
+    """
+    annotations, edits, ranges = [], [], []
+    for i in range(start+1, n+1):
+        fl = random.randint(1, lines)
+        length = (random.randint(0, 4) if random.random() < .98 else
+                  random.randint(5, 300))
+        ll = min(fl + length, lines)
+        annotations.append({'id': i, 'edition_id': 1, 'active': True,
+                            'weight': 0, 'locked': False})
+        edits.append({'entity_id': i, 'edition_id': 1, 'num': 0,
+                      'first_line_num': fl, 'last_line_num': ll,
+                      'first_char_idx': 0, 'last_char_idx': -1,
+                      'current': True, 'approved': True, 'rejected': False,
+                      'body': '', 'weight': 0})
+        ranges.extend({'annotation_id': i, 'edition_id': 1, 'bucket': bucket,
+                       'first_line_num': fl, 'last_line_num': ll}
+                      for bucket in AnnotationRange.buckets(fl, ll))
+    db.session.bulk_insert_mappings(Annotation, annotations)
+    db.session.bulk_insert_mappings(Edit, edits)
+    db.session.bulk_insert_mappings(AnnotationRange, ranges)
+    db.session.commit()
+
+
+def old(first, last):
+    return Annotation.query.join(Edit, Annotation.HEAD)\
+        .filter(Annotation.edition_id==1, Annotation.active==True,
+                Edit.first_line_num<=last, Edit.last_line_num>=first)
+
+
+def new(first, last):
+    return AnnotationRange.annotations(1, first, last)
+
+
+def bench(lookup, sections):
+    start = timer()
+    for first, last in sections:
+        db.session.query(lookup(first, last).with_entities(Annotation.id)
+                         .subquery()).count()
+    return (timer() - start) / len(sections) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "Benchmark the annotation range index against the old lookup.")
+    parser.add_argument('-l', '--lines', action='store', type=int,
+                        default=50000, help="The number of lines.")
+    parser.add_argument('-a', '--annotations', action='store', type=int,
+                        default=100000, help="The number of annotations.")
+    parser.add_argument('-s', '--sections', action='store', type=int,
+                        default=200, help="The number of lookups per step.")
+    args = parser.parse_args()
+
+    random.seed(0)
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        steps = [args.annotations // 100, args.annotations // 10,
+                 args.annotations]
+        done = 0
+        print(f"{'annotations':>12} {'old (ms)':>10} {'new (ms)':>10}")
+        for n in steps:
+            populate(n, args.lines, done)
+            done = n
+            sections = []
+            for _ in range(args.sections):
+                first = random.randint(1, args.lines)
+                sections.append((first, first + random.randint(0, 60)))
+            for first, last in sections[:10]:
+                assert (sorted(a.id for a in old(first, last)) ==
+                        sorted(a.id for a in new(first, last)))
+            print(f"{n:>12} {bench(old, sections):>10.3f} "
+                  f"{bench(new, sections):>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,9 @@ import json
 import yaml
 import pytest
 
+from flask.testing import FlaskClient
+from werkzeug.test import EnvironBuilder
+
 from icc import create_app, db
 from icc import classes
 
@@ -24,6 +27,7 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     TESTING = True
     ELASTICSEARCH_URL = None
+    SEARCH_INDEX = ':memory:'
 
 
 def open_json(filename):
@@ -40,12 +44,75 @@ def open_json(filename):
     return json.load(open(f'{DIR}/data/{filename}', 'rt'))
 
 
+def read_meta(filename):
+    """Read the old-style text config in the `tests/data` directory into the
+    meta of a text as `insertlines.py` reads it from a `meta.yml`.
+    """
+    config = yaml.load(open(f'{DIR}/data/{filename}', 'rt'),
+                       Loader=yaml.FullLoader)
+    edition = config['edition']
+    edition['num'] = edition.pop('number')
+    edition['published'] = edition.pop('publication_date')
+    return config
+
+
+def read_lines(filename):
+    """Generate the lines of the old-style lines file in the `tests/data`
+    directory as the tocs and lines `insertlines.py` reads from a
+    `lines.json`: a line whose primary attribute is a toc is that toc, and
+    every other line is a line.
+    """
+    for line in open_json(filename):
+        primary = next(attr for attr in line['attributes'] if attr['primary'])
+        if primary['precedence']:
+            yield {'enum': primary['enum'], 'num': primary['num'],
+                   'precedence': primary['precedence'],
+                   'body': f"{primary['display']} {primary['num']}"}
+        else:
+            yield {'enum': primary['enum'], 'num': line['num'],
+                   'body': line['line'], 'em': line['emphasis']}
+
+
+class HTTPSClient(FlaskClient):
+    """A test client that makes it's requests over https, so that talisman
+    doesn't redirect them.
+    """
+    def open(self, *args, **kwargs):
+        # a redirect is followed with the environ it's already built
+        if not (len(args) == 1 and isinstance(args[0], (EnvironBuilder, dict))):
+            kwargs.setdefault('base_url', 'https://localhost/')
+        return super().open(*args, **kwargs)
+
+
 @pytest.fixture
 def app():
     """Create the app and yield it; this is the fundamental fixture. The mother
     fixture...
     """
     app = create_app(TestConfig)
+    app.test_client_class = HTTPSClient
+
+    with app.app_context():
+        db.create_all()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def fileapp(tmp_path):
+    """Create the app on a database file instead of in memory and yield it. The
+    in-memory database is one connection, so use this for anything that needs
+    concurrent connections (i.e., threads).
+    """
+    class FileConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'test.db'}"
+
+    app = create_app(FileConfig)
+    app.test_client_class = HTTPSClient
 
     with app.app_context():
         db.create_all()
@@ -96,10 +163,8 @@ def pop(minpop):
     """Populate the database with the rest of the dummy data, return the app."""
 
     enumdata = open_json('enums.text.json')
-    lines = open_json('gravity.json')
     annotations = open_json('annotations.json')
-    textconfig = yaml.load(open(f'{DIR}/data/gravity.config.yml', 'rt'),
-                           Loader=yaml.FullLoader)
+    meta = read_meta('gravity.config.yml')
 
     with minpop.app_context():
         # populate remaining enums
@@ -109,10 +174,11 @@ def pop(minpop):
                 db.session.add(obj)
 
         # populate the text, edition, author, and lines
-        text = get_text(textconfig, True)
-        edition = get_edition(textconfig, text)
-        add_writer_connections(textconfig, edition)
-        populate_lines(lines, edition)
+        text = get_text(meta)
+        edition = get_edition(meta['edition'], text)
+        add_writer_connections(meta, edition)
+        populate_lines(read_lines('gravity.json'), edition)
+        db.session.flush()
 
         # populate the annotations
         for a in annotations:
@@ -122,9 +188,10 @@ def pop(minpop):
             tag_strings = a.pop('tags')
             tags = [classes['Tag'].query.filter_by(tag=tag).first() for tag in
                     tag_strings]
+            toc = edition.lines.filter_by(num=a['fl']).first().toc
             db.session.add(classes['Annotation'](annotator=annotator,
-                                                 edition=edition, tags=tags,
-                                                 **a))
+                                                 edition=edition, toc=toc,
+                                                 tags=tags, **a))
         db.session.commit()
     return minpop
 
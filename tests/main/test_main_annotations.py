@@ -4,9 +4,9 @@ from flask import url_for
 from icc import db
 from icc.models.content import Text, Line
 from icc.models.annotation import Annotation
-from icc.models.user import User
+from icc.models.user import User, ReputationEnum, ReputationChange
 
-from tests.utils import get_token, login, TESTUSER
+from tests.utils import get_token, login, statements, TESTUSER
 
 
 def test_annotate_page(popclient):
@@ -132,3 +132,49 @@ def test_downvote(popclient):
         assert rv.status_code == 200
         db.session.commit()
         assert annotation.weight == -1
+
+
+def test_vote_reputation(popclient):
+    """Test that changing a vote rolls back the reputation change of the old
+    vote, without loading it.
+    """
+    app, client = popclient
+
+    with app.test_request_context():
+        db.session.add_all([
+            ReputationEnum(enum='Annotation_upvote', entity='AnnotationVote',
+                           default_delta=5),
+            ReputationEnum(enum='Annotation_downvote', entity='AnnotationVote',
+                           default_delta=-2)])
+        u = User.query.filter_by(email=TESTUSER).first()
+        annotation = Annotation.query.filter(Annotation.annotator != u).first()
+        annotator = annotation.annotator
+        annotator.reputation = 10
+        db.session.commit()
+        annotation_id, annotator_id = annotation.id, annotator.id
+        login(u, client)
+        up = url_for('main.vote', entity='Annotation', up=True,
+                     id=annotation_id)
+        down = url_for('main.vote', entity='Annotation', up=False,
+                       id=annotation_id)
+
+    rv = client.get(up)
+    assert rv.status_code == 302
+    with statements(app) as executed:
+        rv = client.get(down)
+    assert rv.status_code == 302
+    assert not [s for s in executed if
+                s.startswith('SELECT') and 'FROM reputationchange' in s]
+
+    with app.test_request_context():
+        assert User.query.get(annotator_id).reputation == 8
+        changes = ReputationChange.query.filter_by(user_id=annotator_id).all()
+        assert [change.delta for change in changes] == [-2]
+
+    # and rolling back the only vote
+    rv = client.get(down)
+    assert rv.status_code == 302
+    with app.test_request_context():
+        assert User.query.get(annotator_id).reputation == 10
+        assert not ReputationChange.query.filter_by(user_id=annotator_id)\
+            .count()
@@ -1,8 +1,10 @@
 """Test all of the main.text routes."""
 import math
 from flask import url_for
+from icc import db
 from icc.models.content import Text
-from tests.utils import looptest
+from icc.models.wiki import Wiki
+from tests.utils import looptest, statements
 
 
 def test_text_view(popclient):
@@ -37,3 +39,40 @@ def test_text_annotations(popclient):
             tests = ['class="annotation"']
             looptest(tests=tests, url=url, sorts=sorts, client=client,
                      max_pages=max_pages)
+
+
+def test_text_index_queries(popclient):
+    """Test that the text index doesn't load the writers of every edition it
+    touches.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        url = url_for("main.text_index")
+
+    with statements(app) as executed:
+        rv = client.get(url)
+    assert rv.status_code == 200
+    assert not [s for s in executed if 'FROM writerconnection' in s]
+
+
+def test_text_wiki(popclient):
+    """Test that loading a text's wiki is one query, and that it still knows
+    which text it belongs to.
+    """
+    app, client = popclient
+
+    with app.test_request_context():
+        text = Text.query.first()
+        wiki_id, title = text.wiki.id, text.title
+        url = url_for('main.wiki_edit_history', wiki_id=wiki_id)
+        db.session.expunge_all()
+
+        with statements(app) as executed:
+            wiki = Wiki.query.get(wiki_id)
+        assert len(executed) == 1
+        assert wiki.entity_type == 'Text'
+        assert wiki.entity.title == title
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert bytes(title, 'utf-8') in rv.data
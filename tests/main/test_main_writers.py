@@ -4,7 +4,7 @@ import math
 import pytest
 from flask import url_for
 from icc.models.content import Writer
-from tests.utils import looptest
+from tests.utils import looptest, statements
 
 
 def test_writer_view(popclient):
@@ -55,3 +55,17 @@ def test_writer_index(popclient):
     tests = ['<div class="card">']
     looptest(tests=tests, url=url, max_pages=max_pages, client=client,
              sorts=sorts)
+
+
+def test_writer_index_queries(popclient):
+    """Test that the works of all the writers on the writer index are loaded in
+    one query.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        url = url_for("main.writer_index")
+
+    with statements(app) as executed:
+        rv = client.get(url)
+    assert rv.status_code == 200
+    assert len([s for s in executed if 'FROM writerconnection' in s]) == 1
@@ -0,0 +1,104 @@
+from flask import url_for
+from icc import db, create_app
+from icc.enums import enums
+from icc.models.annotation import AnnotationFlag
+from icc.models.user import AdminRight
+from tests.utils import statements
+
+
+def test_enum_registry(popclient):
+    """Test that the enums are only loaded once, and reloaded when they
+    change.
+    """
+    app, client = popclient
+    AnnotationFlagEnum = AnnotationFlag.enum_cls
+
+    with app.app_context():
+        flags = enums.all(AnnotationFlagEnum)
+        assert ([flag.enum for flag in flags] ==
+                [flag.enum for flag in AnnotationFlagEnum.query.order_by(
+                    AnnotationFlagEnum.id)])
+        flag = flags[0]
+        assert enums.get(AnnotationFlagEnum, flag.id) == flag
+        assert enums.by_enum(AnnotationFlagEnum, flag.enum) == flag
+        assert str(flag) == flag.enum
+
+        right = enums.all(AdminRight)[0]
+        assert hasattr(right, 'min_rep')
+
+        with statements(app) as executed:
+            enums.all(AnnotationFlagEnum)
+            enums.get(AnnotationFlagEnum, flag.id)
+        assert executed == []
+
+        db.session.add(AnnotationFlagEnum(enum='balloons'))
+        db.session.commit()
+        assert enums.by_enum(AnnotationFlagEnum, 'balloons')
+
+
+def test_before_request_enums(popclient):
+    """Test that the annotation flags in before_request aren't queried on
+    every request.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        url = url_for('main.index')
+
+    client.get(url)
+    with statements(app) as executed:
+        rv = client.get(url)
+    assert rv.status_code == 200
+    assert not [s for s in executed if 'FROM annotationflagenum' in s]
+
+
+def test_enum_registry_transactions(popclient):
+    """Test that an enum that isn't committed is found, but isn't cached, and
+    that a rolled back one is forgotten.
+    """
+    app, client = popclient
+    AnnotationFlagEnum = AnnotationFlag.enum_cls
+
+    with app.app_context():
+        count = len(enums.all(AnnotationFlagEnum))
+        db.session.add(AnnotationFlagEnum(enum='balloons'))
+        db.session.flush()
+        assert enums.by_enum(AnnotationFlagEnum, 'balloons')
+        assert len(enums.all(AnnotationFlagEnum)) == count
+
+        db.session.rollback()
+        assert enums.by_enum(AnnotationFlagEnum, 'balloons') is None
+        assert len(enums.all(AnnotationFlagEnum)) == count
+        assert enums.get(AnnotationFlagEnum, None) is None
+
+
+def test_enum_registry_ttl(popclient):
+    """Test that a change the registry isn't told about (i.e., by another
+    process) shows up once the enums have been loaded for the ttl.
+    """
+    app, client = popclient
+    table = AdminRight.__table__
+
+    with app.app_context():
+        right = next(right for right in enums.all(AdminRight)
+                     if right.min_rep is not None)
+        db.session.execute(table.update().where(table.c.id==right.id)
+                           .values(min_rep=right.min_rep + 1))
+        db.session.commit()
+        assert enums.get(AdminRight, right.id).min_rep == right.min_rep
+
+        app.config['ENUM_REGISTRY_TTL'] = 0
+        assert enums.get(AdminRight, right.id).min_rep == right.min_rep + 1
+
+
+def test_enums_loaded_at_startup(fileapp):
+    """Test that the enums are loaded when the app is created."""
+    with fileapp.app_context():
+        db.session.add(AdminRight(enum='balloons', min_rep=0))
+        db.session.commit()
+
+    app = create_app(type('FileConfig', (), dict(fileapp.config)))
+    with app.app_context():
+        with statements(app) as executed:
+            right = enums.by_enum(AdminRight, 'balloons')
+        assert right.min_rep == 0
+        assert executed == []
@@ -0,0 +1,358 @@
+"""Test the insert scripts."""
+import os
+import io
+import json
+import copy
+import yaml
+import pytest
+from datetime import datetime
+
+from icc import db, create_app
+from icc.models.content import Line, TOC, Edition, Text, Writer
+from icc.models.user import User
+from icc.models.annotation import Annotation, Tag, Comment
+from icc.models.search import IndexOperation
+from inserts.insertlines import (get_text, get_edition, populate_lines,
+                                 bulk_populate_lines, stream_json, read_lines,
+                                 main as insertlines)
+from inserts.tojsonl import convert
+from inserts.insertlibrary import populate_library
+from inserts.insertannotations import populate_annotations
+from annotations import export, read_annotations, import_annotations
+from tests.conftest import TestConfig
+from tests.utils import statements
+
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+META = {'title': 'Ozymandias', 'sort_title': 'Ozymandias',
+        'publication_date': datetime(1818, 1, 11), 'description': 'A poem.',
+        'edition': {'num': 1, 'primary': True, 'description': 'The first.',
+                    'published': datetime(1818, 1, 11)}}
+
+
+def toc(enum, precedence, num):
+    return {'enum': enum, 'precedence': precedence, 'num': num,
+            'body': f'{enum} {num}'}
+
+
+def line(num, body, em='nem'):
+    return {'enum': 'line', 'num': num, 'body': body, 'em': em}
+
+
+LINES = [
+    toc('book', 1, 1), toc('chapter', 2, 1),
+    line(1, 'I met a traveller from an antique land,'),
+    line(2, 'Who said—“Two _vast and trunkless legs', 'oem'),
+    line(3, 'of stone_ Stand in the desert. . . .', 'cem'),
+    toc('chapter', 2, 2), line(4, 'Near them, on the sand,'),
+    toc('book', 1, 2), toc('chapter', 2, 1), toc('section', 3, 1),
+    line(5, 'Half sunk a shattered visage lies,'),
+    toc('section', 3, 2), line(6, 'whose frown,'),
+    toc('chapter', 2, 2), line(7, 'And wrinkled lip,'),
+    # a toc without any lines at the very end
+    toc('book', 1, 3),
+]
+
+
+def contents(edition):
+    """The tocs and lines of the edition, with the links between them as the
+    tocs' paths instead of ids (the ORM doesn't insert them in order).
+    """
+    def path(toc):
+        return path(toc.parent) + (toc.body,) if toc else ()
+
+    tocs = sorted((path(toc), toc.num, toc.precedence, toc.haslines,
+                   toc.enum.enum, path(toc.prev)) for toc in edition.toc)
+    lines = [(line.num, line.body, line.html, line.em_id, line.enum.enum,
+              path(line.toc)) for line in edition.lines.order_by(Line.num)]
+    return tocs, lines
+
+
+def test_bulk_populate_lines(app):
+    """Test that the bulk loader makes the same tocs and lines as the ORM
+    does, from a stream, in batches smaller than the text.
+    """
+    with app.app_context():
+        db.session.add_all([TOC.enum_cls(enum=enum) for enum in
+                            ['book', 'chapter', 'section']])
+        db.session.add(Line.enum_cls(enum='line'))
+        text = get_text(META)
+        orm = get_edition(META['edition'], text)
+        populate_lines(copy.deepcopy(LINES), orm)
+        db.session.commit()
+
+        bulk = get_edition({**META['edition'], 'num': 2, 'primary': False},
+                           text)
+        progress = []
+        stats = bulk_populate_lines(
+            stream_json(io.StringIO(json.dumps(LINES)), chunk_size=7), bulk,
+            batch_size=2, progress=progress.append)
+        db.session.commit()
+        assert stats.count == 7
+        counts = [p.count for p in progress]
+        assert counts == sorted(set(counts)) and counts[-1] == 7
+        assert max(b - a for a, b in zip([0] + counts, counts)) <= 2
+
+        assert contents(bulk) == contents(orm)
+        tocs, lines = contents(bulk)
+        assert len(tocs) == 9 and len(lines) == 7
+        assert (('book 3',), 3, 1, False, 'book', ()) in tocs
+
+
+def test_populate_annotations(minpop):
+    """Test that the annotations are matched to their lines by body in the
+    right edition, and that the bulk inserted annotations are the same as the
+    ORM's.
+    """
+    with minpop.app_context():
+        db.session.add_all([TOC.enum_cls(enum=enum) for enum in
+                            ['book', 'chapter', 'section']])
+        db.session.add(Line.enum_cls(enum='line'))
+        db.session.add(Tag(tag='original', description="The originals."))
+        text = get_text(META)
+        orm = get_edition(META['edition'], text)
+        bulk = get_edition({**META['edition'], 'num': 2, 'primary': False},
+                           text)
+        # the same lines in both, but a repeated line in the bulk edition
+        bulk_populate_lines(copy.deepcopy(LINES), orm)
+        bulk_populate_lines(copy.deepcopy(LINES) + [line(8, 'whose  frown,')],
+                            bulk)
+        db.session.commit()
+
+        annotations = [
+            {'line': 'Who said—“Two vast and trunkless legs',
+             'annotation': 'Horace Smith wrote one too.'},
+            {'line': 'whose frown,', 'annotation': 'A frown.'},
+            {'line': 'Near them,\ton the sand, ', 'annotation': 'Sand.'},
+            {'line': 'Look on my Works', 'annotation': 'And despair.'},
+        ]
+        matches = populate_annotations('Ozymandias', 2, 'Horace Smith',
+                                       annotations)
+        assert [num for _, num, _ in matches.matched] == [2, 6, 4]
+        assert matches.ambiguous == [(annotations[1], [6, 8])]
+        assert matches.unmatched == [annotations[3]]
+
+        community = User.query.filter_by(displayname='community').first()
+        tags = Tag.query.filter(Tag.tag.in_(['original',
+                                             'horace-smith'])).all()
+        for annotation, num, _ in matches.matched:
+            db.session.add(Annotation(
+                edition=orm, annotator=community, fl=num, ll=num, fc=0, lc=-1,
+                toc=orm.lines.filter_by(num=num).first().toc, tags=tags,
+                body=annotation['annotation']))
+        db.session.commit()
+
+        def annotations(edition):
+            return [(a.annotator, a.locked, a.active, a.first_line_num,
+                     a.last_line_num, a.HEAD.num, a.HEAD.current,
+                     a.HEAD.approved, a.HEAD.reason, a.HEAD.editor,
+                     a.HEAD.toc.body, a.HEAD.first_line_num,
+                     a.HEAD.last_line_num, a.HEAD.first_char_idx,
+                     a.HEAD.last_char_idx, a.HEAD.body,
+                     sorted(tag.tag for tag in a.HEAD.tags),
+                     [(r.bucket, r.first_line_num, r.last_line_num)
+                      for r in a.ranges], a.all_edits.count())
+                    for a in Annotation.query.filter_by(edition=edition)
+                    .order_by(Annotation.id)]
+
+        assert len(annotations(bulk)) == 3
+        assert annotations(bulk) == annotations(orm)
+        assert [a.HEAD.lines[0].num for a in
+                bulk.annotations.order_by(Annotation.id)] == [2, 6, 4]
+
+
+def test_read_lines(tmp_path):
+    """Test reading the lines one at a time from lines.json, and from the
+    lines.jsonl it's converted to.
+    """
+    with io.open(f'{DIR}/data/gravity.json', 'r', encoding='utf-8-sig') as fin:
+        expected = json.load(fin)
+    with io.open(f'{DIR}/data/gravity.json', 'r', encoding='utf-8-sig') as fin:
+        assert list(stream_json(fin, chunk_size=10)) == expected
+
+    # with a BOM and all kinds of whitespace
+    with io.open(tmp_path / 'lines.json', 'w', encoding='utf-8-sig') as fout:
+        json.dump(LINES, fout, indent=4, ensure_ascii=False)
+    lines = read_lines(str(tmp_path))
+    assert next(lines) == LINES[0]
+    assert list(lines) == LINES[1:]
+
+    assert convert(str(tmp_path), remove=True) == len(LINES)
+    assert sorted(os.listdir(tmp_path)) == ['lines.jsonl']
+    assert list(read_lines(str(tmp_path))) == LINES
+
+
+def test_stream_json_numbers():
+    """Test that a number cut off by the end of a chunk (e.g., `1.` of `1.25`,
+    or `1e` of `1e5`) isn't taken for a whole one.
+    """
+    items = [1.25, 1e5, -2.5e-3, 10, [3.5, 4e2], {'n': 6.75}, 'x', 7.0]
+    text = json.dumps(items)
+    for chunk_size in range(1, 9):
+        assert list(stream_json(io.StringIO(text), chunk_size)) == items
+        assert list(stream_json(io.StringIO(text.replace(',', ' ,\n ')),
+                                chunk_size)) == items
+    assert list(stream_json(io.StringIO('[' + ' ' * 65533 + '1.25]'))) ==\
+        [1.25]
+
+    with pytest.raises(ValueError):
+        list(stream_json(io.StringIO('[1.x]'), 3))
+
+
+def test_insertlines_indexes_once(app, tmp_path):
+    """Test that insertlines.py indexes the lines it inserts (either way) and
+    doesn't also queue them to be indexed again.
+    """
+    meta = {**META, 'edition': {**META['edition'], 'author': [], 'editor': [],
+                                'translator': []}}
+    with open(tmp_path / 'meta.yml', 'wt') as fout:
+        yaml.dump(meta, fout)
+    with open(tmp_path / 'lines.json', 'wt') as fout:
+        json.dump(LINES, fout)
+
+    with app.app_context():
+        db.session.add_all([TOC.enum_cls(enum=enum) for enum in
+                            ['book', 'chapter', 'section']])
+        db.session.add(Line.enum_cls(enum='line'))
+        db.session.commit()
+        insertlines(str(tmp_path))
+        meta['edition'].update(num=2, primary=False)
+        with open(tmp_path / 'meta.yml', 'wt') as fout:
+            yaml.dump(meta, fout)
+        insertlines(str(tmp_path), orm=True)
+
+        assert Line.query.count() == 14
+        assert not IndexOperation.query.filter_by(index_name='line').count()
+        assert Line.search('trunkless', 1, 10)[1] == 2
+
+
+def test_populate_library(tmp_path):
+    """Test loading a library of editions in parallel: two editions of one text
+    that share a writer, another text with an enum nobody has seen yet, and an
+    edition that can't be read, which is left out without stopping the rest.
+    """
+    class FileConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'test.db'}"
+
+    writer = {'name': 'Percy Bysshe Shelley', 'family_name': 'Shelley'}
+    editions = {
+        'shelley/ozymandias/first': {**META, 'edition': {
+            **META['edition'], 'primary': False,
+            'author': [writer], 'editor': [], 'translator': []}},
+        'shelley/ozymandias/second': {**META, 'edition': {
+            **META['edition'], 'num': 2,
+            'author': [writer], 'editor': [{'name': 'Horace Smith'}],
+            'translator': []}},
+        'shelley/mont-blanc': {**META, 'title': 'Mont Blanc',
+                               'sort_title': 'Mont Blanc', 'edition': {
+            **META['edition'], 'author': [writer], 'editor': [],
+            'translator': []}},
+    }
+    for path, meta in editions.items():
+        os.makedirs(tmp_path / 'library' / path)
+        with open(tmp_path / 'library' / path / 'meta.yml', 'wt') as fout:
+            yaml.dump(meta, fout)
+        lines = LINES + [toc('stanza', 2, 1), line(8, 'Look on my Works')]\
+            if path == 'shelley/mont-blanc' else LINES
+        with open(tmp_path / 'library' / path / 'lines.jsonl', 'wt') as fout:
+            fout.writelines(json.dumps(l) + '\n' for l in lines)
+    os.makedirs(tmp_path / 'library' / 'shelley' / 'broken')
+    with open(tmp_path / 'library' / 'shelley' / 'broken' / 'meta.yml',
+              'wt') as fout:
+        yaml.dump({**META, 'title': 'Broken', 'sort_title': 'Broken'}, fout)
+    with open(tmp_path / 'library' / 'shelley' / 'broken' / 'lines.json',
+              'wt') as fout:
+        fout.write(json.dumps(LINES)[:-10])
+
+    app = create_app(FileConfig)
+    with app.app_context():
+        db.create_all()
+        db.session.add(TOC.enum_cls(enum='book'))
+        db.session.commit()
+
+        inserted, failed = populate_library(
+            [str(tmp_path / 'library' / 'shelley' / 'ozymandias'),
+             str(tmp_path / 'library' / 'shelley' / 'mont-blanc'),
+             str(tmp_path / 'library' / 'shelley' / 'broken')],
+            workers=2, batch_size=3, config_class=FileConfig)
+        assert [path for path, _ in failed] ==\
+            [str(tmp_path / 'library' / 'shelley' / 'broken')]
+        assert len(inserted) == 3
+
+        assert sorted(w.name for w in Writer.query) ==\
+            ['Horace Smith', 'Percy Bysshe Shelley']
+        assert sorted(t.title for t in Text.query) ==\
+            ['Mont Blanc', 'Ozymandias']
+        assert sorted(e.enum for e in TOC.enum_cls.query) ==\
+            ['book', 'chapter', 'section', 'stanza']
+        assert [e.enum for e in Line.enum_cls.query] == ['line']
+
+        ozymandias = Text.query.filter_by(title='Ozymandias').first()
+        assert ozymandias.primary.num == 2
+        first, second = sorted(ozymandias.editions, key=lambda e: e.num)
+        assert contents(first) == contents(second)
+        assert TOC.query.count() == 9 * 2 + 10
+        assert Line.query.count() == 7 * 2 + 8
+
+        # indexed once, at the end, instead of queued line by line
+        assert sorted(Line.search('vast', 1, 10)[0], key=lambda l: l.id) ==\
+            sorted(Line.query.filter(Line.body.contains('vast')),
+                   key=lambda l: l.id)
+
+        db.session.remove()
+        db.drop_all()
+
+
+def test_export_import(pop):
+    """Test that the annotations (and their comment threads) survive a round
+    trip through the export and the import, and that the export's queries
+    don't grow with the number of annotations.
+    """
+    with pop.app_context():
+        annotation = Annotation.query.first()
+        community = User.query.filter_by(displayname='community').first()
+        thread = Comment(annotation=annotation, poster=community,
+                         body="A thread.")
+        reply = Comment(annotation=annotation, poster=community, depth=1,
+                        parent=thread, body="A reply.")
+        db.session.add_all([thread, reply])
+        db.session.commit()
+        count = Annotation.query.count()
+
+        fout = io.StringIO()
+        with statements(pop) as executed:
+            assert export(fout, batch_size=count) == count
+        # a batch (the annotations with their HEADs, their tags, and their
+        # comments), and the empty one after it
+        assert len(executed) == 4
+
+        # the old format still works
+        exported = list(read_annotations(io.StringIO(fout.getvalue())))
+        assert list(read_annotations(io.StringIO(json.dumps(exported)))) ==\
+            exported
+
+        inserted, skipped = import_annotations(
+            read_annotations(io.StringIO(fout.getvalue())), batch_size=2)
+        db.session.commit()
+        assert inserted == count and skipped == []
+
+        def threads(annotations):
+            # the comment ids are new, so they're compared by position
+            for a in annotations:
+                ids = [c['id'] for c in a['comments']]
+                a['comments'] = [
+                    {**c, 'id': i, 'parent_id': ids.index(c['parent_id'])
+                     if c['parent_id'] else None}
+                    for i, c in enumerate(a['comments'])]
+            return annotations
+
+        fout = io.StringIO()
+        export(fout, batch_size=3)
+        both = list(read_annotations(io.StringIO(fout.getvalue())))
+        assert threads(both[count:]) == threads(exported)
+        assert exported[0]['comments'][1]['parent_id'] ==\
+            exported[0]['comments'][0]['id']
+        imported = Annotation.query.order_by(Annotation.id.desc()).first()
+        assert imported.HEAD.lines and imported.ranges
@@ -0,0 +1,74 @@
+import logging
+
+import pytest
+from flask import url_for
+from sqlalchemy.exc import OperationalError
+
+from icc import db
+from icc.instrumentation import QueryBudgetExceeded, query_stats
+
+
+def test_query_headers(popclient):
+    """Test that the query count and timing headers are only there when asked
+    for.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        url = url_for('main.index')
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert 'X-Query-Count' not in rv.headers
+
+    app.config['QUERY_HEADERS'] = True
+    rv = client.get(url)
+    assert rv.status_code == 200
+    count = int(rv.headers['X-Query-Count'])
+    assert count > 0
+    assert f'desc="{count} queries"' in rv.headers['Server-Timing']
+
+    # the count is per request, not cumulative
+    rv = client.get(url)
+    assert int(rv.headers['X-Query-Count']) == count
+
+
+def test_query_budget(popclient):
+    """Test that going over a route's query budget fails in testing."""
+    app, client = popclient
+    with app.test_request_context():
+        url = url_for('main.index')
+
+    app.config['QUERY_BUDGETS'] = {'main.index': 1}
+    with pytest.raises(QueryBudgetExceeded):
+        client.get(url)
+
+    app.config['QUERY_BUDGETS'] = {'main.index': 1000}
+    rv = client.get(url)
+    assert rv.status_code == 200
+
+
+def test_slow_query_log(popclient, caplog):
+    """Test that slow queries are logged with the route."""
+    app, client = popclient
+    with app.test_request_context():
+        url = url_for('main.index')
+
+    app.config['SLOW_QUERY_THRESHOLD'] = 0
+    with caplog.at_level(logging.WARNING):
+        rv = client.get(url)
+    assert rv.status_code == 200
+    assert any('Slow query' in r.message and 'main.index' in r.message for r
+               in caplog.records)
+
+
+def test_failed_query(app):
+    """Test that a statement that fails is still counted, and doesn't leave
+    it's start behind on the connection.
+    """
+    with app.test_request_context():
+        stats = query_stats()
+        with pytest.raises(OperationalError):
+            db.session.execute('SELECT * FROM nothing_here')
+        assert db.session.connection().info['query_start'] == []
+        assert stats.count == 1
+        db.session.rollback()
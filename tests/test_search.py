@@ -0,0 +1,323 @@
+from datetime import datetime
+
+from flask import url_for
+from icc import db
+from tests.utils import statements
+from icc.search import (SQLiteBackend, ElasticsearchBackend, query_index,
+                        drain_index_queue, index_queue_stats, document,
+                        query_prefix)
+from icc.models.content import Line, Edition, Writer
+from icc.models.search import IndexOperation
+
+
+def test_sqlite_search(popclient):
+    """Test searching lines on the sqlite backend, with ranking, pagination,
+    and updates to the index.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        assert isinstance(app.extensions['search'], SQLiteBackend)
+        # nothing's indexed until it's indexed
+        assert Line.search('urine', 1, 10)[1] == 0
+
+        Line.reindex()
+        lines, total = Line.search('urine', 1, 10)
+        assert total == 1
+        assert 'urine the rhino' in lines[0].body
+
+        # punctuation and FTS5 syntax in the query are just words
+        assert Line.search('"urine" AND (rhino', 1, 10)[1] >= 1
+
+        # the lines with more of the words come first
+        lines, total = Line.search('the rhino releases', 1, 100)
+        assert total > 1
+        assert 'the rhino releases' in lines[0].body
+
+        # pagination
+        first, total = Line.search('the', 1, 2)
+        second, _ = Line.search('the', 2, 2)
+        assert len(first) == len(second) == 2
+        assert not set(first) & set(second)
+
+        # removing and updating
+        line = lines[0]
+        app.extensions['search'].remove_from_index('line', line)
+        assert line.id not in query_index('line', 'rhino', 1, 10)[0]
+        line.edit('An elephant, instead.')
+        app.extensions['search'].add_to_index('line', line)
+        assert query_index('line', 'elephant', 1, 10)[0] == [line.id]
+        db.session.rollback()
+
+
+def test_sqlite_searchlines(popclient):
+    """Test searching the lines of an edition or a writer."""
+    app, client = popclient
+    with app.test_request_context():
+        Line.reindex()
+        edition = Edition.query.first()
+        writer = Writer.query.first()
+
+        lines, total = edition.searchlines('urine', 1, 10)
+        assert total == 1
+        lines, total = writer.searchlines('urine', 1, 10)
+        assert total == 1
+        assert list(writer.searchlines('urine', 1, 10)[0]) == list(lines)
+
+        other = Edition(text=edition.text, num=edition.num + 1)
+        db.session.add(other)
+        db.session.flush()
+        assert other.searchlines('urine', 1, 10)[1] == 0
+
+        url = url_for('main.searchlines', item='Edition', ident=edition.id,
+                      q='urine')
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert b'cascade of urine the rhino releases,' in rv.data
+
+
+def test_reindex_streaming(popclient):
+    """Test that reindexing streams the lines (without loading them) into the
+    index in chunks, with the same documents the lines themselves make.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        lines = Line.query.all()
+        expected = {}
+        for line in lines:
+            id, fields = document(line)
+            fields['writer_id'] = sorted(fields['writer_id'])
+            expected[id] = fields
+        count = len(lines)
+        del lines, line
+        db.session.expunge_all()
+
+        documents = {}
+        for id, fields in Line.search_documents(Line.query, batch_size=7):
+            fields['writer_id'] = sorted(fields['writer_id'])
+            documents[id] = fields
+        assert documents == expected
+        assert not [obj for obj in db.session if isinstance(obj, Line)]
+
+        progress = []
+        stats = Line.reindex(chunk_size=7, workers=3,
+                             progress=progress.append)
+        assert stats.count == count
+        assert [p.count for p in progress] == sorted(
+            {min(count, 7 * (i + 1)) for i in range(-(-count // 7))})
+        assert not [obj for obj in db.session if isinstance(obj, Line)]
+        assert query_index('line', 'rhino', 1, 10)[1] >= 1
+        edition = Edition.query.first()
+        assert edition.searchlines('urine', 1, 10)[1] == 1
+
+        # only the lines that match
+        app.extensions['search'] = SQLiteBackend(':memory:')
+        assert Line.reindex(edition_id=0).count == 0
+        assert Line.reindex(edition=edition).count == count
+
+
+def test_search_from_index(popclient):
+    """Test that the search results can be shown from the fields stored in the
+    index without touching the database, highlighted, and with the lines around
+    them.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        Line.reindex()
+        line = Line.search('urine', 1, 10)[0][0]
+        expected = {'id': line.id, **document(line)[1]}
+        around = [l.id for l in Line.query.filter(
+            Line.edition_id==line.edition_id, Line.num>=line.num - 2,
+            Line.num<=line.num + 2).order_by(Line.num)]
+        url = url_for('main.search', q='urine')
+        db.session.expunge_all()
+
+        app.config['SEARCH_RESULTS_FROM_INDEX'] = True
+        app.config['SEARCH_CONTEXT_LINES'] = 2
+        with statements(app) as executed:
+            lines, total = Line.search('urine', 1, 10)
+        assert not executed
+        assert lines.from_index and total == 1
+        hit = lines[0]
+        assert '<mark>urine</mark>' in hit.pop('highlight')
+        assert [l['id'] for l in hit.pop('context')] == around
+        assert hit == expected
+
+        # lines indexed without their stored fields come from the database
+        app.extensions['search'].connection.execute('DELETE FROM line_source')
+        assert Line.search('urine', 1, 10)[0][0] == expected
+        Line.reindex()
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert b'cascade of <mark>urine</mark> the rhino releases,' in rv.data
+    assert rv.data.count(b'<div class="line') == len(around)
+
+
+def test_search_highlight_emphasis(popclient):
+    """Test that the highlighted hits from the index are rendered like the
+    lines' html, with their emphasis and their punctuation.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        line = Line.query.filter_by(num=2).first()
+        line.edit('The _vast_, trunkless (legs); of stone!')
+        db.session.commit()
+        Line.reindex()
+        expected = ('The <em><mark>vast</mark></em>, trunkless (legs); of '
+                    'stone!')
+
+        app.config['SEARCH_RESULTS_FROM_INDEX'] = True
+        lines, total = Line.search('vast', 1, 10)
+        assert total == 1
+        assert lines[0]['highlight'] == expected
+        assert lines[0]['html'] == line.html
+        search = url_for('main.search', q='vast')
+        prefix = url_for('ajax.search_lines', edition=line.edition_id,
+                         q='trunkless va')
+
+    rv = client.get(search)
+    assert rv.status_code == 200
+    assert expected.encode() in rv.data
+    assert b'_vast_' not in rv.data
+
+    rv = client.get(prefix)
+    assert [line['line'] for line in rv.json['lines']] ==\
+        [expected.replace('trunkless', '<mark>trunkless</mark>')]
+
+
+def test_prefix_search(popclient):
+    """Test searching lines as they're typed, with the cache and the timeout.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        Line.reindex()
+        edition = Edition.query.first()
+        filters = {'edition_id': edition.id}
+        hits, timed_out = query_prefix('line', 'cascade of ur', filters)
+        assert not timed_out and len(hits) == 1
+        assert '<mark>urine</mark>' in hits[0][1]['highlight']
+        assert query_prefix('line', 'cascade of ur', {'edition_id': 0}) ==\
+            ([], False)
+        # every word has to be there
+        assert query_prefix('line', 'cascade elephant ur', filters)[0] == []
+
+        # the same prefix comes from the cache (even with the index gone)
+        app.extensions['search'] = SQLiteBackend(':memory:')
+        assert query_prefix('line', ' Cascade  of UR', filters)[0] == hits
+        assert query_prefix('line', 'cascade of uri', filters)[0] == []
+
+        # and running out of time isn't cached
+        Line.reindex()
+        app.config['SEARCH_PREFIX_TIMEOUT'] = 1e-9
+        assert query_prefix('line', 'cascade of urin', filters) == ([], True)
+        app.config['SEARCH_PREFIX_TIMEOUT'] = 1
+        assert len(query_prefix('line', 'cascade of urin', filters)[0]) == 1
+
+        url = url_for('ajax.search_lines', edition=edition.id, q='rhino rel')
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert rv.json['success'] and not rv.json['timed_out']
+    assert rv.json['lines']
+    assert all('<mark>rel' in line['line'] for line in rv.json['lines'])
+    assert client.get(url.replace('edition', 'text')).json['lines'] ==\
+        rv.json['lines']
+
+
+class RecordingClient:
+    """Just enough of an Elasticsearch client to see what's asked of it."""
+    def __init__(self):
+        self.searches = []
+
+    def search(self, index, doc_type, body, **kwargs):
+        self.searches.append(body)
+        return {'timed_out': False, 'hits': {'hits': []}}
+
+
+def test_elasticsearch_prefix_query():
+    """Test that the Elasticsearch prefix search wants all of the words, in any
+    order, not the phrase.
+    """
+    client = RecordingClient()
+    backend = ElasticsearchBackend(client)
+    assert backend.prefix_query('line', 'urine cascade o', 10,
+                                {'edition_id': 1}) == ([], False)
+    assert client.searches[0]['query']['bool']['must'] == [
+        {'match': {'edition_id': 1}},
+        {'match': {'body': 'urine'}},
+        {'match': {'body': 'cascade'}},
+        {'match_phrase_prefix': {'body': {'query': 'o'}}}]
+    assert backend.prefix_query('line', ' ', 10) == ([], False)
+    assert len(client.searches) == 1
+
+
+def test_index_queue(popclient):
+    """Test that commits queue the changes to the index, and that draining the
+    queue coalesces them into the index.
+    """
+    app, client = popclient
+    with app.test_request_context():
+        # populating the lines queued them
+        count = Line.query.count()
+        assert IndexOperation.query.count() == count
+        stats = index_queue_stats()
+        assert stats.pending == count and stats.failed == 0 and stats.lag >= 0
+        assert query_index('line', 'rhino', 1, 10) == ([], 0)
+
+        assert drain_index_queue(batch_size=count // 2) == count // 2
+        while drain_index_queue():
+            pass
+        assert index_queue_stats() == (0, 0, 0)
+        ids, total = query_index('line', 'rhino', 1, 10)
+        assert total >= 1
+
+        # two edits in two commits are indexed once, as the last one
+        line = Line.query.get(ids[0])
+        line.edit('An elephant, instead.')
+        db.session.commit()
+        line.edit('A hippo, instead.')
+        db.session.commit()
+        assert IndexOperation.query.count() == 2
+        assert drain_index_queue() == 2
+        assert not IndexOperation.query.count()
+        assert query_index('line', 'elephant', 1, 10) == ([], 0)
+        assert query_index('line', 'hippo', 1, 10) == ([line.id], 1)
+
+        db.session.delete(line)
+        db.session.commit()
+        assert [op.op for op in IndexOperation.query] == ['remove']
+        drain_index_queue()
+        assert query_index('line', 'hippo', 1, 10) == ([], 0)
+
+
+class BrokenBackend(SQLiteBackend):
+    def bulk_index(self, index, objs):
+        raise ConnectionError("The index is down.")
+
+
+def test_index_queue_retry(popclient):
+    """Test that failed operations stay queued and are tried again later."""
+    app, client = popclient
+    with app.test_request_context():
+        count = Line.query.count()
+        app.extensions['search'] = BrokenBackend(':memory:')
+        assert drain_index_queue() == count
+        ops = IndexOperation.query.all()
+        assert len(ops) == count
+        assert all(op.attempts == 1 and 'down' in op.error for op in ops)
+        # and they wait before they're tried again
+        assert drain_index_queue() == 0
+
+        app.extensions['search'] = SQLiteBackend(':memory:')
+        IndexOperation.query.update({'retry_at': datetime.utcnow()})
+        assert drain_index_queue() == count
+        assert not IndexOperation.query.count()
+        assert query_index('line', 'rhino', 1, 10)[1] >= 1
+
+        app.config['SEARCH_QUEUE_MAX_ATTEMPTS'] = 1
+        line = Line.query.first()
+        line.edit('An elephant, instead.')
+        db.session.commit()
+        app.extensions['search'] = BrokenBackend(':memory:')
+        drain_index_queue()
+        # given up on, so it's not pending, and it doesn't hold the lag up
+        assert index_queue_stats() == (0, 1, 0)
@@ -3,8 +3,10 @@ import time
 from flask import url_for
 from icc import db
 from icc.models.user import AdminRight, User
-from tests.utils import (get_token, login, TESTUSER, TESTADMIN, COMMUNITY,
-                         PASSWORD)
+from icc.models.annotation import (Annotation, AnnotationVote, Comment,
+                                   CommentVote)
+from tests.utils import (get_token, login, statements, TESTUSER, TESTADMIN,
+                         TESTUSER2, COMMUNITY, PASSWORD)
 
 
 def test_register(minclient):
@@ -114,6 +116,58 @@ def test_user_rights_not_authorized(app):
         assert not u.is_authorized('right_to_balloons')
 
 
+def test_user_rights_cached(app):
+    """Test that authorization checks don't query the rights once they're
+    loaded, and that changing the rights is still noticed.
+    """
+    with app.app_context():
+        u = User(displayname='john', email=TESTUSER, reputation=5)
+        balloons = AdminRight(enum='right_to_balloons', min_rep=None)
+        db.session.add_all([u, balloons])
+        db.session.commit()
+        assert not u.is_authorized('right_to_balloons')
+
+        with statements(app) as executed:
+            for _ in range(10):
+                assert not u.is_auth_any(['right_to_balloons',
+                                          'right_to_cake'])
+        assert executed == []
+
+        u.rights.append(balloons)
+        assert u.is_authorized('right_to_balloons')
+
+        cake = AdminRight(enum='right_to_cake', min_rep=5)
+        db.session.add(cake)
+        db.session.commit()
+        assert u.is_auth_all(['right_to_balloons', 'right_to_cake'])
+
+
+def test_get_votes(popclient):
+    """Test getting the votes on a page of mixed entities at once."""
+    app, client = popclient
+    with app.app_context():
+        u = User.query.filter_by(email=TESTUSER2).first()
+        annotations = Annotation.query.all()
+        comment = Comment(annotation=annotations[0], poster=u, body='Yes.')
+        upvote = AnnotationVote(voter=u, entity=annotations[0], delta=1)
+        downvote = CommentVote(voter=u, entity=comment, delta=-1)
+        db.session.add_all([comment, upvote, downvote])
+        db.session.commit()
+
+        # reload everything the commit expired
+        u = User.query.filter_by(email=TESTUSER2).first()
+        annotations = Annotation.query.all()
+        entities = annotations + Comment.query.all()
+        with statements(app) as executed:
+            votes = u.get_votes(entities)
+        # one query per vote class
+        assert len(executed) == 2
+        assert votes[annotations[0]] == upvote
+        assert votes[comment] == downvote
+        assert all(votes[a] is None for a in annotations[1:])
+        assert votes == {entity: u.get_vote(entity) for entity in entities}
+
+
 def test_password():
     """Test user password authentication."""
     u = User(displayname='john', email=TESTUSER)
@@ -1,6 +1,9 @@
 import re
+from contextlib import contextmanager
 from flask import url_for
 from flask_login import logout_user
+from sqlalchemy import event
+from icc import db
 
 
 PASSWORD = 'testing'
@@ -16,6 +19,24 @@ def get_token(data):
     return m.group(1).decode("utf-8")
 
 
+@contextmanager
+def statements(app):
+    """Collect the sql statements executed on the app's engine in the with
+    block into the list it yields.
+    """
+    executed = []
+
+    def record(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    engine = db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield executed
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
 def login(user, client):
     url = url_for('main.login')
     rv = client.get(url)